@@ -0,0 +1,324 @@
+from array import array
+from mp_interpretator import *
+
+
+# =====================================================================================================================
+# Symbolic execution into an and-inverter graph: stack and variable bits are literals (2 * node + complement bit),
+# literal 0 is the constant false and literal 1 - true, so the constants pushed by the program are already literals.
+# Native functions become AND nodes with complemented edges; equal nodes are stored once (structural hashing),
+# constant inputs are propagated; a condition on a non-constant bit runs both branches and merges the stack and
+# variables with multiplexers.
+# =====================================================================================================================
+class Aig:
+    def __init__(self):
+        # node 0 - the constant, inputs - nodes with both children 0, AND nodes - children literals (left > right)
+        self.left = array('I', [0])
+        self.right = array('I', [0])
+        self.inputs: List[int] = []  # input literals
+        self.outputs: List[int] = []  # output literals
+        self._hash = {}  # (left << 32) | right -> literal of the AND node
+
+    @property
+    def num_ands(self):
+        return len(self.left) - 1 - len(self.inputs)
+
+    def add_input(self):
+        self.inputs.append(2 * len(self.left))
+        self.left.append(0)
+        self.right.append(0)
+        return self.inputs[-1]
+
+    def and_(self, a, b):
+        if a < b:
+            a, b = b, a
+        if b <= 1:
+            return a if b == 1 else 0
+        elif a == b:
+            return a
+        elif a == b ^ 1:
+            return 0
+        key = (a << 32) | b
+        ret = self._hash.get(key)
+        if ret is None:
+            ret = 2 * len(self.left)
+            self.left.append(a)
+            self.right.append(b)
+            self._hash[key] = ret
+        return ret
+
+    @staticmethod
+    def not_(a):
+        return a ^ 1
+
+    def or_(self, a, b):
+        return self.and_(a ^ 1, b ^ 1) ^ 1
+
+    def xor(self, a, b):
+        return self.or_(self.and_(a, b ^ 1), self.and_(a ^ 1, b))
+
+    def im(self, a, b):
+        """ a -> b """
+        return self.and_(a, b ^ 1) ^ 1
+
+    def mux(self, c, a, b):
+        """ c ? a : b """
+        if a == b:
+            return a
+        return self.or_(self.and_(c, a), self.and_(c ^ 1, b))
+
+    def evaluate(self, bits):
+        """ Output bits for input bits (lists of zeros and ones) """
+        if len(bits) != len(self.inputs):
+            raise IpRunError(f'received {len(bits)} input bits, should be {len(self.inputs)}')
+        left = self.left
+        right = self.right
+        vals = bytearray(len(left))
+        for lit, b in zip(self.inputs, bits):
+            vals[lit >> 1] = b
+        for n in range(1, len(left)):
+            a = left[n]
+            if a:
+                vals[n] = (vals[a >> 1] ^ (a & 1)) & (vals[right[n] >> 1] ^ (right[n] & 1))
+        return [vals[lit >> 1] ^ (lit & 1) for lit in self.outputs]
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # AIGER export: inputs are numbered first, then the AND nodes the outputs depend on, in creation order
+    def _numbering(self):
+        """ (new number of each node (0 - unused), list of used AND nodes) """
+        left = self.left
+        right = self.right
+        used = bytearray(len(left))
+        for lit in self.outputs:
+            used[lit >> 1] = 1
+        for n in range(len(left) - 1, 0, -1):
+            if used[n] and left[n]:
+                used[left[n] >> 1] = 1
+                used[right[n] >> 1] = 1
+        num = array('I', bytes(4 * len(left)))
+        for i, lit in enumerate(self.inputs):
+            num[lit >> 1] = i + 1
+        ands = [n for n in range(1, len(left)) if used[n] and left[n]]
+        for i, n in enumerate(ands, len(self.inputs) + 1):
+            num[n] = i
+        return num, ands
+
+    def _header(self, fmt, num_ands):
+        return f'{fmt} {len(self.inputs) + num_ands} {len(self.inputs)} 0 {len(self.outputs)} {num_ands}\n'
+
+    def _symbols(self, comment):
+        ret = [f'i{i} x{i}\n' for i in range(len(self.inputs))]
+        ret.extend(f'o{i} y{i}\n' for i in range(len(self.outputs)))
+        if comment:
+            ret.append(f'c\n{comment}\n')
+        return ''.join(ret)
+
+    def write_aag(self, f, comment=''):
+        """ ASCII AIGER to the text file f """
+        num, ands = self._numbering()
+        f.write(self._header('aag', len(ands)))
+        f.writelines(f'{2 * (i + 1)}\n' for i in range(len(self.inputs)))
+        f.writelines(f'{2 * num[lit >> 1] | (lit & 1)}\n' for lit in self.outputs)
+        for n in ands:
+            a = self.left[n]
+            b = self.right[n]
+            f.write(f'{2 * num[n]} {2 * num[a >> 1] | (a & 1)} {2 * num[b >> 1] | (b & 1)}\n')
+        f.write(self._symbols(comment))
+
+    @staticmethod
+    def _varint(buf: bytearray, n):
+        while n >= 0x80:
+            buf.append((n & 0x7F) | 0x80)
+            n >>= 7
+        buf.append(n)
+
+    def write_aig(self, f, comment=''):
+        """ Binary AIGER to the binary file f """
+        num, ands = self._numbering()
+        f.write(self._header('aig', len(ands)).encode())
+        f.write(''.join(f'{2 * num[lit >> 1] | (lit & 1)}\n' for lit in self.outputs).encode())
+        buf = bytearray()
+        for n in ands:
+            lhs = 2 * num[n]
+            a = 2 * num[self.left[n] >> 1] | (self.left[n] & 1)
+            b = 2 * num[self.right[n] >> 1] | (self.right[n] & 1)
+            if a < b:
+                a, b = b, a
+            self._varint(buf, lhs - a)
+            self._varint(buf, a - b)
+            if len(buf) >= 1 << 16:
+                f.write(buf)
+                buf.clear()
+        f.write(buf)
+        f.write(self._symbols(comment).encode())
+
+    def save(self, fname, comment=''):
+        """ Write AIGER: binary for *.aig files, ASCII otherwise """
+        if fname.endswith('.aig'):
+            with open(fname, 'wb') as f:
+                self.write_aig(f, comment)
+        else:
+            with open(fname, 'w') as f:
+                self.write_aag(f, comment)
+
+
+# =====================================================================================================================
+class AigLit:
+    """ Literal with bitwise operators building graph nodes, to evaluate gate expressions (Gate.fn) """
+    __slots__ = ('g', 'lit')
+
+    def __init__(self, g, lit):
+        self.g = g
+        self.lit = lit
+
+    def __and__(self, other):
+        return AigLit(self.g, self.g.and_(self.lit, other.lit))
+
+    def __or__(self, other):
+        return AigLit(self.g, self.g.or_(self.lit, other.lit))
+
+    def __xor__(self, other):
+        return AigLit(self.g, self.g.xor(self.lit, other.lit))
+
+    def __invert__(self):
+        return AigLit(self.g, self.lit ^ 1)
+
+
+_GRAPH_OPS = {
+    # gates with their own graph operations; other gates are built from their expressions
+    'and:2:1': lambda g, a, b: g.and_(a, b),
+    'or:2:1': lambda g, a, b: g.or_(a, b),
+    'xor:2:1': lambda g, a, b: g.xor(a, b),
+    'im:2:1': lambda g, a, b: g.im(a, b),
+    'not:1:1': lambda g, a: a ^ 1,
+    'mux:3:1': lambda g, a, b, c: g.mux(a, b, c)
+}
+
+
+# =====================================================================================================================
+class AigRunState(IpRunState):
+    def __init__(self, stack, f: ProgFunc, g):
+        super().__init__(stack, f)
+        self.g = g  # the graph: and_, or_, xor, im, mux on literals
+        self.base = 0  # stack position of the first input bit of the current function
+        self._base_stack = []
+
+    def vars_push(self, f: ProgFunc):
+        super().vars_push(f)
+        self._base_stack.append(self.base)
+        self.base = len(self.stack) - f.len_in
+
+    def vars_pop(self):
+        super().vars_pop()
+        self.base = self._base_stack.pop()
+
+
+# =====================================================================================================================
+class AigRunFunc(IpRunFunc):
+    @staticmethod
+    def _run_native(rs: AigRunState, f: ProgFunc):
+        st = rs.stack
+        n = len(st) - f.len_in
+        op = _GRAPH_OPS.get(f.descr)
+        if op is not None:
+            v = op(rs.g, *st[n:])
+        else:
+            v = f.gate.fn(*[AigLit(rs.g, lit) for lit in st[n:]]).lit
+        del st[n + 1:]
+        st[n] = v
+
+    @staticmethod
+    def _run_table(rs: AigRunState, f: ProgFunc):
+        # the inputs are not known, so the function body is expanded
+        AigRunFunc._run_code(rs, f)
+
+    @staticmethod
+    def _run_intrinsic(rs: AigRunState, f: ProgFunc):
+        AigRunFunc._run_code(rs, f)
+
+
+# =====================================================================================================================
+class AigRunIf(Runner):
+    def run(self, rs: AigRunState):
+        if not isinstance(self.po, ProgIf):
+            raise IpRunError('unexpected error: type mismatch')
+        x = self.po
+        c = rs.stack.pop()
+        if c == 1:
+            x.block.runner.run(rs)
+            return
+        elif c == 0:
+            if x.block_else is not None:
+                x.block_else.runner.run(rs)
+            return
+
+        # both branches are executed, then the results are merged by multiplexers;
+        # a branch cannot reach below the stack base of the current function (x.stack_len_in is the depth of
+        # the first repetition only, if the if is in a loop)
+        base = rs.base
+        tail = rs.stack[base:]
+        frame = rs.frame.copy()
+
+        x.block.runner.run(rs)
+        tail_if = rs.stack[base:]
+        frame_if = rs.frame.copy()
+
+        del rs.stack[base:]
+        rs.stack.extend(tail)
+        rs.frame[:] = frame
+        if x.block_else is not None:
+            x.block_else.runner.run(rs)
+
+        if len(rs.stack) - base != len(tail_if):
+            raise IpRunError(f'stack depth after if and else is different (in {rs.f.descr})')
+        g = rs.g
+        rs.stack[base:] = [g.mux(c, v1, v2) for v1, v2 in zip(tail_if, rs.stack[base:])]
+        rs.frame[:] = [g.mux(c, v1, v2) for v1, v2 in zip(frame_if, rs.frame)]
+
+
+# =====================================================================================================================
+def aig_runners():
+    ret = ip_runners()
+    ret.update({
+        'Prog': AigRunProg,
+        'ProgFunc': AigRunFunc,
+        'ProgIf': AigRunIf
+    })
+    return ret
+
+
+# =====================================================================================================================
+class AigRunProg(IpRunProg):
+    def __init__(self, prog: Prog):
+        super().__init__(prog)
+        self._graphs = {}
+
+    def build(self, func_name: str, g=None):
+        """ Execute the function on symbolic inputs; returns the graph (Aig by default) with its inputs and outputs """
+        f = self.get_func(func_name)
+        g = g if g is not None else Aig()
+        rs = AigRunState([g.add_input() for _ in range(f.len_in)], f, g)
+        f.runner.run(rs)
+        g.outputs = rs.stack
+        return g
+
+    def get_graph(self, func_name: str) -> Aig:
+        if func_name not in self._graphs:
+            self._graphs[func_name] = self.build(func_name)
+        return self._graphs[func_name]
+
+    def run(self, func_name: str, params):
+        """ Evaluate the graph of the function (built on the first call); parameters as in IpRunProg.run """
+        if params is None or 'param' not in params:
+            raise IpRunError("params['param'] parameter is not defined; example: { 'param': [1, 2] }")
+        param = params['param']
+        print_result = params.get('print_result', True)
+
+        f = self.get_func(func_name)
+        pp = self.param_bits(f, param)
+        out = self.get_graph(func_name).evaluate(pp)
+        ret = self.bits_list_to_int(out)
+
+        if print_result:
+            print(f'{func_name} ( {self.param_to_str(pp, f.fmt[0], ", ")} ) '
+                  + f'-> {self.param_to_str(out, f.fmt[1], ", ")}')
+        return ret
@@ -0,0 +1,359 @@
+#! /usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import hashlib
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from mp_compiler import *
+from mp_interpretator import *
+from mp_packed import pk_runners
+from mp_codegen import cg_runners
+from mp_vm import vm_runners
+from mp_bitslice import bs_runners, BsRunProg
+try:
+    from mp_numpy import np_runners
+except ImportError:
+    np_runners = None
+
+
+# =====================================================================================================================
+# Benchmark suite: compilation and execution of the shipped programs and of generated large programs, for every
+# runner set. Each result is checked (hashlib.sha256 or Python arithmetic) and compared with the result of the
+# interpreter; runners with run_batch (bs, np) also run all inputs of a case in one batch. So the suite is also a
+# correctness gate. Results are written in JSON and can be compared with a previous file:
+#   mp_bench.py [--quick] [--runners=ip,pk,vm,cg,bs,np] [--cases=<name>,...] [--out=<file>] [--compare=<file>]
+# =====================================================================================================================
+_RUNNERS = {
+    'ip': ip_runners,
+    'pk': pk_runners,
+    'vm': vm_runners,
+    'cg': cg_runners,
+    'bs': bs_runners
+}
+if np_runners is not None:
+    _RUNNERS['np'] = np_runners
+_PROG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mp_prog')
+
+
+def _sha32(x):
+    return int(hashlib.sha256(x.to_bytes(4, 'big')).hexdigest(), 16)
+
+
+# =====================================================================================================================
+class BenchCase:
+    """
+        param(i): input parameter of the i-th run; expected(param): the correct result;
+        input_bytes: bytes processed per run (for throughput in bytes), 0 - not applicable
+    """
+    def __init__(self, name, fname, func_name, param, expected, runs, input_bytes=0):
+        self.name = name
+        self.fname = fname
+        self.func_name = func_name
+        self.param = param
+        self.expected = expected
+        self.runs = runs
+        self.input_bytes = input_bytes
+
+
+def _synthetic_calls(n):
+    """ Many small functions (tokenizer, call path): main adds 3 * c_i for every f_i; returns (source, constants) """
+    rnd = random.Random(n)
+    cc = [rnd.randrange(256) for _ in range(n)]
+    ret = ['#include lib_basic_native.mp', '#include lib_sum.mp', '']
+    for i, c in enumerate(cc):
+        ret.append(f'// generated function {i}: adds 3 * {c}')
+        ret.append(f'func f{i}:8:8 #8d:8d {{')
+        ret.append(f'  loop 3 {{ {c}:8> >sum:16:8> }}')
+        ret.append('}')
+    ret.append('func main:8:8 #8d:8d {')
+    ret.extend(f'  >f{i}:8:8>' for i in range(n))
+    ret.append('}')
+    return '\n'.join(ret) + '\n', cc
+
+
+def _synthetic_loops(n):
+    """ Nested loops (loop path): main adds 1 n * n times """
+    return '\n'.join([
+        '#include lib_basic_native.mp',
+        '#include lib_sum.mp',
+        '',
+        'func main:8:8 #8d:8d {',
+        f'  loop {n} {{',
+        f'    loop {n} {{ 1:8> >sum:16:8> }}',
+        '  }',
+        '}'
+    ]) + '\n'
+
+
+def _synthetic_nested(n):
+    """
+        A loop in an unrolled loop and an if in a loop changing the stack depth: main adds n, appends the parity bit
+        of the sum and inverts it 2 * (n + 1) times
+    """
+    return '\n'.join([
+        '#include lib_basic_native.mp',
+        '#include lib_sum.mp',
+        '',
+        'func par:8:1 #8b:1d {',
+        '  def { acc:1 }',
+        '  loop 8 { if { acc:1> 1:1> >xor:2:1> >acc:1 } }',
+        '  acc:1>',
+        '}',
+        'func main:8:9 #8d:8d+1d {',
+        '  def { v:8 p:1 }',
+        f'  loop {n} {{ 1:8> >sum:16:8> }}',
+        '  >v:8> >par:8:1> >p:1 v:8> p:1>',
+        f'  loop 2 {{ loop {n + 1} {{ 1:1> >xor:2:1> }} }}',
+        '}'
+    ]) + '\n'
+
+
+def _nested_expected(p, n):
+    v = (p + n) & 255
+    return (v << 1) | (bin(v).count('1') & 1)
+
+
+def bench_cases(tmp_dir, quick=False):
+    """ Benchmark cases; generated programs are written to tmp_dir with the library files they include """
+    for s in ('lib_basic_native.mp', 'lib_sum.mp'):
+        shutil.copy(os.path.join(_PROG_DIR, s), tmp_dir)
+    n_calls = 200 if quick else 1000
+    src, cc = _synthetic_calls(n_calls)
+    calls_fname = os.path.join(tmp_dir, f'synthetic_calls_{n_calls}.mp')
+    with open(calls_fname, 'w') as f:
+        f.write(src)
+    n_loops = 20 if quick else 60
+    loops_fname = os.path.join(tmp_dir, f'synthetic_loops_{n_loops}.mp')
+    with open(loops_fname, 'w') as f:
+        f.write(_synthetic_loops(n_loops))
+    nested_fname = os.path.join(tmp_dir, f'synthetic_nested_{n_loops}.mp')
+    with open(nested_fname, 'w') as f:
+        f.write(_synthetic_nested(n_loops))
+
+    runs = 1 if quick else 3
+    ret = [
+        BenchCase('example_sum', os.path.join(_PROG_DIR, 'example_sum.mp'), 'sum:16:8',
+                  lambda i: [(i * 37) & 255, (i * 101 + 7) & 255], lambda p: (p[0] + p[1]) & 255, 20 * runs),
+        BenchCase('example_sha256', os.path.join(_PROG_DIR, 'example_sha256.mp'), 'sha256:32:256',
+                  lambda i: list(b'ab%02d' % i), lambda p: int(hashlib.sha256(bytes(p)).hexdigest(), 16), runs, 4)
+    ]
+    for lib in ('native', 'if', 'im'):
+        ret.append(BenchCase(f'sha256_{lib}', os.path.join(_PROG_DIR, f'sha256_{lib}.mp'), 'sha:32:256',
+                             lambda i: (i * 0x9E3779B9) & 0xFFFFFFFF, _sha32, runs, 4))
+    ret.append(BenchCase(f'synthetic_calls_{n_calls}', calls_fname, 'main:8:8',
+                         lambda i: i * 13 & 255, lambda p: (p + 3 * sum(cc)) & 255, runs))
+    ret.append(BenchCase(f'synthetic_loops_{n_loops}', loops_fname, 'main:8:8',
+                         lambda i: i * 29 & 255, lambda p: (p + n_loops * n_loops) & 255, runs))
+    ret.append(BenchCase(f'synthetic_nested_{n_loops}', nested_fname, 'main:8:9',
+                         lambda i: i * 29 & 255, lambda p: _nested_expected(p, n_loops), 20 * runs))
+    return ret
+
+
+# =====================================================================================================================
+def _reference(case: BenchCase):
+    """ Parameters of the runs and their results with the interpreter; raises IpRunError on a wrong result """
+    prog = Compiler(case.fname, ip_runners()).compile(print_warnings=False, entry=case.func_name)
+    params = [case.param(i) for i in range(case.runs + 1)]
+    ret = [prog.run(case.func_name, { 'param': p, 'print_result': False }) for p in params]
+    for p, v in zip(params, ret):
+        if v != case.expected(p):
+            raise IpRunError(f'{case.name} (ip): wrong result for {p}: {hex(v)}, expected {hex(case.expected(p))}')
+    return params, ret
+
+
+def _run_batch(prog, f: ProgFunc, params):
+    """ All parameters in one batch: numbers (bs) or big-endian bytes (np), so any parameter format fits """
+    xx = [IpRunProg.param_int(f, p) for p in params]
+    if isinstance(prog.runner, BsRunProg):
+        return prog.runner.run_batch(f.descr, xx)
+    size = (f.len_in + 7) // 8
+    out = prog.runner.run_batch(f.descr, [list(x.to_bytes(size, 'big')) for x in xx],
+                                { 'input_bytes': True, 'output_bytes': True })
+    return [int.from_bytes(bytes(v), 'big') for v in out]
+
+
+def _check(case: BenchCase, runners_name, params, ref, vv):
+    for p, r, v in zip(params, ref, vv):
+        if v != r:
+            raise IpRunError(f'{case.name} ({runners_name}): wrong result for {p}: {hex(v)}, interpreter {hex(r)}')
+
+
+def _run_case(case: BenchCase, runners_name, params, ref):
+    """
+        Phase timings and throughput of one case with one runner set; params, ref: parameters of the runs and
+        their results with the interpreter; raises IpRunError on a different result
+    """
+    ret = {}
+    t = time.perf_counter()
+    c = Compiler(case.fname, _RUNNERS[runners_name]())
+    c.read_prog()
+    ret['tokenize_s'] = time.perf_counter() - t
+    ret['words'] = len(c.words)
+
+    t = time.perf_counter()
+    prog = Compiler(case.fname, _RUNNERS[runners_name]()).compile(print_warnings=False)
+    ret['compile_s'] = time.perf_counter() - t
+    ret['funcs'] = len(prog.funcs)
+
+    t = time.perf_counter()
+    prog = Compiler(case.fname, _RUNNERS[runners_name]()).compile(print_warnings=False, entry=case.func_name)
+    ret['compile_entry_s'] = time.perf_counter() - t
+    ret['entry_funcs'] = len(prog.funcs)
+
+    # the first run includes lowering or code generation of the runners
+    times = []
+    vv = []
+    for p in params:
+        t = time.perf_counter()
+        vv.append(prog.run(case.func_name, { 'param': p, 'print_result': False }))
+        times.append(time.perf_counter() - t)
+    _check(case, runners_name, params, ref, vv)
+    ret['first_run_s'] = times[0]
+    ret['run_s'] = sum(times[1:]) / case.runs
+    ret['runs_per_s'] = case.runs / sum(times[1:])
+    if case.input_bytes:
+        ret['bytes_per_s'] = case.input_bytes * ret['runs_per_s']
+
+    if hasattr(prog.runner, 'run_batch'):
+        # lanes with different inputs: both branches of an if are executed and merged
+        t = time.perf_counter()
+        vv = _run_batch(prog, prog.runner.get_func(case.func_name), params)
+        ret['batch_s'] = time.perf_counter() - t
+        ret['batch_runs_per_s'] = len(params) / ret['batch_s']
+        _check(case, f'{runners_name} batch', params, ref, vv)
+    return ret
+
+
+def _peak_memory(case: BenchCase):
+    """ Peak traced memory (KB) of compilation and of one run with the interpreter """
+    tracemalloc.start()
+    try:
+        prog = Compiler(case.fname, ip_runners()).compile(print_warnings=False)
+        compile_kb = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        prog.run(case.func_name, { 'param': case.param(0), 'print_result': False })
+        run_kb = (tracemalloc.get_traced_memory()[1] - base) // 1024
+    finally:
+        tracemalloc.stop()
+    return { 'compile_peak_kb': compile_kb, 'run_peak_kb': run_kb }
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_bench(runners=tuple(_RUNNERS), cases=None, quick=False, log=None):
+    """ Results of all cases: { 'meta': ..., 'cases': { case: { 'memory': ..., runners: phases } }, 'errors': ... } """
+    ret = {
+        'meta': {
+            'commit': _commit(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': quick
+        },
+        'cases': {},
+        'errors': []
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for case in bench_cases(tmp_dir, quick):
+            if cases is not None and case.name not in cases:
+                continue
+            rc = ret['cases'][case.name] = { 'memory': _peak_memory(case) }
+            try:
+                params, ref = _reference(case)
+            except (CompilerError, IpRunError) as e:
+                ret['errors'].append(str(e))
+                rc['ip'] = { 'error': str(e) }
+                if log is not None:
+                    log(_case_line(case.name, 'ip', rc['ip']))
+                continue
+            for r in runners:
+                try:
+                    rc[r] = _run_case(case, r, params, ref)
+                except (CompilerError, IpRunError) as e:
+                    ret['errors'].append(str(e))
+                    rc[r] = { 'error': str(e) }
+                except Exception as e:
+                    # a failure of one runner set must not stop the other ones
+                    msg = f'{case.name} ({r}): {type(e).__name__}: {e}'
+                    ret['errors'].append(msg)
+                    rc[r] = { 'error': msg }
+                if log is not None:
+                    log(_case_line(case.name, r, rc[r]))
+    try:
+        import resource
+        ret['meta']['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+    return ret
+
+
+def _case_line(name, runners_name, r):
+    if 'error' in r:
+        return f'{name:<24} {runners_name:<3} ERROR {r["error"]}'
+    ret = (f'{name:<24} {runners_name:<3} compile {r["compile_s"]:8.3f} s  first run {r["first_run_s"]:8.3f} s  '
+           f'run {r["run_s"]:8.4f} s  {r["runs_per_s"]:10.1f} runs/s')
+    if 'batch_s' in r:
+        ret += f'  batch {r["batch_runs_per_s"]:10.1f} runs/s'
+    return ret
+
+
+def compare(old, new):
+    """ Text table of run and compile time ratios (new / old) of the cases and runners present in both results """
+    ret = [f'{"case":<24} {"run":<3} {"compile":>8} {"run":>8}  (new / old; {old["meta"].get("commit")} -> '
+           f'{new["meta"].get("commit")})']
+    for name, rc in new['cases'].items():
+        for r, v in rc.items():
+            ov = old['cases'].get(name, {}).get(r)
+            if r == 'memory' or ov is None or 'error' in v or 'error' in ov:
+                continue
+            ret.append(f'{name:<24} {r:<3} {v["compile_s"] / ov["compile_s"]:8.2f} {v["run_s"] / ov["run_s"]:8.2f}')
+    return '\n'.join(ret)
+
+
+# =====================================================================================================================
+def _go():
+    opts = {}
+    for s in sys.argv[1:]:
+        k, _, v = s[2:].partition('=')
+        if not s.startswith('--') or k not in ('quick', 'runners', 'cases', 'out', 'compare'):
+            print('usage: mp_bench.py [--quick] [--runners=ip,pk,vm,cg,bs,np] [--cases=<name>,...] [--out=<file>] '
+                  '[--compare=<file>]')
+            return 2
+        opts[k] = v
+    runners = opts['runners'].split(',') if opts.get('runners') else list(_RUNNERS)
+    if not set(runners) <= set(_RUNNERS):
+        print(f'unknown runners: {", ".join(set(runners) - set(_RUNNERS))}')
+        return 2
+    cases = opts['cases'].split(',') if opts.get('cases') else None
+
+    ret = run_bench(runners, cases, 'quick' in opts, print)
+    if opts.get('out'):
+        with open(opts['out'], 'w') as f:
+            json.dump(ret, f, indent=1)
+    else:
+        print(json.dumps(ret, indent=1))
+    if opts.get('compare'):
+        with open(opts['compare']) as f:
+            print(compare(json.load(f), ret))
+    if ret['errors']:
+        print('\n'.join(['FAILED:'] + ret['errors']))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_go())
@@ -0,0 +1,150 @@
+from mp_interpretator import *
+
+
+# =====================================================================================================================
+# Bitsliced batch interpreter: every stack and variable bit is a Python int whose bit positions are independent
+# lanes (lane i - i-th input of the batch), so each native gate processes the whole batch with one bitwise operation
+# =====================================================================================================================
+class BsRunState(IpRunState):
+    def __init__(self, stack, f: ProgFunc, mask):
+        super().__init__(stack, f)
+        self.mask = mask  # all lanes set
+        self.base = 0  # stack position of the first input bit of the current function
+        self._base_stack = []
+
+    def vars_push(self, f: ProgFunc):
+        super().vars_push(f)
+        self._base_stack.append(self.base)
+        self.base = len(self.stack) - f.len_in
+
+    def vars_pop(self):
+        super().vars_pop()
+        self.base = self._base_stack.pop()
+
+
+# =====================================================================================================================
+class BsRunFunc(IpRunFunc):
+    @staticmethod
+    def _run_native(rs: BsRunState, f: ProgFunc):
+        # the gate expression works on all lanes at once
+        st = rs.stack
+        n = len(st) - f.len_in
+        v = f.gate.fn(*st[n:]) & rs.mask
+        del st[n + 1:]
+        st[n] = v
+
+    @staticmethod
+    def _run_table(rs: BsRunState, f: ProgFunc):
+        # lanes have different inputs, so a lookup table does not apply
+        BsRunFunc._run_code(rs, f)
+
+    @staticmethod
+    def _run_intrinsic(rs: BsRunState, f: ProgFunc):
+        BsRunFunc._run_code(rs, f)
+
+
+# =====================================================================================================================
+class BsRunIf(Runner):
+    def run(self, rs: BsRunState):
+        if not isinstance(self.po, ProgIf):
+            raise IpRunError('unexpected error: type mismatch')
+        x = self.po
+        c = rs.stack.pop()
+        if c == rs.mask:
+            x.block.runner.run(rs)
+            return
+        elif c == 0:
+            if x.block_else is not None:
+                x.block_else.runner.run(rs)
+            return
+
+        # lanes diverge: both branches are executed, then the results are merged by the condition mask;
+        # a branch cannot reach below the stack base of the current function (x.stack_len_in is the depth of
+        # the first repetition only, if the if is in a loop)
+        base = rs.base
+        tail = rs.stack[base:]
+        frame = rs.frame.copy()
+
+        x.block.runner.run(rs)
+        tail_if = rs.stack[base:]
+        frame_if = rs.frame.copy()
+
+        del rs.stack[base:]
+        rs.stack.extend(tail)
+        rs.frame[:] = frame
+        if x.block_else is not None:
+            x.block_else.runner.run(rs)
+
+        if len(rs.stack) - base != len(tail_if):
+            raise IpRunError(f'stack depth after if and else is different (in {rs.f.descr})')
+        nc = c ^ rs.mask
+        rs.stack[base:] = [(v1 & c) | (v2 & nc) for v1, v2 in zip(tail_if, rs.stack[base:])]
+        rs.frame[:] = [(v1 & c) | (v2 & nc) for v1, v2 in zip(frame_if, rs.frame)]
+
+
+# =====================================================================================================================
+class BsRunAssign(IpRunAssign):
+    def run(self, rs: BsRunState):
+        if not isinstance(self.po, ProgAssign):
+            raise IpRunError('unexpected error: type mismatch')
+        v = self.po
+        if v.is_num:
+            rs.stack.extend([rs.mask if b else 0 for b in IpRunProg.bits_int_to_list(v.var, v.nn)])
+        else:
+            super().run(rs)
+
+
+# =====================================================================================================================
+def bs_runners():
+    ret = ip_runners()
+    ret.update({
+        'Prog': BsRunProg,
+        'ProgFunc': BsRunFunc,
+        'ProgIf': BsRunIf,
+        'ProgAssign': BsRunAssign
+    })
+    return ret
+
+
+# =====================================================================================================================
+class BsRunProg(IpRunProg):
+    def run_batch(self, func_name: str, inputs, params=None):
+        """
+            func_name: 'sum:16:8'
+            inputs: input parameters, one per lane; each one as params['param'] of IpRunProg.run
+            params: reserved
+            returns the list of results (numbers) in input order
+        """
+        f = self.get_func(func_name)
+        inputs = list(inputs)
+        nn = len(inputs)
+        if nn == 0:
+            return []
+
+        # transposition: stack bit i of lane j -> bit j of stack item i
+        rows = [self.param_bits(f, p) for p in reversed(inputs)]
+        stack = [self.bits_list_to_int(col) for col in zip(*rows)]
+
+        rs = BsRunState(stack, f, (1 << nn) - 1)
+        f.runner.run(rs)
+
+        cols = [format(v, f'0{nn}b') for v in rs.stack]
+        ret = [int(''.join(row), 2) for row in zip(*cols)]
+        ret.reverse()
+        return ret
+
+    def run(self, func_name: str, params):
+        """ Single input run (one lane); parameters as in IpRunProg.run """
+        if params is None or 'param' not in params:
+            raise IpRunError("params['param'] parameter is not defined; example: { 'param': [1, 2] }")
+        param = params['param']
+        print_result = params.get('print_result', True)
+
+        f = self.get_func(func_name)
+        pp = self.param_bits(f, param)
+        ret = self.run_batch(func_name, [param])[0]
+
+        if print_result:
+            print(f'{func_name} ( {self.param_to_str(pp, f.fmt[0], ", ")} ) '
+                  + f'-> {self.param_to_str(self.bits_int_to_list(ret, f.len_out), f.fmt[1], ", ")}')
+        return ret
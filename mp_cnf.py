@@ -0,0 +1,152 @@
+import os
+import shutil
+from mp_aig import *
+
+
+# =====================================================================================================================
+# Tseitin encoding of a function in DIMACS CNF: the function is executed on symbolic bits by the and-inverter graph
+# runners (mp_aig.py), but every gate gets a new SAT variable, and its clauses are written out immediately; nothing
+# is kept for the gates, so memory is proportional to the live stack and variable bits. Literals are encoded as in
+# the graph (2 * variable + complement bit; 0 - false, 1 - true); gates with constant or equal inputs are simplified.
+# The header (known at the end) and the map of input and output variables are written before the clauses, which
+# are collected in a temporary file.
+# =====================================================================================================================
+class CnfWriter:
+    def __init__(self, fname, buffer_size=1 << 16):
+        self.fname = fname
+        self.num_vars = 0
+        self.num_clauses = 0
+        self.inputs: List[int] = []
+        self.outputs: List[int] = []
+        self._tmp_fname = f'{fname}.{os.getpid()}.tmp'
+        self._f = open(self._tmp_fname, 'w')
+        self._buf = []
+        self._buffer_size = buffer_size  # clauses
+
+    def _new_lit(self):
+        self.num_vars += 1
+        return 2 * self.num_vars
+
+    @staticmethod
+    def _dimacs(lit):
+        return f'-{lit >> 1}' if lit & 1 else str(lit >> 1)
+
+    def _clause(self, *lits):
+        self._buf.append(' '.join(map(self._dimacs, lits)) + ' 0\n')
+        if len(self._buf) >= self._buffer_size:
+            self._flush()
+
+    def _flush(self):
+        self.num_clauses += len(self._buf)
+        self._f.write(''.join(self._buf))
+        self._buf.clear()
+
+    def add_input(self):
+        self.inputs.append(self._new_lit())
+        return self.inputs[-1]
+
+    def and_(self, a, b):
+        if a < b:
+            a, b = b, a
+        if b <= 1:
+            return a if b == 1 else 0
+        elif a == b:
+            return a
+        elif a == b ^ 1:
+            return 0
+        z = self._new_lit()
+        self._clause(z ^ 1, a)
+        self._clause(z ^ 1, b)
+        self._clause(z, a ^ 1, b ^ 1)
+        return z
+
+    @staticmethod
+    def not_(a):
+        return a ^ 1
+
+    def or_(self, a, b):
+        return self.and_(a ^ 1, b ^ 1) ^ 1
+
+    def xor(self, a, b):
+        if a < b:
+            a, b = b, a
+        if b <= 1:
+            return a ^ b
+        elif a == b:
+            return 0
+        elif a == b ^ 1:
+            return 1
+        z = self._new_lit()
+        self._clause(z ^ 1, a, b)
+        self._clause(z ^ 1, a ^ 1, b ^ 1)
+        self._clause(z, a ^ 1, b)
+        self._clause(z, a, b ^ 1)
+        return z
+
+    def im(self, a, b):
+        """ a -> b """
+        return self.or_(a ^ 1, b)
+
+    def mux(self, c, a, b):
+        """ c ? a : b """
+        if c <= 1:
+            return a if c else b
+        elif a == b:
+            return a
+        elif a == b ^ 1:
+            return self.xor(c, b)
+        elif a <= 1:
+            return self.or_(c, b) if a else self.and_(c ^ 1, b)
+        elif b <= 1:
+            return self.or_(c ^ 1, a) if b else self.and_(c, a)
+        z = self._new_lit()
+        self._clause(c ^ 1, a ^ 1, z)
+        self._clause(c ^ 1, a, z ^ 1)
+        self._clause(c, b ^ 1, z)
+        self._clause(c, b, z ^ 1)
+        return z
+
+    def _map_lit(self, lit):
+        return 'T' if lit == 1 else 'F' if lit == 0 else self._dimacs(lit)
+
+    def close(self, comment=''):
+        """ Write the CNF file: comment, variable map, header, clauses """
+        self._flush()
+        self._f.close()
+        try:
+            with open(self.fname, 'w') as f:
+                if comment:
+                    f.write(f'c {comment}\n')
+                f.writelines(f'c input {i} {self._map_lit(lit)}\n' for i, lit in enumerate(self.inputs))
+                f.writelines(f'c output {i} {self._map_lit(lit)}\n' for i, lit in enumerate(self.outputs))
+                f.write(f'p cnf {self.num_vars} {self.num_clauses}\n')
+                with open(self._tmp_fname) as ft:
+                    shutil.copyfileobj(ft, f)
+        finally:
+            os.remove(self._tmp_fname)
+
+    def abort(self):
+        """ Discard the clauses written so far """
+        self._f.close()
+        os.remove(self._tmp_fname)
+
+
+# =====================================================================================================================
+def cnf_runners():
+    ret = aig_runners()
+    ret['Prog'] = CnfRunProg
+    return ret
+
+
+# =====================================================================================================================
+class CnfRunProg(AigRunProg):
+    def write_cnf(self, func_name: str, fname, buffer_size=1 << 16):
+        """ Write the Tseitin encoding of the function to the DIMACS file; returns the CnfWriter (its statistics) """
+        g = CnfWriter(fname, buffer_size)
+        try:
+            self.build(func_name, g)
+        except BaseException:
+            g.abort()
+            raise
+        g.close(func_name)
+        return g
@@ -0,0 +1,189 @@
+from typing import List
+from mp_interpretator import *
+
+
+# =====================================================================================================================
+# Python code generation: every ProgFunc becomes a Python function taking its input bits as an integer and returning
+# its output bits as an integer; the function stack is a single integer (top of the stack - the least significant
+# bit), so stack moves become shifts and masks, and variables become locals
+# =====================================================================================================================
+_NATIVE_CODE = {
+    'not:1:1': 's ^= 1',
+    'xor:2:1': 's = (s >> 1) ^ (s & 1)',
+    'or:2:1': 's = (s >> 1) | (s & 1)',
+    'and:2:1': 's = (s >> 1) & (s | -2)',
+    'im:2:1': 's = ((s >> 1) ^ 1) | (s & 1)'
+}
+
+
+# =====================================================================================================================
+class PyCodeGen:
+    def __init__(self, prog: Prog):
+        self.prog = prog
+
+    @staticmethod
+    def func_name(f: ProgFunc):
+        """ Python name of the function: sum:64:32 -> f_sum_64_32 """
+        return f'f_{f.name}_{f.len_in}_{f.len_out}'
+
+    @staticmethod
+    def _mask(n):
+        return hex((1 << n) - 1)
+
+    def _native_code(self, f: ProgFunc):
+        if f.descr in _NATIVE_CODE:
+            return _NATIVE_CODE[f.descr]
+        elif f.gate is None:
+            raise CompilerError(f'there is no such native function: {f.descr}')
+        # the top len_in bits index the truth table of the gate
+        return f's = ((s >> {f.len_in}) << 1) | {tuple(f.gate.table)!r}[s & {self._mask(f.len_in)}]'
+
+    def _gen_block(self, b: ProgBlock, ret: List[str], indent: str):
+        n0 = len(ret)
+        for x in b.code:
+            if isinstance(x, ProgAssign):
+                if x.is_num:
+                    ret.append(f'{indent}s = (s << {x.nn}) | {hex(x.var)}' if x.var else f'{indent}s <<= {x.nn}')
+                elif x.var_from_stack:
+                    ret.append(f'{indent}v_{x.var.name} = s & {self._mask(x.nn)}')
+                    if not x.var_to_stack:
+                        ret.append(f'{indent}s >>= {x.nn}')
+                elif x.var_to_stack:
+                    ret.append(f'{indent}s = (s << {x.nn}) | v_{x.var.name}')
+            elif isinstance(x, ProgReduce):
+                if x.nn:
+                    ret.append(f'{indent}s >>= {x.nn}')
+            elif isinstance(x, ProgCall):
+                f = x.f
+                if f.native:
+                    ret.append(f'{indent}{self._native_code(f)}')
+                elif f.len_in:
+                    ret.append(f'{indent}s = ((s >> {f.len_in}) << {f.len_out}) '
+                               f'| {self.func_name(f)}(s & {self._mask(f.len_in)})')
+                else:
+                    ret.append(f'{indent}s = (s << {f.len_out}) | {self.func_name(f)}(0)')
+            elif isinstance(x, ProgIf):
+                ret.append(f'{indent}c = s & 1')
+                ret.append(f'{indent}s >>= 1')
+                ret.append(f'{indent}if c:')
+                self._gen_block(x.block, ret, indent + '    ')
+                if x.block_else is not None:
+                    ret.append(f'{indent}else:')
+                    self._gen_block(x.block_else, ret, indent + '    ')
+            elif isinstance(x, ProgLoop):
+                ret.append(f'{indent}for _ in range({x.nn}):')
+                self._gen_block(x.block, ret, indent + '    ')
+            else:
+                raise CompilerError(f'unexpected instruction: {x}')
+        if len(ret) == n0:
+            ret.append(f'{indent}pass')
+
+    def func_source(self, f: ProgFunc):
+        """ Python source of the function """
+        ret = [f'def {self.func_name(f)}(s):  # {f.descr}']
+        if f.native:
+            ret.append(f'    {self._native_code(f)}')
+        elif f.intrinsic is not None and f.intrinsic.source is not None:
+            ret.append(f'    s = {f.intrinsic.source}')
+        elif f.table is not None:
+            ret.append(f'    s = {tuple(f.table)!r}[s]')
+        else:
+            for v in f.vars.values():
+                ret.append(f'    v_{v.name} = 0')
+            self._gen_block(f.block, ret, '    ')
+        ret.append('    return s')
+        return '\n'.join(ret) + '\n'
+
+    def _get_func(self, func_name: str) -> ProgFunc:
+        if func_name in self.prog.native_funcs:
+            return self.prog.native_funcs[func_name]
+        elif func_name in self.prog.funcs:
+            return self.prog.funcs[func_name]
+        raise CompilerError(f'function {func_name} is not defined in this program')
+
+    def _funcs(self, entry=None) -> List[ProgFunc]:
+        """ Functions in definition order: all of them, or those reachable from the entry function """
+        if entry is None:
+            return list(self.prog.native_funcs.values()) + list(self.prog.funcs.values())
+        if self._get_func(entry).native:
+            return [self.prog.native_funcs[entry]]
+        used = self.prog.call_graph.reachable(entry)
+        return [f for f in self.prog.funcs.values() if f.descr in used]
+
+    def source(self, entry=None):
+        """ Python source of all functions of the program, or those needed for the entry function """
+        return '\n\n'.join(self.func_source(f) for f in self._funcs(entry))
+
+    def compile(self, entry=None):
+        """ Compile the generated source; returns {func descr: python function} """
+        ns = {}
+        funcs = self._funcs(entry)
+        exec(compile(self.source(entry), f'<mp_codegen {entry or "*"}>', 'exec'), ns)
+        return {f.descr: ns[self.func_name(f)] for f in funcs}
+
+    def module_source(self, entry: str):
+        """ Source of a standalone module for the entry function; run(*param) accepts numbers according to format """
+        f = self._get_func(entry)
+        return '\n'.join([
+            f'# generated by mp_codegen.py; entry function: {entry}',
+            '',
+            '',
+            self.source(entry),
+            '',
+            f'ENTRY = {self.func_name(f)}',
+            f'FMT_IN = {f.fmt[0]!r}',
+            f'FMT_OUT = {f.fmt[1]!r}',
+            '',
+            '',
+            'def run(*param):',
+            f'    """ {entry}: input parameters according to FMT_IN -> result (number) """',
+            '    if len(param) != len(FMT_IN):',
+            "        raise ValueError(f'received {len(param)} parameters, should be {len(FMT_IN)}')",
+            '    x = 0',
+            '    for v, (n, _) in zip(param, FMT_IN):',
+            '        if v < 0 or v >> n:',
+            "            raise ValueError(f'invalid parameter value {v} for {n} bits')",
+            '        x = (x << n) | v',
+            '    return ENTRY(x)',
+            ''
+        ])
+
+    def write_module(self, fname, entry: str):
+        with open(fname, 'w') as f:
+            f.write(self.module_source(entry))
+
+
+# =====================================================================================================================
+def cg_runners():
+    ret = ip_runners()
+    ret['Prog'] = CgRunProg
+    return ret
+
+
+# =====================================================================================================================
+class CgRunProg(IpRunProg):
+    """ Runs functions through the generated Python code (generated on the first call of each entry function) """
+    def __init__(self, prog: Prog):
+        super().__init__(prog)
+        self._funcs = {}
+
+    def get_compiled(self, func_name: str):
+        if func_name not in self._funcs:
+            self._funcs.update(PyCodeGen(self.prog).compile(func_name))
+        return self._funcs[func_name]
+
+    def run(self, func_name: str, params):
+        """ Parameters as in IpRunProg.run """
+        if params is None or 'param' not in params:
+            raise IpRunError("params['param'] parameter is not defined; example: { 'param': [1, 2] }")
+        param = params['param']
+        print_result = params.get('print_result', True)
+
+        f = self.get_func(func_name)
+        x = self.param_int(f, param)
+        ret = self.get_compiled(func_name)(x)
+
+        if print_result:
+            print(f'{func_name} ( {self.param_to_str(self.bits_int_to_list(x, f.len_in), f.fmt[0], ", ")} ) '
+                  + f'-> {self.param_to_str(self.bits_int_to_list(ret, f.len_out), f.fmt[1], ", ")}')
+        return ret
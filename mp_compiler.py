@@ -1,7 +1,16 @@
-
 import os
+import io
+import re
+import hashlib
+import pickle
 from mp_compiler_objects import *
 from mp_prog_objects import *
+from mp_codegen import PyCodeGen
+from mp_optimizer import Optimizer
+from mp_natives import GATES
+
+_MPC_VERSION = 6  # version of the compiled program file format (.mpc)
+_WORD_RE = re.compile(r'[.{}]|[^\s.{}]+')  # a word: dot, brace, or a sequence of other non-space characters
 
 
 # =====================================================================================================================
@@ -12,96 +21,417 @@ class Compiler:
         self._mp_file_dir = os.path.dirname(fname) + os.path.sep
         self._fnames = set()
         self.fnames: List[str] = []
-        self.lines: List[Line] = []
+        self.words: List[Word] = []
+        self.line_count = 0
         self.prog = None
         self.runners = runners
+        self.units: Dict[str, SourceUnit] = {}  # file name -> compilation unit of the last read
+        self.changed_fnames: List[str] = []  # files (re)read by the last read of the program
+        self.compiled_funcs: List[str] = []  # functions compiled (not reused) by the last compilation
+        self._func_info = {}  # ProgFunc -> (its warnings, all its words are in one file)
+        self.optimizer = None  # Optimizer of the last compilation with optimization (its stats and report)
+
+    @property
+    def mp_file_name(self):
+        """ Main file name (without directory) """
+        return self._mp_file_name
 
     def __str__(self):
-        return f'compiled: {self._mp_file_dir}{self._mp_file_name} ({len(self.fnames)} files; {len(self.lines)} lines)'
+        return f'compiled: {self._mp_file_dir}{self._mp_file_name} ({len(self.fnames)} files; {self.line_count} lines)'
 
     def _clear_state(self):
         self._fnames.clear()
         self.fnames.clear()
-        self.lines.clear()
+        self.words.clear()
+        self.line_count = 0
         self.prog = None
 
-    def _read_lines(self, fname):
+    def _read_unit(self, fname):
+        """ Compilation unit of the file; the file is tokenized again only if its contents have changed """
+        with open(self._mp_file_dir + fname, 'rb') as f:
+            data = f.read()
+        key = hashlib.sha1(data).hexdigest()
+        u = self.units.get(fname)
+        if u is not None and u.key == key:
+            return u
+
+        u = SourceUnit(fname, key)
+        for line_no, line in enumerate(io.TextIOWrapper(io.BytesIO(data)), 1):
+            u.line_count += 1
+            s = self._strip_comment(line)
+            if '#include' in s:
+                u.includes.append((len(u.words), line_no, self._include_fname(s)))
+            else:
+                for m in _WORD_RE.finditer(s):
+                    u.words.append(Word(fname, line_no, m.start() + 1, m[0]))
+        self.units[fname] = u
+        self.changed_fnames.append(fname)
+        return u
+
+    def _read_words(self, fname):
+        """ Generator of words of the file, including the words of included files in place of #include """
         self._fnames.add(fname)
         self.fnames.append(fname)
 
-        ret: List[Line] = []
-        line_no = 0
-        with open(self._mp_file_dir + fname) as f:
-            ss = [s.rstrip() for s in f.readlines()]
-
-        for line in ss:
-            line_no += 1
-            s = line
-            comment_pos = s.find('//')
-            if comment_pos >= 0:
-                s = s[:comment_pos]
-            if '#include' in s:
-                s = s.strip()[8:].lstrip()  # file name in #include statement
-                if os.path.sep in s:
-                    self._clear_state()
-                    raise CompilerError(f'{fname} {line_no}: the file name must not contain a separator: {s}')
-                if s in self._fnames:
-                    self._clear_state()
-                    raise CompilerError(f'{fname} {line_no}: recursive file reference {s}')
-                ret.extend(self._read_lines(s))
-            else:
-                for s1, s2 in [('.', ' . '), ('{', ' { '), ('}', ' } ')]:
-                    s = s.replace(s1, s2)
-                ww = s.split()
-                ret.append(Line(fname, line_no, line, ww))
+        u = self._read_unit(fname)
+        self.line_count += u.line_count
+        idx = 0
+        for pos, line_no, s in u.includes:
+            for i in range(idx, pos):
+                yield u.words[i]
+            idx = pos
+            if os.path.sep in s:
+                self._clear_state()
+                raise CompilerError(f'{fname} {line_no}: the file name must not contain a separator: {s}')
+            if s in self._fnames:
+                self._clear_state()
+                raise CompilerError(f'{fname} {line_no}: recursive file reference {s}')
+            yield from self._read_words(s)
+        for i in range(idx, len(u.words)):
+            yield u.words[i]
 
         self._fnames.remove(fname)
-        return ret
+
+    @staticmethod
+    def _strip_comment(s):
+        comment_pos = s.find('//')
+        return s[:comment_pos] if comment_pos >= 0 else s
+
+    @staticmethod
+    def _include_fname(s):
+        """ File name in #include statement """
+        return s.strip()[8:].lstrip()
 
     def get_words(self):
         """ List of words of the entire program """
-        if len(self.lines) == 0:
+        if len(self.words) == 0:
             self.read_prog()
-        ret: List[Word] = []
-        for s in self.lines:
-            ret.extend(s.get_words())
-        return ret
+        return self.words
 
     def read_prog(self):
         self._clear_state()
-        self.lines.extend(self._read_lines(self._mp_file_name))
+        self.changed_fnames.clear()
+        self.words.extend(self._read_words(self._mp_file_name))
+
+    def compile(self, print_warnings=True, tabulate=0, cache=False, cache_dir=None, optimize=False, entry=None):
+        """
+            entry: compile only this function and the functions it calls ('sha256:32:256'); other functions
+                   are compiled on demand when the program is asked to run them (None - the whole program)
+            optimize: rewrite the code of functions with the peephole optimizer (mp_optimizer.py)
+            tabulate: functions with fewer input bits are evaluated for all inputs at compile time
+                      and replaced with lookup tables (0 - no tabulation)
+            cache: use the compiled program file (.mpc) if the main file and all included files are unchanged,
+                   write it after compilation otherwise
+            cache_dir: directory of compiled program files (None - next to the main file)
+        """
+        key = None
+        self.optimizer = None
+        lazy = (print_warnings, tabulate, optimize)
+        if cache:
+            key = self._source_hash(tabulate, optimize, entry)
+            if key is not None and self._load_cache(key, cache_dir, print_warnings):
+                if entry is not None:
+                    self.prog.loader = EntryLoader(self, self.prog, lazy, key=(key, entry))
+                    self.optimizer = self.prog.loader.optimizer
+                return self.prog
+
+        self.read_prog()
+        index = self._index_funcs(self.get_words()) if entry is not None else None
+        if index is None:
+            cs = self._compile_words({})
+            if print_warnings:
+                cs.print_warnings()
+            self._check_recursion(cs)
+            if optimize:
+                self.optimize()
+            if tabulate > 0:
+                self.tabulate(tabulate)
+        else:
+            self.prog = Prog(self.runners)
+            self._func_info = {}
+            if all(s != entry for s, _, _, _ in index):
+                raise CompilerError(f'function {entry} is not defined in this program')
+            loader = EntryLoader(self, self.prog, lazy, index, list(self.words))
+            self.optimizer = loader.optimizer
+            cs = self._compile_reachable(entry, loader)
+            self.prog.loader = loader
+        if key is not None:
+            self._save_cache(key, cache_dir, cs.warnings)
+        return self.prog
 
-    def compile(self, print_warnings=True):
+    def recompile(self, print_warnings=True, tabulate=0, optimize=False):
+        """
+            Incremental compilation: only changed files are read and tokenized again, and only functions
+            defined in them and functions depending on those are compiled; other functions are reused
+            from the previous compilation (after a compilation for an entry point - the whole program)
+        """
+        if not self._func_info:
+            return self.compile(print_warnings, tabulate, optimize=optimize)
+        reuse = {f.w_first: f for f in self._func_info}  # functions of the last successful compilation
         self.read_prog()
+        cs = self._compile_words(reuse)
+        if print_warnings:
+            cs.print_warnings()
+        self._check_recursion(cs)
+        self.optimizer = None
+        if optimize:
+            self.optimize()
+        if tabulate > 0:
+            self.tabulate(tabulate)
+        return self.prog
+
+    def _compile_words(self, reuse):
+        """ Compile the words read; reuse: {first word: ProgFunc} - functions of the previous compilation """
         ww = self.get_words()
         if len(ww) == 0:
             raise CompilerError('empty program')
+        if reuse:
+            for i, w in enumerate(ww):
+                w.idx = i
         self.prog = Prog(self.runners)
         cs = CompilerState(ww, self.prog, self.runners)
+        func_info = {}
+        self.compiled_funcs.clear()
         idx = 0
         while idx < cs.nn:
+            w = cs.get_w(idx)
+            f = reuse.get(w)
+            if f is not None and self._is_reusable(cs, f):
+                self._add_func(cs, f)
+                cs.add_warns(self._func_info[f][0])
+                func_info[f] = self._func_info[f]
+                idx = f.w_last.idx + 1
+            else:
+                f = ProgFunc(w, cs.runners)
+                n = cs.warn_count()
+                idx_next = self.compile_func(cs, f)
+                func_info[f] = (cs.get_warns(n), all(ww[i].fname == w.fname for i in range(idx, idx_next)))
+                self.compiled_funcs.append(f.descr)
+                idx = idx_next
+        self._func_info = func_info
+
+        for u in self.units.values():
+            u.funcs = []
+        for f in func_info:
+            self.units[f.w_first.fname].funcs.append(f)
+        return cs
+
+    @staticmethod
+    def _index_funcs(ww: List[Word]):
+        """
+            First pass for a compilation for an entry point: [(descr, index of "func", index after the function,
+            set of called functions)] in program order, found by brace matching and call words only; None if the
+            program is not a sequence of function declarations of this shape (the full compilation reports errors)
+        """
+        ret = []
+        idx = 0
+        nn = len(ww)
+        while idx < nn:
+            if ww[idx].word != 'func' or idx + 2 >= nn:
+                return None
+            i = idx + 2
+            if ww[i].word[0] == '#':
+                i += 1
+            if i < nn and ww[i].word == 'native':
+                ret.append((ww[idx + 1].word, idx, i + 1, set()))
+                idx = i + 1
+                continue
+            if i >= nn or ww[i].word != '{':
+                return None
+            calls = set()
+            depth = 0
+            while i < nn:
+                s = ww[i].word
+                if s == '{':
+                    depth += 1
+                elif s == '}':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                elif s[0] == '>' and s[-1] == '>' and s.count(':') == 2:
+                    calls.add(s[1:-1])
+                i += 1
+            if i >= nn:
+                return None
+            ret.append((ww[idx + 1].word, idx, i + 1, calls))
+            idx = i + 1
+        return ret
+
+    def _compile_reachable(self, descr, loader: 'EntryLoader'):
+        """
+            Compile the function and the functions it calls that are not compiled yet into the program of the loader,
+            in program order (also after loading a compiled program file); returns the CompilerState
+        """
+        print_warnings, tabulate, optimize = loader.lazy
+        prog = loader.prog
+        if loader.index is None:
+            # a compiled program file was loaded: the source is read now (by another compiler, so the state of this
+            # one is unchanged) and must still be the source of that file
+            key, entry = loader.key
+            if self._source_hash(tabulate, optimize, entry) != key:
+                raise CompilerError(f'function {descr} cannot be compiled: the program has changed, compile it again')
+            loader.words = Compiler(self._mp_file_dir + self._mp_file_name).get_words()
+            loader.index = self._index_funcs(loader.words)
+            if loader.index is None:
+                raise CompilerError(f'function {descr} cannot be compiled: the program has changed, compile it again')
+        by_descr = {}
+        for i, (s, _, _, _) in enumerate(loader.index):
+            by_descr.setdefault(s, []).append(i)
+        need = set()
+        todo = [descr]
+        seen = {descr}
+        while todo:
+            for i in by_descr.get(todo.pop(), []):
+                need.add(i)
+                for s in loader.index[i][3]:
+                    if s not in seen:
+                        seen.add(s)
+                        todo.append(s)
+
+        cs = CompilerState(loader.words, prog, prog.runners)
+        new_funcs = []
+        for i in sorted(need):
+            s, idx, _, _ = loader.index[i]
+            if s in prog.funcs or s in prog.native_funcs:
+                continue  # compiled before or loaded from the compiled program file
             f = ProgFunc(cs.get_w(idx), cs.runners)
-            idx = self.compile_func(cs, f)
+            self.compile_func(cs, f)
+            new_funcs.append(f)
+        if self.prog is prog:
+            self.compiled_funcs[:] = [f.descr for f in new_funcs]
         if print_warnings:
             cs.print_warnings()
         self._check_recursion(cs)
-        return self.prog
+        if optimize:
+            for f in new_funcs:
+                if not f.native:
+                    n = Optimizer.count(f.block.code)
+                    loader.optimizer.optimize_func(f)
+                    loader.optimizer.stats[f.descr] = (n, Optimizer.count(f.block.code))
+        if tabulate > 0:
+            self._tabulate(prog, tabulate)
+        return cs
+
+    def _is_reusable(self, cs: CompilerState, f: ProgFunc):
+        """ The function is unchanged, and the functions it calls are the same objects as before """
+        if f not in self._func_info or not self._func_info[f][1]:
+            return False
+        if f.descr in cs.prog.funcs or f.descr in cs.prog.native_funcs:
+            return False
+        todo: List[ProgObject] = [f.block]
+        while todo:
+            x = todo.pop()
+            if isinstance(x, ProgCall):
+                ff = cs.prog.native_funcs if x.f.native else cs.prog.funcs
+                if ff.get(x.f.descr) is not x.f:
+                    return False
+            todo.extend(x.children())
+        return True
+
+    @staticmethod
+    def _add_func(cs: CompilerState, f: ProgFunc):
+        """ Add a function of the previous compilation to the program """
+        if f.native:
+            cs.prog.native_funcs[f.descr] = f
+            return
+        cs.prog.funcs[f.descr] = f
+        cs.prog.call_graph.add_func(f.descr)
+        for s in f.called_func_names:
+            cs.prog.call_graph.add_call(f.descr, s)
+
+    def file_stamps(self, fnames=None):
+        """ Modification stamps of the program files (or the given ones), to detect changes """
+        ret = []
+        for fname in self.fnames if fnames is None else fnames:
+            try:
+                st = os.stat(self._mp_file_dir + fname)
+                ret.append((fname, st.st_mtime_ns, st.st_size))
+            except OSError:
+                ret.append((fname, 0, -1))
+        return ret
+
+    def _hash_file(self, h, fname, fnames):
+        """ Add the file and all included files to the hash """
+        if os.path.sep in fname or fname in fnames:
+            raise CompilerError(f'invalid file reference {fname}')
+        fnames.add(fname)
+        with open(self._mp_file_dir + fname, 'rb') as f:
+            data = f.read()
+        h.update(f'{fname}:{len(data)}:'.encode())
+        h.update(data)
+        for line in data.decode().splitlines():
+            s = self._strip_comment(line)
+            if '#include' in s:
+                self._hash_file(h, self._include_fname(s), fnames)
+        fnames.remove(fname)
+
+    def _source_hash(self, tabulate, optimize=False, entry=None):
+        """ Hash of the main file and all included files; None if the files cannot be read """
+        h = hashlib.sha256(f'mpc {_MPC_VERSION} {tabulate} {int(optimize)} {entry}\n'.encode())
+        try:
+            self._hash_file(h, self._mp_file_name, set())
+        except (OSError, UnicodeDecodeError, CompilerError):
+            return None  # the error will be reported by compilation
+        return h.hexdigest()
+
+    def cache_fname(self, cache_dir=None):
+        """ Compiled program file name """
+        if cache_dir is None:
+            return self._mp_file_dir + self._mp_file_name + 'c'
+        h = hashlib.sha256((self._mp_file_dir + self._mp_file_name).encode()).hexdigest()[:12]
+        return os.path.join(cache_dir, f'{self._mp_file_name}-{h}.mpc')
+
+    def _load_cache(self, key, cache_dir, print_warnings):
+        try:
+            with open(self.cache_fname(cache_dir), 'rb') as f:
+                if f.readline() != f'MPC {_MPC_VERSION} {key}\n'.encode():
+                    return False
+                data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return False
+        self._clear_state()
+        self.fnames.extend(data['fnames'])
+        self.prog = data['prog']
+        self.prog.set_runners(self.runners)
+        if print_warnings:
+            CompilerState.print_warns(data['warnings'])
+        return True
+
+    def _save_cache(self, key, cache_dir, warnings):
+        fname = self.cache_fname(cache_dir)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{fname}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(f'MPC {_MPC_VERSION} {key}\n'.encode())
+            pickle.dump({'fnames': self.fnames, 'warnings': warnings, 'prog': self.prog}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fname)
+
+    def optimize(self):
+        """ Peephole optimization of all functions; returns {function: (instructions before, after)} """
+        self.optimizer = Optimizer(self.prog)
+        return self.optimizer.optimize()
+
+    def tabulate(self, max_len_in):
+        """ Evaluate functions with less than max_len_in input bits for all inputs and store lookup tables """
+        self._tabulate(self.prog, max_len_in)
+
+    @staticmethod
+    def _tabulate(prog: Prog, max_len_in):
+        funcs = [f for f in prog.funcs.values() if f.len_in < max_len_in and f.table is None]
+        if not funcs:
+            return
+        cc = PyCodeGen(prog).compile()
+        for f in funcs:
+            ff = cc[f.descr]
+            f.table = [ff(n) for n in range(1 << f.len_in)]
 
     def _check_recursion(self, cs):
         # in fact, recursion can only occur when calling itself
-        for f in self.prog.funcs.values():
-            prev_len = 0
-            nn = set(f.called_func_names)
-            add = set()
-            while len(nn) > prev_len:
-                prev_len = len(nn)
-                add.clear()
-                for s in f.called_func_names:
-                    add |= set(self.prog.funcs[s].called_func_names)
-                nn |= add
-            if f.descr in nn:
-                idx = f.w_first.idx + 1
-                raise CompilerError(str(Warn(cs.ww[idx], 'recursive function call')))
+        cycle = cs.prog.call_graph.find_cycle()
+        if cycle is not None:
+            idx = cs.prog.funcs[cycle[0]].w_first.idx + 1
+            raise CompilerError(str(Warn(cs.ww[idx], 'recursive function call')))
 
     @staticmethod
     def is_valid_name(s: str):
@@ -181,12 +511,17 @@ class Compiler:
 
         w = cs.get_w(idx)
         if w.word == 'native':
+            if f.descr not in GATES:
+                raise cs.err(f.w_first.idx + 1, f'there is no such native function: {f.descr} '
+                                                f'(available: {", ".join(GATES)})')
             f.native = True
+            f.gate = GATES[f.descr]
             f.w_last = w
             cs.prog.native_funcs[f.descr] = f
             return idx + 1
         elif w.word == '{':
             cs.prog.funcs[f.descr] = f
+            cs.prog.call_graph.add_func(f.descr)
         else:
             raise cs.err(idx, 'expected "native" or "{"')
 
@@ -201,6 +536,7 @@ class Compiler:
         f.called_func_names.sort()
 
         Compiler._check_used_vars(cs, f)
+        f.layout_frame()
 
         return idx
 
@@ -380,6 +716,7 @@ class Compiler:
         elif s in cs.prog.funcs:
             x.f = cs.prog.funcs[s]
             f.called_func_names.append(s)
+            cs.prog.call_graph.add_call(f.descr, s)
         if x.f is None:
             raise cs.err(idx, f'function "{s}" is not defined')
 
@@ -441,3 +778,22 @@ class Compiler:
         b.stack_len_out = cs.stack_len
         cs.vars_pop()
         return idx
+
+
+# =====================================================================================================================
+class EntryLoader:
+    """
+        Prog.loader of a program compiled for an entry point: compiles functions on demand into this program, from
+        the words read for it, also after the compiler has compiled the program again
+    """
+    def __init__(self, compiler: Compiler, prog: Prog, lazy, index=None, words=None, key=None):
+        self.compiler = compiler
+        self.prog = prog
+        self.lazy = lazy  # (print_warnings, tabulate, optimize)
+        self.index = index  # function index (see Compiler._index_funcs); None - read the program on the first call
+        self.words = words
+        self.key = key  # (source hash, entry) of a loaded compiled program file, to read the same program
+        self.optimizer = Optimizer(prog) if lazy[2] else None
+
+    def __call__(self, descr):
+        return self.compiler._compile_reachable(descr, self)
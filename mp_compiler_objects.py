@@ -11,30 +11,6 @@ class CompilerError(Exception):
         return self.err
 
 
-# =====================================================================================================================
-class Line:
-    def __init__(self, fname, line_no, line, ss):
-        self.fname = fname
-        self.line_no = line_no
-        self.line = line
-        self.ss = ss
-
-    def __str__(self):
-        return f'{self.fname} {self.line_no}: {self.line}'
-
-    def get_words(self):
-        """ List of words of the line """
-        ret: List[Word] = []
-        p = 0
-        for s in self.ss:
-            p = self.line.find(s, p)
-            if p < 0:
-                raise CompilerError(f'{self.fname} {self.line_no}: word "{s}" not found in line: {self.line}')
-            ret.append(Word(self.fname, self.line_no, p + 1, s))
-            p += 1
-        return ret
-
-
 # =====================================================================================================================
 class Word:
     def __init__(self, fname, line_no, pos_no, word):
@@ -48,6 +24,18 @@ class Word:
         return f'"{self.word}" ({self.fname} {self.line_no}:{self.pos_no})'
 
 
+# =====================================================================================================================
+class SourceUnit:
+    """ Compilation unit: words of one source file (without included files) and functions defined in it """
+    def __init__(self, fname, key):
+        self.fname = fname
+        self.key = key  # hash of the file contents
+        self.words: List[Word] = []
+        self.includes = []  # (index in words, line number, included file name)
+        self.line_count = 0
+        self.funcs = []  # ProgFunc list, filled after compilation
+
+
 # =====================================================================================================================
 class Warn:
     def __init__(self, w: Word, s: str):
@@ -72,14 +60,31 @@ class CompilerState:
 
     def get_words(self, from_idx: int):
         """ Generator for getting pairs (index, word) starting from the specified index """
-        for i, w in enumerate(self.ww[from_idx:]):
-            yield i + from_idx, w
+        for i in range(from_idx, self.nn):
+            yield i, self.ww[i]
+
+    def warn_count(self):
+        return len(self._warns)
+
+    def get_warns(self, from_idx):
+        return self._warns[from_idx:]
+
+    def add_warns(self, warns: List[Warn]):
+        self._warns.extend(warns)
+
+    @property
+    def warnings(self):
+        return [str(s) for s in self._warns]
 
     def print_warnings(self):
-        if not self._warns:
+        self.print_warns(self.warnings)
+
+    @staticmethod
+    def print_warns(warns):
+        if not warns:
             return
-        print(f'\n{len(self._warns)} warnings:\n')
-        for s in self._warns:
+        print(f'\n{len(warns)} warnings:\n')
+        for s in warns:
             print(f'{s}\n')
 
     def err(self, idx, s):
@@ -1,4 +1,5 @@
 
+from collections import OrderedDict
 from mp_prog_objects import *
 
 
@@ -11,23 +12,56 @@ class IpRunError(Exception):
         return self.err
 
 
+# =====================================================================================================================
+class FramePool:
+    """ Variable frames (zeros on get) by frame length, reused after calls instead of allocated """
+    def __init__(self):
+        self._free: Dict[int, list] = {}  # frame length -> returned frames
+        self._zeros = {}  # frame length -> zero frame to clear a returned one
+
+    def _new(self, n):
+        return [0] * n
+
+    def get(self, n):
+        free = self._free.get(n)
+        if free:
+            frame = free.pop()
+            frame[:] = self._zeros[n]
+            return frame
+        return self._new(n)
+
+    def put(self, frame):
+        free = self._free.get(len(frame))
+        if free is None:
+            free = self._free[len(frame)] = []
+            self._zeros[len(frame)] = self._new(len(frame))
+        free.append(frame)
+
+
 # =====================================================================================================================
 class IpRunState:
-    def __init__(self, stack, f: ProgFunc):
+    def __init__(self, stack, f: ProgFunc, pool: FramePool = None):
         self.stack = stack.copy()  # нули и единицы
-        self._vars_stack = []
-        self.vars = {}
+        self.pool = pool if pool is not None else FramePool()
+        self._frame_stack = []
+        self.frame = self.pool.get(self.frame_len(f))  # variables of the current function (ProgVar.offset)
         self._f_stack = []
         self.f = f
+        self.memo = None  # CallMemo, used by IpRunCallMemo
+
+    @staticmethod
+    def frame_len(f: ProgFunc):
+        return f.frame_size
 
     def vars_push(self, f: ProgFunc):
-        self._vars_stack.append(self.vars)
-        self.vars = {}
+        self._frame_stack.append(self.frame)
+        self.frame = self.pool.get(self.frame_len(f))
         self._f_stack.append(self.f)
         self.f = f
 
     def vars_pop(self):
-        self.vars = self._vars_stack.pop()
+        self.pool.put(self.frame)
+        self.frame = self._frame_stack.pop()
         self.f = self._f_stack.pop()
 
 
@@ -38,30 +72,52 @@ class IpRunFunc(Runner):
             raise IpRunError('unexpected error: type mismatch')
         if self.po.native:
             self._run_native(rs, self.po)
+        elif self.po.intrinsic is not None:
+            self._run_intrinsic(rs, self.po)
+        elif self.po.table is not None:
+            self._run_table(rs, self.po)
         else:
             self._run_code(rs, self.po)
 
     @staticmethod
     def _run_native(rs: IpRunState, f: ProgFunc):
-        if f.descr == 'not:1:1':
-            rs.stack.append(rs.stack.pop() ^ 1)
-        elif f.descr == 'xor:2:1':
-            rs.stack.append(rs.stack.pop() ^ rs.stack.pop())
-        elif f.descr == 'or:2:1':
-            rs.stack.append(rs.stack.pop() | rs.stack.pop())
-        elif f.descr == 'and:2:1':
-            rs.stack.append(rs.stack.pop() & rs.stack.pop())
-        elif f.descr == 'im:2:1':
-            v2 = rs.stack.pop()
-            v1 = rs.stack.pop()
-            rs.stack.append((v1 ^ 1) | v2)
+        # the input bits index the truth table of the gate
+        st = rs.stack
+        if f.len_in == 2:
+            b = st.pop()
+            st[-1] = f.gate.table[(st[-1] << 1) | b]
+        elif f.len_in == 1:
+            st[-1] = f.gate.table[st[-1]]
         else:
-            raise IpRunError(f'there is no such native function: {f.descr}')
+            n = len(st) - f.len_in
+            idx = 0
+            for b in st[n:]:
+                idx = (idx << 1) | b
+            del st[n + 1:]
+            st[n] = f.gate.table[idx]
+
+    @staticmethod
+    def _run_lookup(rs: IpRunState, f: ProgFunc, fn):
+        """ Replace the input bits on the stack with the output bits of fn (numbers) """
+        n = len(rs.stack) - f.len_in
+        idx = 0
+        for b in rs.stack[n:]:
+            idx = (idx << 1) | b
+        del rs.stack[n:]
+        v = fn(idx)
+        rs.stack.extend([(v >> i) & 1 for i in range(f.len_out - 1, -1, -1)])
+
+    @staticmethod
+    def _run_table(rs: IpRunState, f: ProgFunc):
+        IpRunFunc._run_lookup(rs, f, f.table.__getitem__)
+
+    @staticmethod
+    def _run_intrinsic(rs: IpRunState, f: ProgFunc):
+        IpRunFunc._run_lookup(rs, f, f.intrinsic.fn)
 
     @staticmethod
     def _run_code(rs: IpRunState, f: ProgFunc):
-        for name, v in f.vars.items():
-            rs.vars[name] = [0] * v.size
+        # variables are zeros in a new frame
         f.block.runner.run(rs)
 
 
@@ -118,17 +174,14 @@ class IpRunAssign(Runner):
         if v.is_num:
             rs.stack.extend(IpRunProg.bits_int_to_list(v.var, v.nn))
         else:
-            if v.var.name not in rs.vars:
-                raise IpRunError(f'unexpected error: variable {v.var.name} missing (in {rs.f.descr})')
-            vv = rs.vars[v.var.name]
+            o = v.var.offset
             if v.var_from_stack:
                 n = len(rs.stack) - v.nn
-                vv.clear()
-                vv.extend(rs.stack[n:])
+                rs.frame[o:o + v.nn] = rs.stack[n:]
                 if not v.var_to_stack:
                     del rs.stack[n:]
             elif v.var_to_stack:
-                rs.stack.extend(vv)
+                rs.stack.extend(rs.frame[o:o + v.nn])
 
 
 # =====================================================================================================================
@@ -136,11 +189,116 @@ class IpRunCall(Runner):
     def run(self, rs: IpRunState):
         if not isinstance(self.po, ProgCall):
             raise IpRunError('unexpected error: type mismatch')
-        rs.vars_push(self.po.f)
-        self.po.f.runner.run(rs)
+        f = self.po.f
+        if f.native:
+            f.runner.run(rs)  # no variables
+            return
+        rs.vars_push(f)
+        f.runner.run(rs)
         rs.vars_pop()
 
 
+# =====================================================================================================================
+class CallMemoStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+    def __str__(self):
+        return f'hits: {self.hits}, misses: {self.misses}, evictions: {self.evictions}, hit rate: {self.hit_rate:.2%}'
+
+
+# =====================================================================================================================
+class CallMemo:
+    """
+        LRU caches of function results keyed by input bits, one cache per function (functions are pure:
+        the output depends only on len_in input bits)
+        max_size: cache size (entries) per function
+        max_len_in: only functions with at most this number of input bits are cached
+        min_hit_rate, warmup: after warmup lookups, caching is switched off for a function with a lower hit rate
+        funcs: if given, only these functions are cached (descr list), regardless of max_len_in
+    """
+    def __init__(self, max_size=4096, max_len_in=64, min_hit_rate=0.0, warmup=1000, funcs=None):
+        self.max_size = max_size
+        self.max_len_in = max_len_in
+        self.min_hit_rate = min_hit_rate
+        self.warmup = warmup
+        self.funcs = set(funcs) if funcs is not None else None
+        self.caches: Dict[str, OrderedDict] = {}
+        self.stats: Dict[str, CallMemoStats] = {}
+        self.disabled = set()
+
+    def enabled(self, f: ProgFunc):
+        if f.descr in self.disabled:
+            return False
+        if self.funcs is not None:
+            return f.descr in self.funcs
+        return f.len_in <= self.max_len_in
+
+    def get(self, f: ProgFunc, key):
+        if f.descr not in self.caches:
+            self.caches[f.descr] = OrderedDict()
+            self.stats[f.descr] = CallMemoStats()
+        cache = self.caches[f.descr]
+        st = self.stats[f.descr]
+        ret = cache.get(key)
+        if ret is not None:
+            cache.move_to_end(key)
+            st.hits += 1
+            return ret
+        st.misses += 1
+        if st.misses + st.hits >= self.warmup and st.hit_rate < self.min_hit_rate:
+            self.disabled.add(f.descr)
+            cache.clear()
+        return None
+
+    def put(self, f: ProgFunc, key, value):
+        if f.descr in self.disabled:
+            return
+        cache = self.caches[f.descr]
+        cache[key] = value
+        if len(cache) > self.max_size:
+            cache.popitem(last=False)
+            self.stats[f.descr].evictions += 1
+
+    def clear(self):
+        self.caches.clear()
+        self.stats.clear()
+        self.disabled.clear()
+
+    def report(self):
+        ret = []
+        for descr, st in sorted(self.stats.items(), key=lambda x: -x[1].hits):
+            off = ' (disabled)' if descr in self.disabled else ''
+            ret.append(f'{descr}: {st}; size: {len(self.caches[descr])}{off}')
+        return '\n'.join(ret)
+
+
+# =====================================================================================================================
+class IpRunCallMemo(IpRunCall):
+    """ Function call with memoization of results in rs.memo (no memoization if rs.memo is None) """
+    def run(self, rs: IpRunState):
+        f = self.po.f
+        if rs.memo is None or f.native or not rs.memo.enabled(f):
+            super().run(rs)
+            return
+        n = len(rs.stack) - f.len_in
+        key = tuple(rs.stack[n:])
+        ret = rs.memo.get(f, key)
+        if ret is None:
+            super().run(rs)
+            rs.memo.put(f, key, tuple(rs.stack[n:]))
+        else:
+            del rs.stack[n:]
+            rs.stack.extend(ret)
+
+
 # =====================================================================================================================
 def ip_runners():
     return {
@@ -157,27 +315,41 @@ def ip_runners():
 
 
 # =====================================================================================================================
+def ip_memo_runners():
+    """ Runners with memoization of function calls; the cache is passed in params: { 'memo': CallMemo() } """
+    ret = ip_runners()
+    ret['ProgCall'] = IpRunCallMemo
+    return ret
+
+
+# =====================================================================================================================
+# bit codecs: a byte -> its 8 bits as bytes (the high bit first); bits as bytes -> binary digits for int(..., 2)
+_BYTE_BITS = [bytes((b >> i) & 1 for i in range(7, -1, -1)) for b in range(256)]
+_BITS_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+
+
 class IpRunProg:
     def __init__(self, prog: Prog):
         self.prog = prog
+        self.frame_pool = FramePool()  # variable frames, kept between runs
 
     @staticmethod
     def bits_int_to_list(n, p_len):
-        """ Convert a number to a list of zeros and ones """
-        bb = bin(n)[2:]
-        if len(bb) > p_len:
-            raise IpRunError(f'the actual parameter length {len(bb)} bits is greater than the maximum {p_len}')
-        ret = [0] * p_len
-        indent = p_len - len(bb)
-        for i, c in enumerate(bb):
-            if c == '1':
-                ret[i + indent] = 1
-        return ret
+        """ Convert a number to a list of p_len zeros and ones (the high bit first) """
+        if n < 0 or n.bit_length() > p_len:
+            raise IpRunError(f'the actual parameter length {n.bit_length()} bits is greater than the maximum {p_len}')
+        nb = (p_len + 7) >> 3
+        return list(b''.join([_BYTE_BITS[b] for b in n.to_bytes(nb, 'big')])[8 * nb - p_len:])
+
+    @staticmethod
+    def bits_list_to_int(lst):
+        """ Convert a list of zeros and ones (the high bit first) to a number """
+        return int(bytes(lst).translate(_BITS_DIGITS) or b'0', 2)
 
     @staticmethod
     def _bits_binstr_to_list(s, p_len):
         """ Convert bin string to list of zeros and ones """
-        return IpRunProg.bits_int_to_list(int(s.hex(), 16), p_len)
+        return IpRunProg.bits_int_to_list(int.from_bytes(s, 'big'), p_len)
 
     @staticmethod
     def bits_list(v, p_len):
@@ -192,7 +364,7 @@ class IpRunProg:
     @staticmethod
     def _list_to_str(lst, fmt):
         """ Convert a value from a list of zeros and ones to a specified format (d, h, b) """
-        n = int(''.join([str(n) for n in lst]), 2)
+        n = IpRunProg.bits_list_to_int(lst)
         if fmt == 'd':
             return str(n)
         elif fmt == 'b':
@@ -219,41 +391,80 @@ class IpRunProg:
             idx += n
         return delim.join(ret)
 
+    def get_func(self, func_name: str) -> ProgFunc:
+        if func_name in self.prog.native_funcs:
+            return self.prog.native_funcs[func_name]
+        elif func_name in self.prog.funcs:
+            return self.prog.funcs[func_name]
+        raise IpRunError(f'function {func_name} is not defined in this program')
+
+    @staticmethod
+    def param_bits(f: ProgFunc, param):
+        """ Convert an input parameter (number, bin string or list of them) to a list of zeros and ones """
+        if type(param) is list:
+            fmt = [n for n, _ in f.fmt[0]]
+            if len(param) != len(fmt):
+                raise IpRunError(f'received {len(param)} parameters, should be {len(fmt)}')
+            pp = []
+            for i, n in enumerate(fmt):
+                pp.extend(IpRunProg.bits_list(param[i], n))
+            return pp
+        return IpRunProg.bits_list(param, f.len_in)
+
+    @staticmethod
+    def _int_param(v, p_len):
+        if type(v) is bytes:
+            v = int.from_bytes(v, 'big')
+        elif type(v) is not int:
+            raise IpRunError(f'valid types: int, bytes; obtained: {type(v).__name__}')
+        if v < 0 or v.bit_length() > p_len:
+            raise IpRunError(f'the actual parameter length {v.bit_length()} bits is greater than the maximum {p_len}')
+        return v
+
+    @staticmethod
+    def param_int(f: ProgFunc, param):
+        """ Convert an input parameter (number, bin string or list of them) to a number of f.len_in bits """
+        if type(param) is list:
+            fmt = [n for n, _ in f.fmt[0]]
+            if len(param) != len(fmt):
+                raise IpRunError(f'received {len(param)} parameters, should be {len(fmt)}')
+            ret = 0
+            for i, n in enumerate(fmt):
+                ret = (ret << n) | IpRunProg._int_param(param[i], n)
+            return ret
+        return IpRunProg._int_param(param, f.len_in)
+
     def run(self, func_name: str, params):
         """
             func_name: 'and:2:1'
-            params: { 'param': ..., 'print_result': True }
+            params: { 'param': ..., 'print_result': True, 'memo': None }
             param: input parameter; options: number, bin string, list of numbers or bin strings
                    (according to the parameter format)
+            memo: CallMemo for runners with memoization (ip_memo_runners)
         """
         if params is None or 'param' not in params:
             raise IpRunError("params['param'] parameter is not defined; example: { 'param': [1, 2] }")
         param = params['param']
         print_result = params.get('print_result', True)
 
-        if func_name in self.prog.native_funcs:
-            f: ProgFunc = self.prog.native_funcs[func_name]
-        elif func_name in self.prog.funcs:
-            f: ProgFunc = self.prog.funcs[func_name]
-        else:
-            raise IpRunError(f'function {func_name} is not defined in this program')
-
-        pp = []
-        if type(param) is list:
-            fmt = [n for n, _ in f.fmt[0]]
-            if len(param) != len(fmt):
-                raise IpRunError(f'received {len(param)} parameters, should be {len(fmt)}')
-            for i, n in enumerate(fmt):
-                pp.extend(self.bits_list(param[i], n))
-        else:
-            pp = self.bits_list(param, f.len_in)
+        f = self.get_func(func_name)
+        pp = self.param_bits(f, param)
 
-        rs = IpRunState(pp, f)
+        rs = IpRunState(pp, f, self.frame_pool)
+        rs.memo = params.get('memo')
         f.runner.run(rs)
 
-        ret = int(''.join([str(n) for n in rs.stack]), 2)
+        ret = self.bits_list_to_int(rs.stack)
 
         if print_result:
             print(f'{func_name} ( {self.param_to_str(pp, f.fmt[0], ", ")} ) '
                   + f'-> {self.param_to_str(rs.stack, f.fmt[1], ", ")}')
         return ret
+
+    def run_many(self, func_name: str, inputs, workers=None, chunksize=256):
+        """
+            Results (numbers) for an iterable of inputs (parameters as in run), in input order; every worker process
+            runs the program with the same runners (workers=None - one per CPU, 1 - in this process)
+        """
+        from mp_pool import run_many
+        return run_many(self.prog, self.get_func(func_name), inputs, workers, chunksize)
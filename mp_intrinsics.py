@@ -0,0 +1,174 @@
+import re
+import random
+import itertools
+from mp_interpretator import *
+from mp_codegen import PyCodeGen
+
+
+# =====================================================================================================================
+# Word-level intrinsics: Python integer implementations of described functions, used by the runners instead of the
+# function code. The input bits of a function are a number s (the first parameter in the high bits, as on the
+# stack), the result is the number of its output bits. MP stays the source of truth: by default an intrinsic is only
+# enabled after it returned the same results as the function code for edge-case and random inputs.
+# =====================================================================================================================
+class Intrinsic:
+    """
+        source: Python expression of s (also inlined by the code generator)
+        fn: function of s, for implementations that are not expressions (module-level, to be pickled with the program)
+    """
+    def __init__(self, descr, source=None, fn=None):
+        if (source is None) == (fn is None):
+            raise CompilerError(f'intrinsic {descr}: exactly one of source and fn is required')
+        self.descr = descr
+        self.source = source
+        self.fn = fn if fn is not None else eval(f'lambda s: {source}')
+
+    def __getstate__(self):
+        ret = self.__dict__.copy()
+        if self.source is not None:
+            ret['fn'] = None
+        return ret
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.source is not None:
+            self.fn = eval(f'lambda s: {self.source}')
+
+    def __str__(self):
+        return f'{self.descr}: {self.source if self.source is not None else self.fn.__name__}'
+
+
+INTRINSICS: Dict[str, Intrinsic] = {}  # registered intrinsics by function descr (before the standard ones)
+
+
+def register_intrinsic(descr, source=None, fn=None):
+    """ Register an intrinsic for the function descr (example: register_intrinsic('sum:64:32', '...')) """
+    INTRINSICS[descr] = Intrinsic(descr, source, fn)
+
+
+# =====================================================================================================================
+# standard intrinsics by function name and sizes: sum, xor, and, or, mul (two parameters of equal size),
+# not, rotrN, rotlN, shrN, shlN (one parameter)
+_TWO_ARGS = {
+    'sum': '((s >> {w}) + s) & {m}',
+    'xor': '((s >> {w}) ^ s) & {m}',
+    'and': '(s >> {w}) & s',
+    'or': '((s >> {w}) | s) & {m}'
+}
+_SHIFTS = {
+    'rotr': '((s >> {n}) | (s << {wn})) & {m}',
+    'rotl': '((s << {n}) | (s >> {wn})) & {m}',
+    'shr': 's >> {n}',
+    'shl': '(s << {n}) & {m}'
+}
+
+
+def standard_intrinsic(descr):
+    """ Intrinsic for the usual meaning of the function name, or None """
+    ss = descr.split(':')
+    if len(ss) != 3 or not ss[1].isdecimal() or not ss[2].isdecimal():
+        return None
+    name, len_in, len_out = ss[0], int(ss[1]), int(ss[2])
+    if len_out == 0:
+        return None
+    m = hex((1 << len_out) - 1)
+    if name in _TWO_ARGS and len_in == 2 * len_out:
+        return Intrinsic(descr, _TWO_ARGS[name].format(w=len_out, m=m))
+    elif name == 'sum' and len_in == 3 and len_out == 2:
+        return Intrinsic(descr, '(s >> 2) + ((s >> 1) & 1) + (s & 1)')
+    elif name == 'mul' and len_in == len_out and len_in % 2 == 0:
+        return Intrinsic(descr, f'(s >> {len_in // 2}) * (s & {hex((1 << len_in // 2) - 1)})')
+    elif name == 'not' and len_in == len_out:
+        return Intrinsic(descr, f's ^ {m}')
+    mm = re.fullmatch(r'(rotr|rotl|shr|shl)(\d+)', name)
+    if mm and len_in == len_out and int(mm[2]) < len_in:
+        n = int(mm[2])
+        return Intrinsic(descr, _SHIFTS[mm[1]].format(n=n, wn=len_in - n, m=m))
+    return None
+
+
+def find_intrinsic(descr):
+    """ Registered or standard intrinsic for the function, or None """
+    if descr in INTRINSICS:
+        return INTRINSICS[descr]
+    return standard_intrinsic(descr)
+
+
+# =====================================================================================================================
+def _test_inputs(f: ProgFunc, samples, rnd: random.Random):
+    """ Edge cases of every parameter (combined for up to 3 parameters) and random inputs """
+    widths = [n for n, _ in f.fmt[0]]
+    if sum(widths) != f.len_in or not widths:
+        widths = [f.len_in]
+
+    def edges(n):
+        if not n:
+            return [0]
+        m = (1 << n) - 1
+        return sorted({0, 1, m, m >> 1, 1 << (n - 1), m // 3, m - m // 3})
+
+    def join(vv):
+        ret = 0
+        for v, n in zip(vv, widths):
+            ret = (ret << n) | v
+        return ret
+
+    ret = []
+    if len(widths) <= 3:
+        ret.extend(join(vv) for vv in itertools.product(*[edges(n) for n in widths]))
+    else:
+        for i, n in enumerate(widths):
+            ret.extend(join([e if j == i else 0 for j in range(len(widths))]) for e in edges(n))
+    ret.extend(rnd.getrandbits(f.len_in) for _ in range(samples))
+    return ret
+
+
+def verify_intrinsic(prog: Prog, f: ProgFunc, intr: Intrinsic, samples=256, seed=0):
+    """ None if the intrinsic matches the function code, otherwise (input, code result, intrinsic result) """
+    saved = f.intrinsic
+    f.intrinsic = None  # the function code (called functions may use verified intrinsics)
+    try:
+        code = PyCodeGen(prog).compile(f.descr)[f.descr]
+    finally:
+        f.intrinsic = saved
+    for s in _test_inputs(f, samples, random.Random(seed)):
+        v1 = code(s)
+        v2 = intr.fn(s)
+        if v1 != v2:
+            return s, v1, v2
+    return None
+
+
+def enable_intrinsics(prog: Prog, verify=True, samples=256, funcs=None):
+    """
+        Attach intrinsics to the described functions (funcs: descr list, default - all with an intrinsic);
+        with verify, only those that match the function code; returns {descr: 'ok' or the reason it is not enabled}
+    """
+    ret = {}
+    for descr in prog.call_graph.topological_order():
+        f = prog.funcs[descr]
+        if funcs is not None and descr not in funcs:
+            continue
+        intr = find_intrinsic(descr)
+        if intr is None:
+            continue
+        bad = verify_intrinsic(prog, f, intr, samples) if verify else None
+        if bad is None:
+            f.intrinsic = intr
+            ret[descr] = 'ok'
+        else:
+            ret[descr] = f'mismatch: input {hex(bad[0])}, code {hex(bad[1])}, intrinsic {hex(bad[2])}'
+    prog.set_runner(prog.runners)  # code lowered or generated by the runners is out of date
+    return ret
+
+
+def disable_intrinsics(prog: Prog):
+    for f in prog.funcs.values():
+        f.intrinsic = None
+    prog.set_runner(prog.runners)
+
+
+def report(status: Dict[str, str]):
+    ret = [f'{descr}: {s}' for descr, s in status.items() if s != 'ok']
+    ret.append(f'intrinsics: {sum(s == "ok" for s in status.values())} of {len(status)} enabled')
+    return '\n'.join(ret)
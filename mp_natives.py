@@ -0,0 +1,61 @@
+from typing import Dict
+from mp_compiler_objects import CompilerError
+
+
+# =====================================================================================================================
+# Native functions (gates): one output bit given by a bitwise expression (&, |, ^, ~) of the inputs a, b, c, ...
+# (a - the deepest on the stack, the last one - the top of the stack). The same expression is evaluated on bits,
+# on lanes of bits (Python ints, NumPy arrays) and on graph literals; the caller masks the result. The compiler
+# resolves every native declaration to its Gate (ProgFunc.gate), so the runners dispatch without name lookups.
+# =====================================================================================================================
+class Gate:
+    def __init__(self, descr, expr):
+        ss = descr.split(':')
+        if len(ss) != 3 or not ss[0].isidentifier() or not ss[1].isdecimal() or ss[2] != '1' \
+                or not 1 <= int(ss[1]) <= 8:
+            raise CompilerError(f'invalid native function {descr}: one output bit and 1 to 8 inputs are required')
+        self.descr = descr
+        self.name = ss[0]
+        self.len_in = int(ss[1])
+        self.expr = expr
+        self.args = 'abcdefgh'[:self.len_in]
+        self._compile()
+
+    def _compile(self):
+        self.fn = eval(f'lambda {", ".join(self.args)}: {self.expr}')
+        k = self.len_in
+        # output bit for the input bits as a number (a - the high bit, as on the packed stack)
+        self.table = [self.fn(*[(i >> j) & 1 for j in range(k - 1, -1, -1)]) & 1 for i in range(1 << k)]
+
+    def __getstate__(self):
+        ret = self.__dict__.copy()
+        ret['fn'] = None
+        return ret
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def __str__(self):
+        return f'{self.descr}: {self.expr}'
+
+
+GATES: Dict[str, Gate] = {}
+
+
+def register_gate(descr, expr):
+    """ Make a native function available to native declarations: register_gate('nand3:3:1', '~(a & b & c)') """
+    GATES[descr] = Gate(descr, expr)
+    return GATES[descr]
+
+
+register_gate('not:1:1', '~a')
+register_gate('and:2:1', 'a & b')
+register_gate('or:2:1', 'a | b')
+register_gate('xor:2:1', 'a ^ b')
+register_gate('im:2:1', '~a | b')
+register_gate('nand:2:1', '~(a & b)')
+register_gate('nor:2:1', '~(a | b)')
+register_gate('xnor:2:1', '~(a ^ b)')
+register_gate('maj:3:1', '(a & b) | (a & c) | (b & c)')
+register_gate('mux:3:1', '(a & b) | (~a & c)')  # a ? b : c
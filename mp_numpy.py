@@ -0,0 +1,281 @@
+import numpy as np
+from mp_interpretator import *
+
+
+# =====================================================================================================================
+# NumPy batch engine: the stack and every variable are 2-D arrays (bit index x batch); the batch axis is packed
+# into uint64 words, 64 inputs per word, so each instruction processes whole columns of inputs at once
+# =====================================================================================================================
+_ONES = np.uint64(0xFFFFFFFFFFFFFFFF)
+_INPLACE = {
+    # gates computed in place into the first input row
+    'and:2:1': np.bitwise_and,
+    'or:2:1': np.bitwise_or,
+    'xor:2:1': np.bitwise_xor
+}
+
+
+# =====================================================================================================================
+class NpFramePool(FramePool):
+    """ Variable frames as (bits x words) arrays """
+    def __init__(self, words):
+        super().__init__()
+        self.words = words
+
+    def _new(self, n):
+        return np.zeros((n, self.words), dtype=np.uint64)
+
+
+# =====================================================================================================================
+class NpRunState(IpRunState):
+    def __init__(self, stack, f: ProgFunc, lanes):
+        super().__init__(stack, f, NpFramePool(len(lanes)))
+        self.sp = len(stack)  # stack depth; self.stack is a buffer with capacity >= sp
+        self.lanes = lanes  # (words,) mask of valid lanes
+        self.base = 0  # stack position of the first input bit of the current function
+        self._base_stack = []
+        self.reserve(len(stack) + 64)
+
+    def vars_push(self, f: ProgFunc):
+        super().vars_push(f)
+        self._base_stack.append(self.base)
+        self.base = self.sp - f.len_in
+
+    def vars_pop(self):
+        super().vars_pop()
+        self.base = self._base_stack.pop()
+
+    def reserve(self, n):
+        """ Make sure the stack buffer can hold n more bits """
+        if self.sp + n > len(self.stack):
+            st = np.zeros((max(2 * len(self.stack), self.sp + n), len(self.lanes)), dtype=np.uint64)
+            st[:self.sp] = self.stack[:self.sp]
+            self.stack = st
+
+    def push(self, a):
+        n = len(a)
+        self.reserve(n)
+        self.stack[self.sp:self.sp + n] = a
+        self.sp += n
+
+
+# =====================================================================================================================
+class NpRunFunc(IpRunFunc):
+    @staticmethod
+    def _run_native(rs: NpRunState, f: ProgFunc):
+        s = rs.stack
+        sp = rs.sp
+        op = _INPLACE.get(f.descr)
+        if op is not None:
+            op(s[sp - 2], s[sp - 1], out=s[sp - 2])
+        elif f.descr == 'not:1:1':
+            s[sp - 1] ^= _ONES
+        else:
+            n = sp - f.len_in
+            s[n] = f.gate.fn(*s[n:sp])
+        rs.sp -= f.len_in - 1
+
+    @staticmethod
+    def _run_table(rs: NpRunState, f: ProgFunc):
+        # lanes have different inputs, so a lookup table does not apply
+        NpRunFunc._run_code(rs, f)
+
+    @staticmethod
+    def _run_intrinsic(rs: NpRunState, f: ProgFunc):
+        NpRunFunc._run_code(rs, f)
+
+
+# =====================================================================================================================
+class NpRunIf(Runner):
+    def run(self, rs: NpRunState):
+        if not isinstance(self.po, ProgIf):
+            raise IpRunError('unexpected error: type mismatch')
+        x = self.po
+        rs.sp -= 1
+        c = rs.stack[rs.sp] & rs.lanes
+        if np.array_equal(c, rs.lanes):
+            x.block.runner.run(rs)
+            return
+        elif not c.any():
+            if x.block_else is not None:
+                x.block_else.runner.run(rs)
+            return
+
+        # lanes diverge: both branches are executed, then the results are merged by the condition mask;
+        # a branch cannot reach below the stack base of the current function (x.stack_len_in is the depth of
+        # the first repetition only, if the if is in a loop)
+        base = rs.base
+        tail = rs.stack[base:rs.sp].copy()
+        frame = rs.frame.copy()
+
+        x.block.runner.run(rs)
+        tail_if = rs.stack[base:rs.sp].copy()
+        frame_if = rs.frame.copy()
+
+        rs.sp = base
+        rs.push(tail)
+        rs.frame[...] = frame
+        if x.block_else is not None:
+            x.block_else.runner.run(rs)
+
+        if rs.sp - base != len(tail_if):
+            raise IpRunError(f'stack depth after if and else is different (in {rs.f.descr})')
+        nc = ~c
+        tail_else = rs.stack[base:rs.sp]
+        tail_else &= nc
+        tail_else |= tail_if & c
+        rs.frame &= nc
+        rs.frame |= frame_if & c
+
+
+# =====================================================================================================================
+class NpRunReduce(Runner):
+    def run(self, rs: NpRunState):
+        if not isinstance(self.po, ProgReduce):
+            raise IpRunError('unexpected error: type mismatch')
+        rs.sp -= self.po.nn
+
+
+# =====================================================================================================================
+class NpRunAssign(Runner):
+    def __init__(self, po: ProgObject):
+        super().__init__(po)
+        self._const = None  # (nn, 1) column of constant bits, filled lazily
+
+    def run(self, rs: NpRunState):
+        if not isinstance(self.po, ProgAssign):
+            raise IpRunError('unexpected error: type mismatch')
+        v = self.po
+        if v.is_num:
+            if self._const is None:
+                bb = IpRunProg.bits_int_to_list(v.var, v.nn)
+                self._const = np.array([[_ONES if b else 0] for b in bb], dtype=np.uint64)
+            rs.reserve(v.nn)
+            rs.stack[rs.sp:rs.sp + v.nn] = self._const
+            rs.sp += v.nn
+        else:
+            vv = rs.frame[v.var.offset:v.var.offset + v.nn]
+            if v.var_from_stack:
+                n = rs.sp - v.nn
+                vv[:] = rs.stack[n:rs.sp]
+                if not v.var_to_stack:
+                    rs.sp = n
+            elif v.var_to_stack:
+                rs.push(vv)
+
+
+# =====================================================================================================================
+def np_runners():
+    ret = ip_runners()
+    ret.update({
+        'Prog': NpRunProg,
+        'ProgFunc': NpRunFunc,
+        'ProgIf': NpRunIf,
+        'ProgReduce': NpRunReduce,
+        'ProgAssign': NpRunAssign
+    })
+    return ret
+
+
+# =====================================================================================================================
+class NpRunProg(IpRunProg):
+    @staticmethod
+    def _fields_to_bits(a, fmt):
+        """ (batch x fields) integer array -> (batch x bits) array of zeros and ones; fields up to 64 bits """
+        ret = []
+        for k, (n, _) in enumerate(fmt):
+            if n > 64:
+                raise IpRunError(f'integer input is limited to 64 bits per parameter, got {n}; use bytes input')
+            col = a[:, k].astype(np.uint64)
+            if n < 64 and (col >> np.uint64(n)).any():
+                raise IpRunError(f'the actual parameter length is greater than the maximum {n}')
+            ret.append((col[:, None] >> np.arange(n - 1, -1, -1, dtype=np.uint64)) & np.uint64(1))
+        return np.concatenate(ret, axis=1).astype(np.uint8) if ret else np.zeros((len(a), 0), dtype=np.uint8)
+
+    @staticmethod
+    def _bytes_to_bits(a, p_len):
+        """ (batch x bytes) uint8 array, big-endian, right-aligned -> (batch x p_len) array of zeros and ones """
+        bb = np.unpackbits(a, axis=1)
+        if bb.shape[1] < p_len:
+            raise IpRunError(f'{a.shape[1]} bytes per input is not enough for {p_len} bits')
+        if bb[:, :bb.shape[1] - p_len].any():
+            raise IpRunError(f'the actual parameter length is greater than the maximum {p_len}')
+        return bb[:, bb.shape[1] - p_len:]
+
+    @staticmethod
+    def _bits_to_fields(bb, fmt):
+        """ (batch x bits) array of zeros and ones -> (batch x fields) uint64 array; fields up to 64 bits """
+        ret = np.zeros((len(bb), len(fmt)), dtype=np.uint64)
+        idx = 0
+        for k, (n, _) in enumerate(fmt):
+            for i in range(idx, idx + n):
+                ret[:, k] <<= np.uint64(1)
+                ret[:, k] |= bb[:, i]
+            idx += n
+        return ret
+
+    def _run_bits(self, f: ProgFunc, bits):
+        """ (batch x len_in) array of zeros and ones -> (batch x len_out) array of zeros and ones """
+        nn = len(bits)
+        words = (nn + 63) // 64
+        lanes = np.full(words, _ONES, dtype=np.uint64)
+        if nn % 64:
+            lanes[-1] = np.uint64((1 << (nn % 64)) - 1)
+
+        # transposition: bit i of input j -> lane j of stack item i
+        packed = np.packbits(np.ascontiguousarray(bits.T), axis=1, bitorder='little')
+        stack = np.zeros((f.len_in, words * 8), dtype=np.uint8)
+        stack[:, :packed.shape[1]] = packed
+        rs = NpRunState(stack.view('<u8').astype(np.uint64), f, lanes)
+        f.runner.run(rs)
+
+        out = np.ascontiguousarray(rs.stack[:rs.sp]).astype('<u8').view(np.uint8)
+        return np.unpackbits(out, axis=1, bitorder='little')[:, :nn].T
+
+    def run_batch(self, func_name: str, inputs, params=None):
+        """
+            func_name: 'sum:16:8'
+            inputs: array of inputs, one row per input:
+                    integers - (batch x parameters) or (batch,) array according to the parameter format,
+                    up to 64 bits per parameter;
+                    bytes - (batch x bytes) uint8 array, big-endian, if params['input_bytes'] is set
+            params: { 'input_bytes': False, 'output_bytes': False }
+            returns (batch x results) uint64 array according to the result format ((batch,) for a single result),
+            or (batch x bytes) uint8 array if params['output_bytes'] is set or some result exceeds 64 bits
+        """
+        params = params if params is not None else {}
+        f = self.get_func(func_name)
+        a = np.asarray(inputs)
+
+        if params.get('input_bytes', False):
+            bits = self._bytes_to_bits(a.reshape(len(a), -1).astype(np.uint8), f.len_in)
+        else:
+            a = a.reshape(len(a), -1) if a.size else np.zeros((len(a), len(f.fmt[0])), dtype=np.uint64)
+            if a.shape[1] != len(f.fmt[0]):
+                raise IpRunError(f'received {a.shape[1]} parameters, should be {len(f.fmt[0])}')
+            bits = self._fields_to_bits(a, f.fmt[0])
+
+        out = self._run_bits(f, bits)
+
+        if params.get('output_bytes', False) or any(n > 64 for n, _ in f.fmt[1]):
+            pad = (-f.len_out) % 8
+            return np.packbits(np.concatenate([np.zeros((len(out), pad), dtype=np.uint8), out], axis=1), axis=1)
+        ret = self._bits_to_fields(out, f.fmt[1])
+        return ret[:, 0] if len(f.fmt[1]) == 1 else ret
+
+    def run(self, func_name: str, params):
+        """ Single input run; parameters as in IpRunProg.run """
+        if params is None or 'param' not in params:
+            raise IpRunError("params['param'] parameter is not defined; example: { 'param': [1, 2] }")
+        param = params['param']
+        print_result = params.get('print_result', True)
+
+        f = self.get_func(func_name)
+        pp = self.param_bits(f, param)
+        out = self._run_bits(f, np.array([pp], dtype=np.uint8).reshape(1, f.len_in))[0].tolist()
+        ret = self.bits_list_to_int(out)
+
+        if print_result:
+            print(f'{func_name} ( {self.param_to_str(pp, f.fmt[0], ", ")} ) '
+                  + f'-> {self.param_to_str(out, f.fmt[1], ", ")}')
+        return ret
@@ -0,0 +1,249 @@
+from typing import List
+from mp_prog_objects import *
+
+
+# =====================================================================================================================
+# Peephole optimizer: rewrites the code of compiled functions without changing the stack depth at the boundaries
+# of blocks, conditions and loops:
+#   - adjacent stack reductions and constant pushes are fused; a push followed by a reduction is cut or dropped;
+#   - store/push round-trips of a variable become copies (>x:n x:n> -> >x:n>) or disappear (x:n> >x:n);
+#   - constant bits fed into native functions are folded; a constant condition selects its branch;
+#   - stores to variables that are never read again become reductions, such copies are dropped;
+#   - zero reductions, loops of 0 repetitions or with empty bodies and empty conditions are dropped
+# =====================================================================================================================
+# =====================================================================================================================
+class Optimizer:
+    def __init__(self, prog: Prog):
+        self.prog = prog
+        self.stats = {}  # function -> (number of instructions before, after)
+
+    @staticmethod
+    def count(code) -> int:
+        """ Number of instructions, including nested blocks """
+        ret = 0
+        for x in code:
+            ret += 1
+            if isinstance(x, (ProgIf, ProgLoop)):
+                for b in x.children():
+                    ret += Optimizer.count(b.code)
+        return ret
+
+    def optimize(self):
+        """ Optimize all functions; returns {function: (number of instructions before, after)} """
+        self.stats = {}
+        for f in self.prog.funcs.values():
+            n = self.count(f.block.code)
+            self.optimize_func(f)
+            self.stats[f.descr] = (n, self.count(f.block.code))
+        return self.stats
+
+    def optimize_func(self, f: ProgFunc):
+        n = -1
+        while n != self.count(f.block.code):
+            n = self.count(f.block.code)
+            self._peephole(f.block)
+            self._dead_stores(f.block.code, set(), True)
+        used = set()
+        self._used_vars(f.block.code, used)
+        f.vars = {name: v for name, v in f.vars.items() if name in used}
+        f.layout_frame()
+
+    def report(self):
+        """ Per-function instruction counts of the last optimization """
+        ret = []
+        for descr, (n1, n2) in self.stats.items():
+            if n1 != n2:
+                ret.append(f'{descr}: {n1} -> {n2}')
+        n1 = sum(n for n, _ in self.stats.values())
+        n2 = sum(n for _, n in self.stats.values())
+        ret.append(f'total: {n1} -> {n2} instructions in {len(self.stats)} functions')
+        return '\n'.join(ret)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    # new instructions
+    def _reduce(self, w: Word, nn):
+        return ProgReduce(w, nn, self.prog.runners)
+
+    def _push_num(self, w: Word, v, nn):
+        x = ProgAssign(w, self.prog.runners)
+        x.var = v
+        x.is_num = True
+        x.nn = nn
+        x.var_to_stack = True
+        return x
+
+    def _var_op(self, w: Word, var: ProgVar, from_stack, to_stack):
+        x = ProgAssign(w, self.prog.runners)
+        x.var = var
+        x.nn = var.size
+        x.var_from_stack = from_stack
+        x.var_to_stack = to_stack
+        return x
+
+    def _call(self, w: Word, f: ProgFunc):
+        x = ProgCall(w, self.prog.runners)
+        x.f = f
+        return x
+
+    # -----------------------------------------------------------------------------------------------------------------
+    @staticmethod
+    def _is_num(x):
+        return isinstance(x, ProgAssign) and x.is_num
+
+    @staticmethod
+    def _is_var(x, from_stack, to_stack):
+        return isinstance(x, ProgAssign) and not x.is_num \
+            and x.var_from_stack == from_stack and x.var_to_stack == to_stack
+
+    def _peephole(self, b: ProgBlock):
+        """ Rewrites at the end of the already optimized part of the block, as each instruction is appended """
+        out = []
+        todo = list(reversed(b.code))
+        while todo:
+            x = todo.pop()
+            if isinstance(x, ProgIf):
+                self._peephole(x.block)
+                if x.block_else is not None:
+                    self._peephole(x.block_else)
+                    if not x.block_else.code:
+                        x.block_else = None
+                if out and self._is_num(out[-1]):
+                    # constant condition: the selected branch takes the place of the condition
+                    c = out.pop()
+                    bb = x.block if c.var & 1 else x.block_else
+                    todo.extend(reversed(bb.code) if bb is not None else [])
+                    if c.nn > 1:
+                        todo.append(self._push_num(c.w_first, c.var >> 1, c.nn - 1))
+                    continue
+                if not x.block.code and x.block_else is None:
+                    x = self._reduce(x.w_first, 1)
+            elif isinstance(x, ProgLoop):
+                self._peephole(x.block)
+                if x.nn == 0 or not x.block.code:
+                    continue
+                elif x.nn == 1:
+                    todo.extend(reversed(x.block.code))
+                    continue
+            out.append(x)
+            while out and self._rewrite(out):
+                pass
+        b.code = out
+
+    def _rewrite(self, out: List[ProgObject]):
+        """ Rewrite the last instructions; returns True if something has changed """
+        b = out[-1]
+        if isinstance(b, ProgReduce) and b.nn == 0:
+            out.pop()
+            return True
+        if len(out) < 2:
+            return False
+        a = out[-2]
+        w = a.w_first
+        ret = None
+
+        if isinstance(b, ProgReduce):
+            if isinstance(a, ProgReduce):
+                ret = [self._reduce(w, a.nn + b.nn)]
+            elif self._is_num(a):
+                ret = [self._reduce(w, b.nn - a.nn)] if b.nn >= a.nn \
+                    else [self._push_num(w, a.var >> b.nn, a.nn - b.nn)]
+            elif self._is_var(a, False, True) and b.nn >= a.nn:
+                ret = [self._reduce(w, b.nn - a.nn)]
+            elif self._is_var(a, True, True) and b.nn >= a.nn:
+                ret = [self._var_op(w, a.var, True, False), self._reduce(b.w_first, b.nn - a.nn)]
+        elif self._is_num(b):
+            if self._is_num(a):
+                ret = [self._push_num(w, (a.var << b.nn) | b.var, a.nn + b.nn)]
+        elif isinstance(b, ProgAssign):
+            if isinstance(a, ProgAssign) and not a.is_num and a.var is b.var:
+                if self._is_var(a, True, False) and self._is_var(b, False, True):
+                    ret = [self._var_op(w, a.var, True, True)]  # >x:n x:n> -> >x:n>
+                elif self._is_var(a, False, True) and self._is_var(b, True, False):
+                    ret = []  # x:n> >x:n
+                elif self._is_var(a, True, True) and self._is_var(b, True, False):
+                    ret = [self._var_op(w, a.var, True, False)]  # >x:n> >x:n -> >x:n
+        elif isinstance(b, ProgCall) and b.f.native and self._is_num(a):
+            ret = self._fold_native(a, b)
+
+        if ret is None:
+            return False
+        del out[-2:]
+        out.extend(ret)
+        return True
+
+    def _fold_native(self, a: ProgAssign, b: ProgCall):
+        """ Constant a (the top a.nn bits of the stack) passed to the native function b; None - no folding """
+        f = b.f
+        if f.gate is None:
+            return None
+        tt = f.gate.table  # indexed by the input bits, the top of the stack - the low bit
+        w = a.w_first
+        k = f.len_in
+        if a.nn >= k:
+            r = tt[a.var & ((1 << k) - 1)]
+            return [self._push_num(w, ((a.var >> k) << 1) | r, a.nn - k + 1)]
+
+        # some arguments are unknown: the result may be a constant, or the unknown argument itself or its negation
+        n = k - a.nn
+        rr = [tt[(u << a.nn) | a.var] for u in range(1 << n)]
+        if rr.count(rr[0]) == len(rr):
+            return [self._reduce(w, n), self._push_num(b.w_first, rr[0], 1)]
+        elif n == 1 and rr == [0, 1]:
+            return []
+        elif n == 1 and rr == [1, 0] and 'not:1:1' in self.prog.native_funcs:
+            return [self._call(b.w_first, self.prog.native_funcs['not:1:1'])]
+        return None
+
+    def live_in(self, f: ProgFunc):
+        """ Variables of the function that may be read before they are written (so their initial zeros matter) """
+        live = set()
+        self._dead_stores(f.block.code, live, False)
+        return live
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def _dead_stores(self, code: List[ProgObject], live: set, rewrite: bool):
+        """
+            Backward liveness of variables; live - variables read after the code (changed in place to those
+            read before it); rewrite - replace stores to variables that are not read later
+        """
+        out = []
+        for x in reversed(code):
+            if isinstance(x, ProgAssign) and not x.is_num:
+                name = x.var.name
+                if x.var_from_stack:
+                    if name not in live:
+                        if rewrite and x.var_to_stack:
+                            continue
+                        elif rewrite:
+                            x = self._reduce(x.w_first, x.nn)
+                    live.discard(name)
+                elif x.var_to_stack:
+                    live.add(name)
+            elif isinstance(x, ProgIf):
+                live_if = set(live)
+                self._dead_stores(x.block.code, live_if, rewrite)
+                if x.block_else is not None:
+                    self._dead_stores(x.block_else.code, live, rewrite)
+                live |= live_if
+            elif isinstance(x, ProgLoop):
+                # the body is followed by the code after the loop or by the body itself
+                live_body = set(live)
+                while True:
+                    live_in = set(live_body)
+                    self._dead_stores(x.block.code, live_in, False)
+                    if live_in <= live_body:
+                        break
+                    live_body |= live_in
+                self._dead_stores(x.block.code, set(live_body), rewrite)
+                live |= live_body
+            out.append(x)
+        if rewrite:
+            code[:] = reversed(out)
+
+    def _used_vars(self, code: List[ProgObject], used: set):
+        for x in code:
+            if isinstance(x, ProgAssign) and not x.is_num:
+                used.add(x.var.name)
+            elif isinstance(x, (ProgIf, ProgLoop)):
+                for b in x.children():
+                    self._used_vars(b.code, used)
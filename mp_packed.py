@@ -0,0 +1,156 @@
+from mp_interpretator import *
+
+
+# =====================================================================================================================
+# Packed-integer interpreter: the stack of the current function and every variable are Python ints (the top of the
+# stack is the least significant bit), so pushes, pops and variable copies become shifts and masks
+# =====================================================================================================================
+class PkRunState(IpRunState):
+    def __init__(self, stack, stack_len, f: ProgFunc, pool: FramePool = None):
+        super().__init__([], f, pool)
+        self.stack = stack  # stack bits of the current function
+        self.stack_len = stack_len
+        self._stack_stack = []  # (stack, stack_len) of the callers below the input of the current function
+
+    @staticmethod
+    def frame_len(f: ProgFunc):
+        return len(f.vars)  # one int per variable (ProgVar.slot)
+
+    def stack_push(self, len_in):
+        """ Leave only len_in top bits for the called function """
+        self._stack_stack.append((self.stack >> len_in, self.stack_len - len_in))
+        self.stack &= (1 << len_in) - 1
+        self.stack_len = len_in
+
+    def stack_pop(self):
+        """ Put the result of the called function on top of the caller stack """
+        s, n = self._stack_stack.pop()
+        self.stack |= s << self.stack_len
+        self.stack_len += n
+
+
+# =====================================================================================================================
+class PkRunFunc(IpRunFunc):
+    @staticmethod
+    def _run_native(rs: PkRunState, f: ProgFunc):
+        # the top len_in bits are the index in the truth table of the gate
+        k = f.len_in
+        rs.stack = ((rs.stack >> k) << 1) | f.gate.table[rs.stack & ((1 << k) - 1)]
+        rs.stack_len -= k - 1
+
+    @staticmethod
+    def _run_table(rs: PkRunState, f: ProgFunc):
+        rs.stack = f.table[rs.stack]
+        rs.stack_len = f.len_out
+
+    @staticmethod
+    def _run_intrinsic(rs: PkRunState, f: ProgFunc):
+        rs.stack = f.intrinsic.fn(rs.stack)
+        rs.stack_len = f.len_out
+
+
+# =====================================================================================================================
+class PkRunIf(Runner):
+    def run(self, rs: PkRunState):
+        if not isinstance(self.po, ProgIf):
+            raise IpRunError('unexpected error: type mismatch')
+        c = rs.stack & 1
+        rs.stack >>= 1
+        rs.stack_len -= 1
+        if c:
+            self.po.block.runner.run(rs)
+        elif self.po.block_else is not None:
+            self.po.block_else.runner.run(rs)
+
+
+# =====================================================================================================================
+class PkRunReduce(Runner):
+    def run(self, rs: PkRunState):
+        if not isinstance(self.po, ProgReduce):
+            raise IpRunError('unexpected error: type mismatch')
+        rs.stack >>= self.po.nn
+        rs.stack_len -= self.po.nn
+
+
+# =====================================================================================================================
+class PkRunAssign(Runner):
+    def run(self, rs: PkRunState):
+        if not isinstance(self.po, ProgAssign):
+            raise IpRunError('unexpected error: type mismatch')
+        v = self.po
+        if v.is_num:
+            rs.stack = (rs.stack << v.nn) | v.var
+            rs.stack_len += v.nn
+        else:
+            if v.var_from_stack:
+                rs.frame[v.var.slot] = rs.stack & ((1 << v.nn) - 1)
+                if not v.var_to_stack:
+                    rs.stack >>= v.nn
+                    rs.stack_len -= v.nn
+            elif v.var_to_stack:
+                rs.stack = (rs.stack << v.nn) | rs.frame[v.var.slot]
+                rs.stack_len += v.nn
+
+
+# =====================================================================================================================
+class PkRunCall(Runner):
+    def run(self, rs: PkRunState):
+        if not isinstance(self.po, ProgCall):
+            raise IpRunError('unexpected error: type mismatch')
+        f = self.po.f
+        if f.native:
+            # gates and lookups replace the top len_in bits in place, without splitting the stack
+            PkRunFunc._run_native(rs, f)
+        elif f.intrinsic is not None or f.table is not None:
+            k = f.len_in
+            x = rs.stack & ((1 << k) - 1)
+            y = f.intrinsic.fn(x) if f.intrinsic is not None else f.table[x]
+            rs.stack = ((rs.stack >> k) << f.len_out) | y
+            rs.stack_len += f.len_out - k
+        elif not f.vars:
+            # no frame for a function without variables (gates written in MP)
+            rs.stack_push(f.len_in)
+            f.runner.run(rs)
+            rs.stack_pop()
+        else:
+            rs.stack_push(f.len_in)
+            rs.vars_push(f)
+            f.runner.run(rs)
+            rs.vars_pop()
+            rs.stack_pop()
+
+
+# =====================================================================================================================
+def pk_runners():
+    ret = ip_runners()
+    ret.update({
+        'Prog': PkRunProg,
+        'ProgFunc': PkRunFunc,
+        'ProgIf': PkRunIf,
+        'ProgReduce': PkRunReduce,
+        'ProgAssign': PkRunAssign,
+        'ProgCall': PkRunCall
+    })
+    return ret
+
+
+# =====================================================================================================================
+class PkRunProg(IpRunProg):
+    def run(self, func_name: str, params):
+        """ Parameters as in IpRunProg.run """
+        if params is None or 'param' not in params:
+            raise IpRunError("params['param'] parameter is not defined; example: { 'param': [1, 2] }")
+        param = params['param']
+        print_result = params.get('print_result', True)
+
+        f = self.get_func(func_name)
+        x = self.param_int(f, param)
+
+        rs = PkRunState(x, f.len_in, f, self.frame_pool)
+        f.runner.run(rs)
+        ret = rs.stack
+
+        if print_result:
+            print(f'{func_name} ( {self.param_to_str(self.bits_int_to_list(x, f.len_in), f.fmt[0], ", ")} ) '
+                  + f'-> {self.param_to_str(self.bits_int_to_list(ret, rs.stack_len), f.fmt[1], ", ")}')
+        return ret
@@ -0,0 +1,119 @@
+import os
+import pickle
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import deque
+from mp_interpretator import *
+
+
+# =====================================================================================================================
+# Parallel execution over a process pool: the program is pickled once and unpickled by every worker on start;
+# inputs and results of a chunk travel through a shared memory slot as fixed-width big-endian records, so a task
+# message is only (slot name, count)
+# =====================================================================================================================
+def record_size(n_bits):
+    """ Bytes per record of n_bits bits """
+    return (n_bits + 7) // 8
+
+
+_pool = None  # (prog, func_name, in_size, out_size, attached slots) in a worker process
+
+
+def _pool_init(prog_data, func_name, in_size, out_size):
+    global _pool
+    prog: Prog = pickle.loads(prog_data)
+    prog.set_runners(prog.runners)
+    _pool = (prog, func_name, in_size, out_size, {})
+
+
+def _run_records(prog: Prog, func_name, in_size, out_size, buf, n):
+    """ Run n records of buf (inputs, then results); returns None or (record index, error message) """
+    out = n * in_size
+    for i in range(n):
+        x = int.from_bytes(buf[i * in_size:(i + 1) * in_size], 'big')
+        try:
+            y = prog.run(func_name, { 'param': x, 'print_result': False })
+        except Exception as e:
+            return i, f'{e.__class__.__name__}: {e}'
+        buf[out + i * out_size:out + (i + 1) * out_size] = y.to_bytes(out_size, 'big')
+    return None
+
+
+def _pool_run(name, n):
+    prog, func_name, in_size, out_size, slots = _pool
+    if name not in slots:
+        slots[name] = shared_memory.SharedMemory(name=name)  # the parent unlinks it
+    return _run_records(prog, func_name, in_size, out_size, slots[name].buf, n)
+
+
+def _put(buf, xx, in_size):
+    for i, x in enumerate(xx):
+        buf[i * in_size:(i + 1) * in_size] = x.to_bytes(in_size, 'big')
+
+
+def _results(buf, n, in_size, out_size):
+    out = n * in_size
+    return [int.from_bytes(buf[out + i * out_size:out + (i + 1) * out_size], 'big') for i in range(n)]
+
+
+# =====================================================================================================================
+def run_many(prog: Prog, f: ProgFunc, inputs, workers=None, chunksize=256):
+    """
+        Generator of results (numbers) of function f for the inputs, in input order; inputs - iterable of parameters
+        as in IpRunProg.run; at most 2 * workers chunks are in progress, so the inputs may be an endless iterator
+    """
+    inputs = (IpRunProg.param_int(f, x) for x in inputs)
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, chunksize)
+    in_size = record_size(f.len_in)
+    out_size = record_size(f.len_out)
+    chunks = iter(lambda: list(itertools.islice(inputs, chunksize)), [])
+
+    def error(k, err):
+        return IpRunError(f'{f.descr}: input {k}: {err}')
+
+    if workers <= 1:
+        k = 0
+        for xx in chunks:
+            buf = bytearray(len(xx) * (in_size + out_size))
+            _put(buf, xx, in_size)
+            e = _run_records(prog, f.descr, in_size, out_size, buf, len(xx))
+            if e is not None:
+                raise error(k + e[0], e[1])
+            yield from _results(buf, len(xx), in_size, out_size)
+            k += len(xx)
+        return
+
+    # a slot is the shared memory for one chunk: chunksize input records, then chunksize result records
+    slot_size = max(1, chunksize * (in_size + out_size))
+    free = [shared_memory.SharedMemory(create=True, size=slot_size) for _ in range(2 * workers)]
+    slots = list(free)
+    try:
+        with multiprocessing.Pool(workers, _pool_init, (pickle.dumps(prog), f.descr, in_size, out_size)) as pool:
+            pending = deque()
+            k = 0
+
+            def ready():
+                nonlocal k
+                slot, n, res = pending.popleft()
+                e = res.get()
+                if e is not None:
+                    raise error(k + e[0], e[1])
+                ret = _results(slot.buf, n, in_size, out_size)
+                k += n
+                free.append(slot)
+                return ret
+
+            for xx in chunks:
+                if not free:
+                    yield from ready()
+                slot = free.pop()
+                _put(slot.buf, xx, in_size)
+                pending.append((slot, len(xx), pool.apply_async(_pool_run, (slot.name, len(xx)))))
+            while pending:
+                yield from ready()
+    finally:
+        for slot in slots:
+            slot.close()
+            slot.unlink()
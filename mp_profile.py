@@ -0,0 +1,172 @@
+import json
+import time
+import marshal
+from mp_interpretator import *
+
+
+# =====================================================================================================================
+# Execution profiler: Prog.run(func_name, { 'param': ..., 'profile': Profile() }) attaches runners derived from the
+# program runners (ProgFunc and ProgLoop runners are subclassed to record counters), runs the function and restores
+# the original runners, so the normal runners are never changed. Times are wall-clock; a native function call is
+# counted as a gate of the calling function and is not timed separately.
+# =====================================================================================================================
+class ProfileStats:
+    def __init__(self, w: Word):
+        self.w = w  # first word of the function (file and line for pstats)
+        self.calls = 0
+        self.time_incl = 0.0
+        self.time_excl = 0.0
+        self.gates: Dict[str, int] = {}  # native function -> executions directly in this function
+        self.gates_incl = 0  # gates including called functions
+        self.loop_iters = 0
+        self.callers: Dict[str, list] = {}  # calling function -> [calls, exclusive time, inclusive time]
+
+    @property
+    def gates_excl(self):
+        return sum(self.gates.values())
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'time_incl': self.time_incl,
+            'time_excl': self.time_excl,
+            'gates': dict(self.gates),
+            'gates_excl': self.gates_excl,
+            'gates_incl': self.gates_incl,
+            'loop_iters': self.loop_iters,
+            'callers': {k: {'calls': v[0], 'time_excl': v[1], 'time_incl': v[2]} for k, v in self.callers.items()}
+        }
+
+
+# =====================================================================================================================
+class Profile:
+    """
+        runners: runner set to profile (None - the runners of the program); only runner sets executing the program
+                 tree (interpreter, packed, bitslice, numpy, graph runners) see the calls of described functions
+    """
+    _SORT_KEYS = {
+        'excl': lambda s: -s.time_excl,
+        'incl': lambda s: -s.time_incl,
+        'calls': lambda s: -s.calls,
+        'gates': lambda s: -s.gates_incl
+    }
+
+    def __init__(self, runners=None):
+        self.runners = runners
+        self.stats: Dict[str, ProfileStats] = {}
+        self.loops: Dict[str, int] = {}  # loop position -> iterations
+        self._frames = []  # [descr, start time, time of calls, gates including calls]
+
+    def clear(self):
+        self.stats.clear()
+        self.loops.clear()
+
+    def _stats(self, f: ProgFunc):
+        st = self.stats.get(f.descr)
+        if st is None:
+            st = self.stats[f.descr] = ProfileStats(f.w_first)
+        return st
+
+    def wrap(self, runners):
+        """ Runner set recording into this profile """
+        profile = self
+        func_runner = runners['ProgFunc']
+        loop_runner = runners['ProgLoop']
+
+        class ProfRunFunc(func_runner):
+            def run(self, rs):
+                f = self.po
+                if f.native:
+                    if profile._frames:
+                        fr = profile._frames[-1]
+                        fr[3] += 1
+                        gates = profile.stats[fr[0]].gates
+                        gates[f.descr] = gates.get(f.descr, 0) + 1
+                    super().run(rs)
+                    return
+                st = profile._stats(f)
+                fr = [f.descr, time.perf_counter(), 0.0, 0]
+                profile._frames.append(fr)
+                try:
+                    super().run(rs)
+                finally:
+                    profile._frames.pop()
+                    t = time.perf_counter() - fr[1]
+                    st.calls += 1
+                    st.time_incl += t
+                    st.time_excl += t - fr[2]
+                    st.gates_incl += fr[3]
+                    caller = profile._frames[-1] if profile._frames else None
+                    if caller is not None:
+                        caller[2] += t
+                        caller[3] += fr[3]
+                        c = st.callers.setdefault(caller[0], [0, 0.0, 0.0])
+                        c[0] += 1
+                        c[1] += t - fr[2]
+                        c[2] += t
+
+        class ProfRunLoop(loop_runner):
+            def run(self, rs):
+                x = self.po
+                if profile._frames:
+                    profile.stats[profile._frames[-1][0]].loop_iters += x.nn
+                    key = f'{x.w_first.fname} {x.w_first.line_no}:{x.w_first.pos_no}'
+                    profile.loops[key] = profile.loops.get(key, 0) + x.nn
+                super().run(rs)
+
+        ret = dict(runners)
+        ret['ProgFunc'] = ProfRunFunc
+        ret['ProgLoop'] = ProfRunLoop
+        return ret
+
+    def run(self, prog: Prog, func_name: str, params):
+        """ Run the function with profiling runners (called by Prog.run for params['profile']) """
+        runners = prog.runners
+        prog.set_runners(self.wrap(self.runners if self.runners is not None else runners))
+        try:
+            return prog.runner.run(func_name, params)
+        finally:
+            self._frames.clear()
+            prog.set_runners(runners)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def report(self, sort='excl', limit=None):
+        """ Text report sorted by: excl, incl (time), calls, gates (including called functions) """
+        ss = sorted(self.stats.items(), key=lambda x: self._SORT_KEYS[sort](x[1]))
+        ret = [f'{"function":<24} {"calls":>10} {"incl, s":>10} {"excl, s":>10} {"gates":>12} {"gates incl":>12} '
+               f'{"loop iters":>10}  gates by native']
+        for descr, st in ss[:limit]:
+            gates = ' '.join(f'{k.split(":")[0]}={v}' for k, v in sorted(st.gates.items()))
+            ret.append(f'{descr:<24} {st.calls:>10} {st.time_incl:>10.4f} {st.time_excl:>10.4f} {st.gates_excl:>12} '
+                       f'{st.gates_incl:>12} {st.loop_iters:>10}  {gates}')
+        return '\n'.join(ret)
+
+    def to_dict(self):
+        return {
+            'functions': {descr: st.to_dict() for descr, st in self.stats.items()},
+            'loops': dict(self.loops)
+        }
+
+    def dump_json(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def dump_pstats(self, fname):
+        """ File for pstats.Stats (profile.Profile.dump_stats format): calls, exclusive and inclusive times """
+        def key(descr):
+            w = self.stats[descr].w
+            return w.fname, w.line_no, descr
+
+        ret = {}
+        for descr, st in self.stats.items():
+            callers = {key(c): (v[0], v[0], v[1], v[2]) for c, v in st.callers.items()}
+            ret[key(descr)] = (st.calls, st.calls, st.time_excl, st.time_incl, callers)
+        with open(fname, 'wb') as f:
+            marshal.dump(ret, f)
+
+    def dump(self, fname):
+        """ JSON for *.json files, pstats otherwise """
+        if fname.endswith('.json'):
+            self.dump_json(fname)
+        else:
+            self.dump_pstats(fname)
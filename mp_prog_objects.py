@@ -1,13 +1,85 @@
 
-from typing import Dict
+from typing import Dict, List
 from mp_compiler_objects import Word, CompilerError
 
 
+# =====================================================================================================================
+class CallGraph:
+    """ Calls between described (not native) functions, by function descr """
+    def __init__(self):
+        self.calls: Dict[str, List[str]] = {}  # function -> called functions
+        self.callers: Dict[str, List[str]] = {}  # function -> calling functions
+
+    def add_func(self, descr):
+        self.calls.setdefault(descr, [])
+        self.callers.setdefault(descr, [])
+
+    def add_call(self, caller, callee):
+        if callee not in self.calls[caller]:
+            self.calls[caller].append(callee)
+            self.callers[callee].append(caller)
+
+    def _dfs(self):
+        """ Depth-first search over all functions: (post-order list, cycle or None) """
+        order = []
+        state = {}  # 1 - on the current path, 2 - done
+        for root in self.calls:
+            if root in state:
+                continue
+            path = [root]
+            iters = [iter(self.calls[root])]
+            state[root] = 1
+            while iters:
+                for s in iters[-1]:
+                    st = state.get(s)
+                    if st == 1:
+                        return order, path[path.index(s):]
+                    elif st is None:
+                        state[s] = 1
+                        path.append(s)
+                        iters.append(iter(self.calls[s]))
+                        break
+                else:
+                    s = path.pop()
+                    iters.pop()
+                    state[s] = 2
+                    order.append(s)
+        return order, None
+
+    def find_cycle(self):
+        """ Some cycle of calls (list of functions, the first one calls the second one, etc.) or None """
+        return self._dfs()[1]
+
+    def topological_order(self):
+        """ All functions, every function after the functions it calls """
+        order, cycle = self._dfs()
+        if cycle is not None:
+            raise CompilerError(f'recursive function call: {" -> ".join(cycle + cycle[:1])}')
+        return order
+
+    def reachable(self, descr):
+        """ Set of functions called directly or indirectly by the function, including itself """
+        ret = {descr}
+        todo = [descr]
+        while todo:
+            for s in self.calls[todo.pop()]:
+                if s not in ret:
+                    ret.add(s)
+                    todo.append(s)
+        return ret
+
+
 # =====================================================================================================================
 class Prog:
     def __init__(self, runners):
         self.funcs = {}
         self.native_funcs = {}
+        self.call_graph = CallGraph()
+        self.loader = None  # compiles a function on demand (a program compiled for an entry point), or None
+        self.set_runner(runners)
+
+    def set_runner(self, runners):
+        self.runners = runners  # kept to attach the same runners to a copy of the program (e.g. in a worker)
         if runners:
             s = self.__class__.__name__
             if s not in runners:
@@ -16,16 +88,75 @@ class Prog:
         else:
             self.runner = None
 
+    def set_runners(self, runners):
+        """ Attach runners to the program and all its objects (e.g. after unpickling) """
+        self.set_runner(runners)
+        for x in self.objects():
+            x.set_runner(runners)
+
+    def objects(self):
+        """ All program objects (functions, variables, blocks and instructions), each one once """
+        seen = set()
+        todo = list(self.native_funcs.values()) + list(self.funcs.values())
+        todo.reverse()
+        while todo:
+            x = todo.pop()
+            if id(x) in seen:
+                continue
+            seen.add(id(x))
+            yield x
+            todo.extend(reversed(x.children()))
+
+    def __getstate__(self):
+        ret = self.__dict__.copy()
+        ret['runner'] = None
+        ret['loader'] = None
+        return ret
+
+    def require(self, func_name: str):
+        """ Compile the function and the functions it calls if they are not compiled yet (Compiler.compile(entry)) """
+        if self.loader is not None and func_name not in self.funcs and func_name not in self.native_funcs:
+            self.loader(func_name)
+
     def run(self, func_name: str, params=None):
+        """ params['profile']: Profile (mp_profile.py) - run with profiling runners """
         if self.runner is None:
             raise CompilerError('runners not defined')
+        self.require(func_name)
+        if params and params.get('profile') is not None:
+            return params['profile'].run(self, func_name, params)
         return self.runner.run(func_name, params)
 
+    def cost(self, func_name: str):
+        """ Static cost of the function (FuncCost): gate counts, executed instructions, stack depth, variable bits """
+        self.require(func_name)
+        return CostModel(self).func_cost(func_name)
+
+    def run_batch(self, func_name: str, inputs, params=None):
+        if self.runner is None:
+            raise CompilerError('runners not defined')
+        if not hasattr(self.runner, 'run_batch'):
+            raise CompilerError(f'batch execution is not supported by {self.runner.__class__.__name__}')
+        self.require(func_name)
+        return self.runner.run_batch(func_name, inputs, params)
+
+    def run_many(self, func_name: str, inputs, workers=None, chunksize=256):
+        """ Iterator of results for an iterable of inputs, computed by a pool of worker processes """
+        if self.runner is None:
+            raise CompilerError('runners not defined')
+        if not hasattr(self.runner, 'run_many'):
+            raise CompilerError(f'parallel execution is not supported by {self.runner.__class__.__name__}')
+        self.require(func_name)
+        return self.runner.run_many(func_name, inputs, workers, chunksize)
+
 
 # =====================================================================================================================
 class ProgObject:
     def __init__(self, w_first: Word, runners):
         self.w_first = self.w_last = w_first
+        self.set_runner(runners)
+
+    def set_runner(self, runners):
         if runners:
             s = self.__class__.__name__
             if s not in runners:
@@ -34,9 +165,22 @@ class ProgObject:
         else:
             self.runner = Runner(self)
 
+    def children(self):
+        """ Nested program objects """
+        return []
+
     # def run(self, rs):
     #     self.runner.run(rs)
 
+    def __getstate__(self):
+        ret = self.__dict__.copy()
+        del ret['runner']
+        return ret
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.runner = Runner(self)
+
     def __str__(self):
         return f'{self.__class__.__name__}: {self.w_first}'
 
@@ -64,10 +208,25 @@ class ProgFunc(ProgObject):
         self.fmt_str = ''  # #16d+16d:16d
         self.fmt = ([], [])  # ([(16, 'd'), (16, 'd')],   [(16, 'd')])
         self.native = False
+        self.gate = None  # Gate (mp_natives.py) of a native function, resolved by the compiler
+        self.table = None  # lookup table of a tabulated function: output (number) for every input (number)
+        self.intrinsic = None  # Intrinsic (mp_intrinsics.py): Python implementation used instead of the code
         self.block = ProgBlock(self.w_first, runners)
         self.vars: Dict[str:ProgVar] = {}
+        self.frame_size = 0  # bits of all variables (see layout_frame)
         self.called_func_names = []
 
+    def children(self):
+        return [self.block] + list(self.vars.values())
+
+    def layout_frame(self):
+        """ Fixed places of the variables in the frame of the function: bit offsets and slots (one per variable) """
+        self.frame_size = 0
+        for i, v in enumerate(self.vars.values()):
+            v.slot = i
+            v.offset = self.frame_size
+            self.frame_size += v.size
+
     def __str__(self):
         w = self.w_first
         return f'{self.__class__.__name__}: "{w.word} {self.descr}" ({w.fname} {w.line_no}:{w.pos_no})'
@@ -82,6 +241,8 @@ class ProgVar(ProgObject):
         self.name = ss[0]
         self.size = int(ss[1])
         self.used = False
+        self.offset = 0  # first bit in the function frame
+        self.slot = 0  # index in the function frame of one value per variable
 
 
 # =====================================================================================================================
@@ -92,6 +253,9 @@ class ProgBlock(ProgObject):
         self.code = []  # list of executable instructions
         self.first_point = None  # first point in block; no points should be in loop block with depth change
 
+    def children(self):
+        return self.code
+
 
 # =====================================================================================================================
 class ProgIf(ProgObject):
@@ -101,6 +265,9 @@ class ProgIf(ProgObject):
         self.block_else = None
         self.stack_len_in = self.stack_len_out = 0
 
+    def children(self):
+        return [self.block] if self.block_else is None else [self.block, self.block_else]
+
 
 # =====================================================================================================================
 class ProgLoop(ProgObject):
@@ -110,6 +277,9 @@ class ProgLoop(ProgObject):
         self.stack_len_in = self.stack_len_out = 0
         self.nn = 0
 
+    def children(self):
+        return [self.block]
+
 
 # =====================================================================================================================
 class ProgReduce(ProgObject):
@@ -134,3 +304,167 @@ class ProgCall(ProgObject):
     def __init__(self, w_first: Word, runners):
         super().__init__(w_first, runners)
         self.f = None  # ProgFunc
+
+
+# =====================================================================================================================
+# Static cost model: without recursion and with fixed loop counts the work of a function is known at compile time.
+# Counts include called functions; a condition makes them data-dependent, so the minimum and maximum over the
+# branches are kept (equal for functions without conditions). Tabulated functions are counted by their code.
+# =====================================================================================================================
+class FuncCost:
+    def __init__(self, f: ProgFunc):
+        self.descr = f.descr
+        self.gates_min: Dict[str, int] = {}  # native function -> executions (including called functions)
+        self.gates_max: Dict[str, int] = {}
+        self.steps_min = 0  # executed instructions (including called functions)
+        self.steps_max = 0
+        self.instrs = 0  # instructions in the function code
+        self.max_stack = 0  # maximum stack depth in bits (from the function stack base, including called functions)
+        self.vars_bits = 0  # bits of the function variables
+        self.vars_bits_incl = 0  # maximum bits of variables of the function and the functions active below it
+        self.exact = True  # no data-dependent conditions (min == max)
+
+    @property
+    def gates(self):
+        """ Total native gate executions (maximum) """
+        return sum(self.gates_max.values())
+
+    def to_dict(self):
+        return {
+            'gates_min': dict(self.gates_min),
+            'gates_max': dict(self.gates_max),
+            'steps_min': self.steps_min,
+            'steps_max': self.steps_max,
+            'instrs': self.instrs,
+            'max_stack': self.max_stack,
+            'vars_bits': self.vars_bits,
+            'vars_bits_incl': self.vars_bits_incl,
+            'exact': self.exact
+        }
+
+
+# =====================================================================================================================
+class CostModel:
+    def __init__(self, prog: Prog):
+        self.prog = prog
+        self.costs: Dict[str, FuncCost] = {}  # function descr -> cost (described and native functions)
+
+    @staticmethod
+    def _add(gg: Dict[str, int], g: Dict[str, int], k=1):
+        for s, n in g.items():
+            gg[s] = gg.get(s, 0) + n * k
+
+    def func_cost(self, descr) -> FuncCost:
+        if descr in self.costs:
+            return self.costs[descr]
+        if descr in self.prog.native_funcs:
+            f = self.prog.native_funcs[descr]
+            c = FuncCost(f)
+            c.gates_min = {descr: 1}
+            c.gates_max = {descr: 1}
+            c.steps_min = c.steps_max = 1
+            c.max_stack = max(f.len_in, f.len_out)
+            self.costs[descr] = c
+            return c
+        if descr not in self.prog.funcs:
+            raise CompilerError(f'function {descr} not found')
+        reachable = self.prog.call_graph.reachable(descr)
+        for s in self.prog.call_graph.topological_order():
+            if s in reachable and s not in self.costs:
+                self.costs[s] = self._cost(self.prog.funcs[s])
+        return self.costs[descr]
+
+    def _cost(self, f: ProgFunc) -> FuncCost:
+        c = FuncCost(f)
+        c.vars_bits = sum(v.size for v in f.vars.values())
+        c.vars_bits_incl = c.vars_bits
+        c.instrs = self._count(f.block)
+        gmin, gmax, smin, smax, _, m = self._block(f.block, c)
+        c.gates_min, c.gates_max = gmin, gmax
+        c.steps_min, c.steps_max = smin, smax
+        c.max_stack = f.len_in + m
+        return c
+
+    def _count(self, b: ProgBlock):
+        ret = 0
+        for x in b.code:
+            ret += 1
+            if isinstance(x, (ProgIf, ProgLoop)):
+                ret += self._count(x.block)
+            if isinstance(x, ProgIf) and x.block_else is not None:
+                ret += self._count(x.block_else)
+        return ret
+
+    def _block(self, b: ProgBlock, c: FuncCost):
+        """ (min gates, max gates, min steps, max steps, stack depth change, max depth over the block start) """
+        gmin: Dict[str, int] = {}
+        gmax: Dict[str, int] = {}
+        smin = smax = 0
+        d = m = 0
+        for x in b.code:
+            smin += 1
+            smax += 1
+            if isinstance(x, ProgAssign):
+                if x.is_num or (x.var_to_stack and not x.var_from_stack):
+                    d += x.nn
+                elif not x.var_to_stack:
+                    d -= x.nn
+            elif isinstance(x, ProgReduce):
+                d -= x.nn
+            elif isinstance(x, ProgCall):
+                fc = self.func_cost(x.f.descr)
+                self._add(gmin, fc.gates_min)
+                self._add(gmax, fc.gates_max)
+                if not x.f.native:
+                    smin += fc.steps_min
+                    smax += fc.steps_max
+                m = max(m, d - x.f.len_in + fc.max_stack)
+                c.vars_bits_incl = max(c.vars_bits_incl, c.vars_bits + fc.vars_bits_incl)
+                c.exact = c.exact and fc.exact
+                d += x.f.len_out - x.f.len_in
+            elif isinstance(x, ProgLoop):
+                g1, g2, s1, s2, dd, mm = self._block(x.block, c)
+                self._add(gmin, g1, x.nn)
+                self._add(gmax, g2, x.nn)
+                smin += s1 * x.nn
+                smax += s2 * x.nn
+                if x.nn:
+                    m = max(m, d + mm + max(0, (x.nn - 1) * dd))
+                d += dd * x.nn
+            elif isinstance(x, ProgIf):
+                d -= 1
+                g1, g2, s1, s2, dd, mm = self._block(x.block, c)
+                if x.block_else is not None:
+                    e1, e2, t1, t2, _, me = self._block(x.block_else, c)
+                else:
+                    e1, e2, t1, t2, me = {}, {}, 0, 0, 0
+                for s in set(g1) | set(e1):
+                    gmin[s] = gmin.get(s, 0) + min(g1.get(s, 0), e1.get(s, 0))
+                for s in set(g2) | set(e2):
+                    gmax[s] = gmax.get(s, 0) + max(g2.get(s, 0), e2.get(s, 0))
+                smin += min(s1, t1)
+                smax += max(s2, t2)
+                m = max(m, d + max(mm, me))
+                c.exact = False
+                d += dd
+            m = max(m, d)
+        return gmin, gmax, smin, smax, d, m
+
+    def report(self, descr):
+        """ Text report for the function and all the functions it calls """
+        self.func_cost(descr)
+        reachable = self.prog.call_graph.reachable(descr)
+        ret = [f'{"function":<24} {"instrs":>7} {"steps":>12} {"gates":>12} {"stack":>7} {"vars":>7} {"vars incl":>9}'
+               f'  gates by native']
+        for s in reversed(self.prog.call_graph.topological_order()):
+            if s not in reachable:
+                continue
+            c = self.costs[s]
+            steps = str(c.steps_max) if c.exact else f'{c.steps_min}..{c.steps_max}'
+            gates = str(c.gates) if c.exact else f'{sum(c.gates_min.values())}..{c.gates}'
+            by_native = ' '.join(f'{k.split(":")[0]}={v}' if c.gates_min.get(k, 0) == v
+                                 else f'{k.split(":")[0]}={c.gates_min.get(k, 0)}..{v}'
+                                 for k, v in sorted(c.gates_max.items()))
+            ret.append(f'{s:<24} {c.instrs:>7} {steps:>12} {gates:>12} {c.max_stack:>7} {c.vars_bits:>7} '
+                       f'{c.vars_bits_incl:>9}  {by_native}')
+        return '\n'.join(ret)
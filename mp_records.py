@@ -0,0 +1,149 @@
+import os
+import mmap
+import itertools
+from mp_interpretator import *
+from mp_pool import record_size
+
+
+# =====================================================================================================================
+# Fixed-width binary record files: a record holds the parameters of ProgFunc.fmt[0] (input) or fmt[1] (result) in
+# format order, every parameter as a big-endian number in whole bytes (a 12-bit parameter takes 2 bytes), with no
+# header or separators. Input files are memory-mapped and decoded through memoryview slices with int.from_bytes;
+# result files are created at their final size, memory-mapped and filled in place, so neither file is read into
+# memory as a whole.
+# =====================================================================================================================
+class RecordLayout:
+    def __init__(self, fmt):
+        self.widths = [n for n, _ in fmt]
+        self.sizes = [record_size(n) for n in self.widths]
+        self.bits = sum(self.widths)
+        self.size = sum(self.sizes)
+        # parameters of whole bytes: the record is the number itself
+        self.whole_bytes = all(n % 8 == 0 for n in self.widths)
+
+    def decode(self, rec):
+        """ Record (bytes or memoryview of self.size bytes) -> number of self.bits bits (the first parameter high) """
+        if self.whole_bytes:
+            return int.from_bytes(rec, 'big')
+        ret = 0
+        pos = 0
+        for n, sz in zip(self.widths, self.sizes):
+            v = int.from_bytes(rec[pos:pos + sz], 'big')
+            if v >> n:
+                raise IpRunError(f'record parameter {v} does not fit in {n} bits')
+            ret = (ret << n) | v
+            pos += sz
+        return ret
+
+    def encode(self, v):
+        """ Number of self.bits bits -> record bytes """
+        if self.whole_bytes:
+            return v.to_bytes(self.size, 'big')
+        ret = bytearray(self.size)
+        pos = self.size
+        for n, sz in zip(reversed(self.widths), reversed(self.sizes)):
+            ret[pos - sz:pos] = (v & ((1 << n) - 1)).to_bytes(sz, 'big')
+            v >>= n
+            pos -= sz
+        return bytes(ret)
+
+
+def input_layout(f: ProgFunc):
+    return RecordLayout(f.fmt[0])
+
+
+def output_layout(f: ProgFunc):
+    return RecordLayout(f.fmt[1])
+
+
+# =====================================================================================================================
+class RecordReader:
+    """ Memory-mapped record file: len(r), r[i] and iteration give the records as numbers """
+    def __init__(self, fname, layout: RecordLayout):
+        if layout.size == 0:
+            raise IpRunError('records of zero length can not be read from a file')
+        self.fname = fname
+        self.layout = layout
+        self._f = open(fname, 'rb')
+        size = os.fstat(self._f.fileno()).st_size
+        if size % layout.size:
+            self._f.close()
+            raise IpRunError(f'{fname}: file size {size} is not a multiple of the record size {layout.size}')
+        self._n = size // layout.size
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._mv = memoryview(self._mm) if size else memoryview(b'')
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._n:
+            raise IndexError(f'record {i} is out of range 0..{self._n - 1}')
+        sz = self.layout.size
+        return self.layout.decode(self._mv[i * sz:(i + 1) * sz])
+
+    def __iter__(self):
+        return self.read()
+
+    def read(self, start=0, count=None):
+        """ Numbers of the records from start (count - all to the end) """
+        sz = self.layout.size
+        decode = self.layout.decode
+        mv = self._mv
+        stop = self._n if count is None else min(self._n, start + count)
+        for pos in range(start * sz, stop * sz, sz):
+            yield decode(mv[pos:pos + sz])
+
+    def close(self):
+        self._mv.release()
+        if self._mm is not None:
+            self._mm.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_records(fname, layout: RecordLayout, values, chunk=4096):
+    """ Write numbers (an iterable, streamed in chunks) as records; returns the number of records """
+    ret = 0
+    it = iter(values)
+    with open(fname, 'wb') as f:
+        for vv in iter(lambda: list(itertools.islice(it, chunk)), []):
+            f.write(b''.join([layout.encode(v) for v in vv]))
+            ret += len(vv)
+    return ret
+
+
+# =====================================================================================================================
+def run_records(prog: Prog, func_name, in_fname, out_fname, workers=1, chunksize=256):
+    """
+        Run the function for every input record of in_fname and write the results to out_fname as records, in
+        input order; workers != 1 - in worker processes (Prog.run_many); returns the number of records
+    """
+    f = prog.runner.get_func(func_name)
+    out_layout = output_layout(f)
+    with RecordReader(in_fname, input_layout(f)) as rd:
+        n = len(rd)
+        with open(out_fname, 'w+b') as fout:
+            fout.truncate(n * out_layout.size)
+            if n == 0 or out_layout.size == 0:
+                return n
+            with mmap.mmap(fout.fileno(), 0) as mm:
+                if workers == 1:
+                    results = (prog.run(func_name, { 'param': x, 'print_result': False }) for x in rd)
+                else:
+                    results = prog.run_many(func_name, rd.read(), workers, chunksize)
+                mv = memoryview(mm)
+                try:
+                    sz = out_layout.size
+                    encode = out_layout.encode
+                    for pos, y in zip(range(0, n * sz, sz), results):
+                        mv[pos:pos + sz] = encode(y)
+                finally:
+                    mv.release()
+                    results.close()
+    return n
@@ -1,15 +1,47 @@
 #! /usr/bin/python3
 
 import sys
+import time
+import pickle
+import itertools
+import multiprocessing
+from collections import deque
 from mp_compiler import *
 from mp_interpretator import *
+from mp_vm import vm_runners
+from mp_aig import aig_runners
+from mp_cnf import cnf_runners
+from mp_profile import Profile
+from mp_records import run_records
+from mp_intrinsics import enable_intrinsics, report as intrinsics_report
 
 
 # =====================================================================================================================
 def _print_usage():
     print('usage:')
-    print('mp_run.py <file_name> <func_name> [<func_params>]')
+    print('mp_run.py [<options>] <file_name> <func_name> [<func_params>]')
     print('Binary (0b), hexadecimal (0x) and decimal non-negative numbers are allowed')
+    print('options:')
+    print('  --cache             use the compiled program file (.mpc) next to the main file if sources are unchanged')
+    print('  --cache-dir=<dir>   the same, with compiled program files in the specified directory')
+    print('  --watch             keep the program compiled, recompile changed files and run again on every change')
+    print('  --batch[=<file>]    read parameter vectors line by line from the file (default: stdin),')
+    print('                      print results line by line in input order')
+    print('  --workers=<n>       batch mode: number of worker processes (default: 1)')
+    print('  --chunk=<n>         batch mode: number of lines per worker task (default: 1000)')
+    print('  --records=<file>    read inputs from a binary record file (parameters of the function format as')
+    print('                      big-endian numbers in whole bytes), write results to the --records-out file')
+    print('  --records-out=<file> binary record file of results (default: <records file>.out)')
+    print('  --optimize          apply the peephole optimizer after compilation and print instruction counts')
+    print('  --vm                run functions on the bytecode VM instead of the interpreter')
+    print('  --aig=<file>        write the and-inverter graph of the function (binary AIGER for *.aig, ASCII otherwise)')
+    print('  --cnf=<file>        write the Tseitin encoding of the function in DIMACS CNF')
+    print('  --intrinsics        run verified word-level Python implementations of library functions')
+    print('                      (sum, xor, and, not, rotrN, shrN, ...) instead of their code')
+    print('  --cost              print the static cost (gates, executed instructions, stack depth, variable bits)')
+    print('                      of the function and the functions it calls without running it')
+    print('  --profile[=<file>]  print call counts, times, gate and loop counters per function;')
+    print('                      with a file name, also write them (JSON for *.json, pstats otherwise)')
     print(f'\ngot: {sys.argv}')
 
 
@@ -30,20 +62,177 @@ def _str_to_int(s):
             return int(s, 10)
 
 
+# =====================================================================================================================
+# command line options: '--cache-dir=dir' -> {'cache-dir': 'dir'}, '--cache' -> {'cache': ''}
+def _get_opts(ss):
+    ret = {}
+    for s in ss:
+        k, _, v = s[2:].partition('=')
+        ret[k] = v
+    return ret
+
+
+# =====================================================================================================================
+# recompile changed files and run the function again on every change; stopped by Ctrl+C
+def _watch(c: Compiler, func_name, param, optimize):
+    fnames = list(dict.fromkeys([c.mp_file_name] + c.fnames))
+    stamps = c.file_stamps(fnames)
+    print('\nwatching for changes (Ctrl+C to stop)')
+    try:
+        while True:
+            time.sleep(0.5)
+            if c.file_stamps(fnames) == stamps:
+                continue
+            print('')
+            try:
+                c.recompile(optimize=optimize).run(func_name, { 'param': param })
+                print(f'recompiled: {len(c.compiled_funcs)} functions ({", ".join(c.changed_fnames)})')
+            except (CompilerError, IpRunError, OSError) as e:
+                print(e)
+            fnames = list(dict.fromkeys(fnames + c.fnames))
+            stamps = c.file_stamps(fnames)
+    except KeyboardInterrupt:
+        print('')
+
+
+# =====================================================================================================================
+# batch mode: lines of parameter vectors -> lines of results (or error messages)
+def _run_lines(prog: Prog, f: ProgFunc, lines):
+    ret = []
+    for s in lines:
+        ss = s.split()
+        if not ss:
+            continue
+        try:
+            v = prog.run(f.descr, { 'param': [_str_to_int(x) for x in ss], 'print_result': False })
+            ret.append(IpRunProg.param_to_str(IpRunProg.bits_int_to_list(v, f.len_out), f.fmt[1], ' '))
+        except (CompilerError, IpRunError, ValueError) as e:
+            ret.append(f'error: {e}')
+    return ret
+
+
+_worker = None  # (prog, func) in a worker process
+
+
+def _worker_init(prog_data, func_name):
+    global _worker
+    prog: Prog = pickle.loads(prog_data)
+    prog.set_runners(prog.runners)
+    _worker = (prog, prog.runner.get_func(func_name))
+
+
+def _worker_run(lines):
+    return _run_lines(*_worker, lines)
+
+
+def _batch(prog: Prog, func_name, fin, workers, chunk):
+    """ Results are written in input order; at most 2 * workers chunks are in progress, so memory stays flat """
+    f = prog.runner.get_func(func_name)
+    chunks = iter(lambda: list(itertools.islice(fin, chunk)), [])
+    out = sys.stdout
+    if workers <= 1:
+        for lines in chunks:
+            out.writelines(s + '\n' for s in _run_lines(prog, f, lines))
+        return
+
+    with multiprocessing.Pool(workers, _worker_init, (pickle.dumps(prog), func_name)) as pool:
+        pending = deque()
+        for lines in chunks:
+            pending.append(pool.apply_async(_worker_run, (lines,)))
+            if len(pending) >= 2 * workers:
+                out.writelines(s + '\n' for s in pending.popleft().get())
+        while pending:
+            out.writelines(s + '\n' for s in pending.popleft().get())
+
+
 # =====================================================================================================================
 def _go():
-    if len(sys.argv) < 3:
+    opts = _get_opts([s for s in sys.argv[1:] if s.startswith('--')])
+    args = [s for s in sys.argv[1:] if not s.startswith('--')]
+    if len(args) < 2 or not set(opts) <= {'cache', 'cache-dir', 'watch', 'batch', 'workers', 'chunk', 'optimize', 'vm',
+                                          'aig', 'cnf', 'profile', 'cost', 'intrinsics', 'records',
+                                          'records-out'} \
+            or ('batch' in opts and (len(args) > 2 or 'watch' in opts)) \
+            or ('records' in opts and (not opts['records'] or len(args) > 2 or 'watch' in opts or 'batch' in opts)):
         _print_usage()
         return
 
-    mp_file_name = sys.argv[1]
-    func_name = sys.argv[2]
-    param = [_str_to_int(v) for v in sys.argv[3:]]
+    mp_file_name = args[0]
+    func_name = args[1]
+    param = [_str_to_int(v) for v in args[2:]]
+    cache_dir = opts.get('cache-dir') or None
+    optimize = 'optimize' in opts
+    c = Compiler(mp_file_name, vm_runners() if 'vm' in opts else ip_runners())
+    if opts.get('aig'):
+        prog = c.compile(cache='cache' in opts or cache_dir is not None, cache_dir=cache_dir, optimize=optimize,
+                         entry=func_name)
+        prog.set_runners(aig_runners())
+        g = prog.runner.build(func_name)
+        g.save(opts['aig'], f'{func_name} ({mp_file_name})')
+        print(f'{func_name}: {len(g.inputs)} inputs, {len(g.outputs)} outputs, {g.num_ands} and nodes -> {opts["aig"]}')
+        return
+    if opts.get('cnf'):
+        prog = c.compile(cache='cache' in opts or cache_dir is not None, cache_dir=cache_dir, optimize=optimize,
+                         entry=func_name)
+        prog.set_runners(cnf_runners())
+        g = prog.runner.write_cnf(func_name, opts['cnf'])
+        print(f'{func_name}: {g.num_vars} variables, {g.num_clauses} clauses -> {opts["cnf"]}')
+        return
+    if 'cost' in opts:
+        prog = c.compile(cache='cache' in opts or cache_dir is not None, cache_dir=cache_dir, optimize=optimize,
+                         entry=func_name)
+        print(CostModel(prog).report(func_name))
+        return
+    if 'records' in opts:
+        prog = c.compile(print_warnings=False, cache='cache' in opts or cache_dir is not None, cache_dir=cache_dir,
+                         optimize=optimize, entry=func_name)
+        if 'intrinsics' in opts:
+            print(intrinsics_report(enable_intrinsics(prog)))
+        out_fname = opts.get('records-out') or opts['records'] + '.out'
+        t = time.perf_counter()
+        n = run_records(prog, func_name, opts['records'], out_fname, int(opts.get('workers') or 1),
+                        int(opts.get('chunk') or 1000))
+        print(f'{func_name}: {n} records -> {out_fname} ({time.perf_counter() - t:.3f} s)')
+        return
+    if 'batch' in opts:
+        prog = c.compile(print_warnings=False, cache='cache' in opts or cache_dir is not None, cache_dir=cache_dir,
+                         optimize=optimize, entry=func_name)
+        if 'intrinsics' in opts:
+            sys.stderr.write(intrinsics_report(enable_intrinsics(prog)) + '\n')
+        workers = int(opts.get('workers') or 1)
+        chunk = int(opts.get('chunk') or 1000)
+        if opts['batch'] in ('', '-'):
+            _batch(prog, func_name, sys.stdin, workers, chunk)
+        else:
+            with open(opts['batch']) as fin:
+                _batch(prog, func_name, fin, workers, chunk)
+        return
     # print('')
     # for p in sys.argv[1:]:
     #     print(p)
     print('')
-    Compiler(mp_file_name, ip_runners()).compile().run(func_name, { 'param': param })
+    if 'watch' in opts:
+        try:
+            c.compile(optimize=optimize).run(func_name, { 'param': param })
+        except (CompilerError, IpRunError, OSError) as e:
+            print(e)
+        _watch(c, func_name, param, optimize)
+        return
+    prog = c.compile(cache='cache' in opts or cache_dir is not None, cache_dir=cache_dir, optimize=optimize,
+                     entry=func_name)
+    if c.optimizer is not None:
+        print(c.optimizer.report())
+    if 'intrinsics' in opts:
+        print(intrinsics_report(enable_intrinsics(prog)))
+    if 'profile' in opts:
+        profile = Profile(ip_runners() if 'vm' in opts else None)
+        prog.run(func_name, { 'param': param, 'profile': profile })
+        print('')
+        print(profile.report())
+        if opts['profile']:
+            profile.dump(opts['profile'])
+        return
+    prog.run(func_name, { 'param': param })
 
 
 # =====================================================================================================================
@@ -0,0 +1,408 @@
+#! /usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import pickle
+import signal
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from mp_compiler import *
+from mp_interpretator import *
+from mp_packed import pk_runners
+from mp_codegen import cg_runners
+from mp_vm import vm_runners
+from mp_bitslice import bs_runners, BsRunProg
+
+
+# =====================================================================================================================
+# Evaluation server: the program is compiled once; clients send line-delimited JSON requests over a Unix socket or
+# TCP and get one JSON line per request (in completion order, matched by id):
+#   {"id": 1, "func": "sum:16:8", "param": [15, 7]}      -> {"id": 1, "result": 22}
+#   {"id": 2, "func": "sha:32:256", "param": "0x61626364", "hex": true} -> {"id": 2, "result": "0x88d4..."}
+#   {"id": 3, "op": "metrics"}                             -> {"id": 3, "metrics": {...}}
+# Concurrent requests for the same function are collected for a short window (or up to max_batch) and evaluated as
+# one batch in a worker pool, off the event loop; with bitslice runners a batch is a single bitsliced run.
+# =====================================================================================================================
+_RUNNERS = {
+    'ip': ip_runners,
+    'pk': pk_runners,
+    'vm': vm_runners,
+    'cg': cg_runners,
+    'bs': bs_runners
+}
+
+
+def _eval(prog: Prog, func_name, xx):
+    """ Results of a batch of inputs (numbers): [(True, result) or (False, error message)] """
+    if isinstance(prog.runner, BsRunProg):
+        return [(True, v) for v in prog.run_batch(func_name, xx)]
+    ret = []
+    for x in xx:
+        try:
+            ret.append((True, prog.run(func_name, { 'param': x, 'print_result': False })))
+        except Exception as e:
+            ret.append((False, f'{e.__class__.__name__}: {e}'))
+    return ret
+
+
+_worker_prog = None  # program in a worker process
+
+
+def _worker_init(prog_data):
+    global _worker_prog
+    _worker_prog = pickle.loads(prog_data)
+    _worker_prog.set_runners(_worker_prog.runners)
+
+
+def _worker_eval(func_name, xx):
+    return _eval(_worker_prog, func_name, xx)
+
+
+def _param_value(v):
+    """ Parameter of a request: number, or string with a decimal, 0x or 0b number """
+    if type(v) is int:
+        return v
+    if type(v) is str:
+        return int(v, 0) if v[:2] in ('0x', '0b') else int(v, 10)
+    raise IpRunError(f'valid parameter types: number, string; obtained: {type(v).__name__}')
+
+
+# =====================================================================================================================
+class ServerMetrics:
+    def __init__(self, window=1024):
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_max = 0
+        self.batched = 0  # inputs in all batches
+        self.latencies = deque(maxlen=window)  # seconds from the request to its result, latest requests
+        self.funcs: Dict[str, list] = {}  # function -> [requests, batches]
+
+    def to_dict(self, queued, running):
+        ll = sorted(self.latencies)
+
+        def ms(q):
+            return round(ll[min(len(ll) - 1, int(q * len(ll)))] * 1000, 3) if ll else None
+
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'queue_depth': queued,
+            'running': running,
+            'batches': self.batches,
+            'batch_size': {
+                'mean': round(self.batched / self.batches, 2) if self.batches else None,
+                'max': self.batch_max
+            },
+            'latency_ms': {
+                'mean': round(sum(ll) / len(ll) * 1000, 3) if ll else None,
+                'p50': ms(0.5),
+                'p99': ms(0.99),
+                'max': ms(1.0)
+            },
+            'funcs': {descr: {'requests': v[0], 'batches': v[1]} for descr, v in self.funcs.items()}
+        }
+
+
+class _FuncQueue:
+    def __init__(self, f: ProgFunc):
+        self.f = f
+        self.items = []  # (input number, future, request time)
+        self.timer = None
+
+
+# =====================================================================================================================
+class EvalServer:
+    """
+        workers: number of worker processes (0 - one thread of this process, the program is not copied)
+        window: seconds to collect requests for a batch after the first one; max_batch: batch size limit
+    """
+    def __init__(self, prog: Prog, workers=1, window=0.002, max_batch=256):
+        self.prog = prog
+        self.workers = workers
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.metrics = ServerMetrics()
+        self._queues: Dict[str, _FuncQueue] = {}
+        self._queued = 0
+        self._running = 0
+        self._executor = None
+        self._server = None
+        self._conns = {}  # connection handler task -> its writer
+
+    def _start_executor(self):
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(self.workers, initializer=_worker_init,
+                                                 initargs=(pickle.dumps(self.prog),))
+        else:
+            self._executor = ThreadPoolExecutor(1)
+
+    def get_metrics(self):
+        return self.metrics.to_dict(self._queued, self._running)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def submit(self, func_name, param):
+        """ Future of the result of one evaluation: (True, result) or (False, error message) """
+        q = self._queues.get(func_name)
+        if q is None:
+            self.prog.require(func_name)
+            q = self._queues[func_name] = _FuncQueue(self.prog.runner.get_func(func_name))
+        x = self.prog.runner.param_int(q.f, param)
+        self.metrics.funcs.setdefault(func_name, [0, 0])[0] += 1
+        fut = asyncio.get_running_loop().create_future()
+        q.items.append((x, fut, time.perf_counter()))
+        self._queued += 1
+        if len(q.items) >= self.max_batch:
+            self._flush(q)
+        elif q.timer is None:
+            q.timer = asyncio.get_running_loop().call_later(self.window, self._flush, q)
+        return fut
+
+    def _flush(self, q: _FuncQueue):
+        if q.timer is not None:
+            q.timer.cancel()
+            q.timer = None
+        items = q.items
+        q.items = []
+        if items:
+            asyncio.get_running_loop().create_task(self._run_batch(q.f.descr, items))
+
+    async def _run_batch(self, func_name, items):
+        n = len(items)
+        self._queued -= n
+        self._running += n
+        m = self.metrics
+        m.batches += 1
+        m.batched += n
+        m.batch_max = max(m.batch_max, n)
+        m.funcs.setdefault(func_name, [0, 0])[1] += 1
+        xx = [x for x, _, _ in items]
+        try:
+            if self.workers > 0:
+                ret = await asyncio.get_running_loop().run_in_executor(self._executor, _worker_eval, func_name, xx)
+            else:
+                ret = await asyncio.get_running_loop().run_in_executor(self._executor, _eval, self.prog, func_name,
+                                                                       xx)
+        except Exception as e:
+            ret = [(False, f'{e.__class__.__name__}: {e}')] * n
+        finally:
+            self._running -= n
+        t = time.perf_counter()
+        for (_, fut, t0), r in zip(items, ret):
+            m.latencies.append(t - t0)
+            if not fut.done():
+                fut.set_result(r)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    async def _answer(self, line, writer: asyncio.StreamWriter):
+        req_id = None
+        try:
+            req = json.loads(line)
+            if type(req) is not dict:
+                raise IpRunError('a request must be a JSON object')
+            req_id = req.get('id')
+            if req.get('op') == 'metrics':
+                ret = {'id': req_id, 'metrics': self.get_metrics()}
+            else:
+                func_name = req.get('func')
+                if type(func_name) is not str:
+                    raise IpRunError('"func" is required (example: "sum:16:8")')
+                self.metrics.requests += 1
+                param = req.get('param')
+                param = [_param_value(v) for v in param] if type(param) is list else _param_value(param)
+                ok, v = await self.submit(func_name, param)
+                if not ok:
+                    raise IpRunError(v)
+                ret = {'id': req_id, 'result': hex(v) if req.get('hex') else v}
+        except (ValueError, CompilerError, IpRunError) as e:
+            self.metrics.errors += 1
+            ret = {'id': req_id, 'error': str(e)}
+        writer.write(json.dumps(ret).encode() + b'\n')
+        await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks = set()
+        self._conns[asyncio.current_task()] = writer
+        try:
+            while line := await reader.readline():
+                if not line.strip():
+                    continue
+                t = asyncio.create_task(self._answer(line, writer))
+                tasks.add(t)
+                t.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self._conns.pop(asyncio.current_task(), None)
+            writer.close()
+
+    async def start(self, path=None, host='127.0.0.1', port=7800):
+        """ Listen on the Unix socket path, or on TCP host:port if path is None """
+        self._start_executor()
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self._server = await asyncio.start_unix_server(self._handle, path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in self._conns.values():
+                writer.close()  # connected clients: the handlers see the end of the stream
+            await asyncio.gather(*self._conns, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def serve(self, path=None, host='127.0.0.1', port=7800):
+        """ Serve until SIGTERM or cancellation (Ctrl+C) """
+        await self.start(path, host, port)
+        stop = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # no signal handlers on this platform
+        try:
+            await stop.wait()
+        finally:
+            await self.close()
+            if path is not None and os.path.exists(path):
+                os.unlink(path)
+
+
+# =====================================================================================================================
+class EvalClient:
+    """ Client of EvalServer; requests of one connection may be in progress concurrently """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._next_id = 0
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._task = asyncio.get_running_loop().create_task(self._read())
+
+    @classmethod
+    async def connect(cls, path=None, host='127.0.0.1', port=7800):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _read(self):
+        try:
+            while line := await self._reader.readline():
+                ret = json.loads(line)
+                fut = self._pending.pop(ret.get('id'), None)
+                if fut is not None and not fut.done():
+                    fut.set_result(ret)
+        finally:
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError('connection closed'))
+            self._pending.clear()
+
+    async def request(self, req):
+        """ Response (dict) to the request (dict without id) """
+        self._next_id += 1
+        req = dict(req, id=self._next_id)
+        fut = self._pending[self._next_id] = asyncio.get_running_loop().create_future()
+        self._writer.write(json.dumps(req).encode() + b'\n')
+        await self._writer.drain()
+        return await fut
+
+    async def run(self, func_name, param):
+        """ Result (number) of the function for the parameter (as in Prog.run) """
+        ret = await self.request({'func': func_name, 'param': param})
+        if 'error' in ret:
+            raise IpRunError(ret['error'])
+        return ret['result']
+
+    async def metrics(self):
+        return (await self.request({'op': 'metrics'}))['metrics']
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        await self._task
+
+
+# =====================================================================================================================
+def _print_usage():
+    print('usage:')
+    print('mp_server.py [<options>] <file_name>                              - run the server')
+    print('mp_server.py --client [<options>] <func_name> [<func_params>]     - evaluate with the server')
+    print('options:')
+    print('  --unix=<path>       Unix socket (default: TCP)')
+    print('  --tcp=<host:port>   TCP address (default: 127.0.0.1:7800)')
+    print('server options:')
+    print('  --runners=<name>    ip, pk, vm, cg or bs (bitsliced batches; default: pk)')
+    print('  --workers=<n>       worker processes (0 - a thread of the server process; default: 1)')
+    print('  --window-ms=<ms>    time to collect requests of one function into a batch (default: 2)')
+    print('  --max-batch=<n>     maximum batch size (default: 256)')
+    print('  --optimize          apply the peephole optimizer after compilation')
+    print('client options:')
+    print('  --count=<n>         send the request n times concurrently, then print the server metrics')
+    print(f'\ngot: {sys.argv}')
+
+
+def _address(opts):
+    host, _, port = (opts.get('tcp') or '127.0.0.1:7800').rpartition(':')
+    return opts.get('unix') or None, host or '127.0.0.1', int(port)
+
+
+async def _client(opts, func_name, param):
+    c = await EvalClient.connect(*_address(opts))
+    try:
+        n = int(opts.get('count') or 1)
+        t = time.perf_counter()
+        ret = await asyncio.gather(*[c.run(func_name, param) for _ in range(n)])
+        t = time.perf_counter() - t
+        print(f'{func_name} ( {", ".join(map(str, param))} ) -> {hex(ret[0])}')
+        if n > 1:
+            print(f'{n} requests: {t:.3f} s, {n / t:.1f} requests/s')
+            print(json.dumps(await c.metrics(), indent=1))
+    finally:
+        await c.close()
+
+
+def _go():
+    opts = {}
+    for s in sys.argv[1:]:
+        if s.startswith('--'):
+            k, _, v = s[2:].partition('=')
+            opts[k] = v
+    args = [s for s in sys.argv[1:] if not s.startswith('--')]
+    client_opts = {'client', 'unix', 'tcp', 'count'}
+    server_opts = {'unix', 'tcp', 'runners', 'workers', 'window-ms', 'max-batch', 'optimize'}
+    if not args or not set(opts) <= (client_opts if 'client' in opts else server_opts) \
+            or ('client' not in opts and len(args) != 1) or opts.get('runners', 'pk') not in _RUNNERS:
+        _print_usage()
+        return
+
+    if 'client' in opts:
+        asyncio.run(_client(opts, args[0], [int(v, 0) if v[:2] in ('0x', '0b') else int(v) for v in args[1:]]))
+        return
+
+    prog = Compiler(args[0], _RUNNERS[opts.get('runners') or 'pk']()).compile(optimize='optimize' in opts)
+    server = EvalServer(prog, int(opts.get('workers') or 1), float(opts.get('window-ms') or 2) / 1000,
+                        int(opts.get('max-batch') or 256))
+    path, host, port = _address(opts)
+    print(f'{args[0]}: {len(prog.funcs)} functions; listening on {path or f"{host}:{port}"} (Ctrl+C to stop)')
+    try:
+        asyncio.run(server.serve(path, host, port))
+    except KeyboardInterrupt:
+        print('')
+
+
+if __name__ == '__main__':
+    _go()
@@ -0,0 +1,533 @@
+import os
+import sys
+import itertools
+import random
+import subprocess
+import asyncio
+import pytest
+from mp_compiler import *
+from mp_interpretator import *
+from mp_packed import pk_runners
+from mp_codegen import cg_runners
+from mp_vm import vm_runners
+from mp_bitslice import bs_runners
+from mp_aig import aig_runners
+from mp_cnf import cnf_runners
+from mp_natives import GATES, Gate
+from mp_intrinsics import INTRINSICS, Intrinsic, enable_intrinsics, standard_intrinsic
+from mp_records import RecordLayout, RecordReader, input_layout, output_layout, run_records, write_records
+from mp_server import EvalServer, EvalClient
+try:
+    from mp_numpy import np_runners
+except ImportError:
+    np_runners = None
+
+
+# =====================================================================================================================
+# Differential tests: every runner set must give the results of the interpreter (ip_runners). Edge cases are small
+# programs written to a temporary directory; all inputs of a function are run. The shipped programs are run with
+# sample inputs for every function (the library files are compiled through the programs that include them). The CNF
+# export is evaluated by unit propagation from the input values.
+#   python -m pytest -q mp_test.py
+# =====================================================================================================================
+_PROG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mp_prog')
+_PROGS = ['example_sum.mp', 'example_sha256.mp', 'libs_native.mp', 'libs_if.mp', 'libs_im.mp', 'sha256_native.mp',
+          'sha256_if.mp', 'sha256_im.mp']
+# a full SHA-256 takes seconds with every runner set: only sha:32:256 of sha256_native.mp is run (test_sha256),
+# without compile options
+_SLOW = ('add_msg:512:2048', 'sha_block:768:256', 'sha:1:256', 'sha:2:256', 'sha:16:256', 'sha:32:256',
+         'sha:64:256', 'sha256:32:256')
+
+_RUNNERS = {
+    'pk': pk_runners,
+    'cg': cg_runners,
+    'vm': vm_runners,
+    'bs': bs_runners,
+    'aig': aig_runners
+}
+if np_runners is not None:
+    _RUNNERS['np'] = np_runners
+# compile options of every runner set; tabulate - functions of up to 8 input bits become lookup tables
+_OPTIONS = [{}, { 'optimize': True }, { 'tabulate': 9 }]
+
+_NESTED_LOOPS = '''
+func not:1:1 native
+func f:1:1 #1b:1b {
+  loop 3 { loop 9 { >not:1:1> } }
+}
+'''
+
+_DROP_AFTER_IF = '''
+func g:5:3 #5b:3b {
+  def { x:2 }
+  >x:2>
+  loop 2 { if { >_:2 x:2> } }
+  >_:1 1:1>
+}
+'''
+
+_DROP_IN_UNROLLED = '''
+func f:2:3 #2b:3b {
+  def { y:2 }
+  >y:2 y:2>
+  loop 2 { >_:1 0:1> }
+  1:1>
+}
+'''
+
+_PARITY = '''
+func not:1:1 native
+func par:4:1 #4b:1b {
+  def { acc:1 }
+  loop 4 { if { acc:1> >not:1:1> >acc:1 } }
+  acc:1>
+}
+'''
+
+_CALL_IN_IF = '''
+func not:1:1 native
+func and:2:1 native
+func par:4:1 #4b:1b {
+  def { acc:1 }
+  loop 4 { if { acc:1> >not:1:1> >acc:1 } }
+  acc:1>
+}
+func h:9:5 #9b:5b {
+  loop 2 {
+    if { >par:4:1> 1:1> 0:1> } else { >and:2:1> }
+  }
+}
+'''
+
+
+def _run(prog, func_name, params):
+    return [prog.run(func_name, { 'param': p, 'print_result': False }) for p in params]
+
+
+def _bs_batch(prog, func_name, params):
+    return prog.runner.run_batch(func_name, params)
+
+
+def _np_batch(prog, func_name, params):
+    """ Inputs and results as bytes, so any parameter format fits """
+    size = (prog.funcs[func_name].len_in + 7) // 8
+    out = prog.runner.run_batch(func_name, [list(p.to_bytes(size, 'big')) for p in params],
+                                { 'input_bytes': True, 'output_bytes': True })
+    return [int.from_bytes(bytes(v), 'big') for v in out]
+
+
+_BATCH = {
+    # runners with run_batch: all inputs in one batch, so the lanes of an if diverge
+    'bs': _bs_batch,
+    'np': _np_batch
+}
+
+
+def _cnf_lit(s):
+    """ Variable map entry -> (variable, value if the variable is true); T, F - (0, True), (0, False) """
+    return (0, s == 'T') if s in ('T', 'F') else (abs(int(s)), not s.startswith('-'))
+
+
+def _cnf_results(prog, func_name, params, cnf_fname):
+    """ Results of the Tseitin encoding: the clauses of a gate follow the clauses of its inputs """
+    prog.runner.write_cnf(func_name, cnf_fname)
+    inputs, outputs, clauses = [], [], []
+    with open(cnf_fname) as f:
+        for s in f:
+            w = s.split()
+            if w[0] == 'c' and w[1] in ('input', 'output'):
+                (inputs if w[1] == 'input' else outputs).append(_cnf_lit(w[3]))
+            elif w[0] not in ('c', 'p'):
+                clauses.append([int(x) for x in w[:-1]])
+    f = prog.funcs[func_name]
+    ret = []
+    for p in params:
+        val = { 0: True }
+        val.update((v, b == 1) for (v, _), b in zip(inputs, IpRunProg.param_bits(f, p)))
+        for c in clauses:
+            free = [x for x in c if abs(x) not in val]
+            if not any(val[abs(x)] == (x > 0) for x in c if abs(x) in val):
+                assert len(free) == 1, f'clause {c} is not satisfied by unit propagation'
+                val[abs(free[0])] = free[0] > 0
+        ret.append(IpRunProg.bits_list_to_int([int(val[v] == t) for v, t in outputs]))
+    return ret
+
+
+def _check(tmp_path, fname, cases, options=None):
+    """ cases: (function name, input numbers); every runner set and option compiles the program once """
+    prog = Compiler(fname, ip_runners()).compile(print_warnings=False)
+    expected = [_run(prog, func_name, params) for func_name, params in cases]
+    for name, runners in [('ip', ip_runners)] + list(_RUNNERS.items()):
+        for opts in options if options is not None else _OPTIONS:
+            if name == 'ip' and not opts:
+                continue
+            prog = Compiler(fname, runners()).compile(print_warnings=False, **opts)
+            for (func_name, params), ee in zip(cases, expected):
+                assert _run(prog, func_name, params) == ee, f'{func_name}: {name} {opts}'
+                if name in _BATCH:
+                    assert _BATCH[name](prog, func_name, params) == ee, f'{func_name}: {name} batch {opts}'
+    prog = Compiler(fname, cnf_runners()).compile(print_warnings=False)
+    for (func_name, params), ee in zip(cases, expected):
+        assert _cnf_results(prog, func_name, params, os.path.join(tmp_path, 'test.cnf')) == ee, f'{func_name}: cnf'
+
+
+def _check_src(tmp_path, src, func_name):
+    """ All inputs of a function of a small program """
+    fname = os.path.join(tmp_path, 'test.mp')
+    with open(fname, 'w') as f:
+        f.write(src)
+    _check(tmp_path, fname, [(func_name, range(1 << int(func_name.split(':')[1])))])
+
+
+def _params(f: ProgFunc):
+    """ All inputs of up to 8 bits, otherwise zero, all ones and random inputs """
+    if f.len_in <= 8:
+        return range(1 << f.len_in)
+    rnd = random.Random(f.descr)
+    return [0, (1 << f.len_in) - 1] + [rnd.getrandbits(f.len_in) for _ in range(4)]
+
+
+# =====================================================================================================================
+def test_nested_loops(tmp_path):
+    """ A loop that is not unrolled inside an unrolled loop """
+    _check_src(tmp_path, _NESTED_LOOPS, 'f:1:1')
+
+
+def test_drop_after_unrolled_if(tmp_path):
+    """ A drop after an unrolled loop must not be merged into a push that a jump skips """
+    _check_src(tmp_path, _DROP_AFTER_IF, 'g:5:3')
+
+
+def test_drop_in_unrolled_loop(tmp_path):
+    """ A drop at the start of an unrolled loop body must not be merged into a push before the loop """
+    _check_src(tmp_path, _DROP_IN_UNROLLED, 'f:2:3')
+
+
+def test_if_in_loop(tmp_path):
+    """ An if in a loop whose body changes the stack depth """
+    _check_src(tmp_path, _PARITY, 'par:4:1')
+
+
+def test_call_in_if(tmp_path):
+    """ A call of a function with an if in a loop from the branches of an if in an unrolled loop """
+    _check_src(tmp_path, _CALL_IN_IF, 'h:9:5')
+
+
+@pytest.mark.parametrize('name', _PROGS)
+def test_prog(tmp_path, name):
+    fname = os.path.join(_PROG_DIR, name)
+    prog = Compiler(fname, ip_runners()).compile(print_warnings=False)
+    _check(tmp_path, fname, [(f.descr, _params(f)) for f in prog.funcs.values() if f.descr not in _SLOW])
+
+
+def test_sha256(tmp_path):
+    _check(tmp_path, os.path.join(_PROG_DIR, 'sha256_native.mp'), [('sha:32:256', [0x61626364])], [{}])
+
+
+# =====================================================================================================================
+# Intrinsics: the functions with an intrinsic must give the results of their code with every runner set, and an
+# intrinsic that does not match the code is not enabled
+def test_intrinsics():
+    fname = os.path.join(_PROG_DIR, 'libs_im.mp')
+    prog = Compiler(fname, ip_runners()).compile(print_warnings=False)
+    cases = [(f.descr, _params(f)) for f in prog.funcs.values()]
+    expected = [_run(prog, func_name, params) for func_name, params in cases]
+    for name, runners in [('ip', ip_runners)] + list(_RUNNERS.items()):
+        prog = Compiler(fname, runners()).compile(print_warnings=False)
+        status = enable_intrinsics(prog)
+        assert set(status.values()) == { 'ok' } and prog.funcs['sum:64:32'].intrinsic is not None, name
+        for (func_name, params), ee in zip(cases, expected):
+            assert _run(prog, func_name, params) == ee, f'{func_name}: {name}'
+
+
+def test_intrinsic_mismatch(monkeypatch):
+    # the sum without the carry mask has one bit more than the function result
+    monkeypatch.setitem(INTRINSICS, 'sum:16:8', Intrinsic('sum:16:8', '(s >> 8) + (s & 0xff)'))
+    prog = Compiler(os.path.join(_PROG_DIR, 'libs_im.mp'), ip_runners()).compile(print_warnings=False)
+    status = enable_intrinsics(prog)
+    assert status['sum:16:8'].startswith('mismatch') and status['sum:32:16'] == 'ok'
+    assert prog.funcs['sum:16:8'].intrinsic is None
+    assert _run(prog, 'sum:16:8', [0xffff]) == [0xfe]
+    # the standard intrinsics only fit the sizes of their meaning
+    assert standard_intrinsic('sum:16:9') is None and standard_intrinsic('rotr40:32:32') is None
+    assert standard_intrinsic('not:8:4') is None and standard_intrinsic('sum:16:8') is not None
+
+
+# =====================================================================================================================
+# Call memoization: the results of ip_memo_runners with small caches (evictions) and with caching switched off for
+# functions with a low hit rate must be those of the interpreter
+def test_call_memo():
+    fname = os.path.join(_PROG_DIR, 'libs_if.mp')
+    prog = Compiler(fname, ip_runners()).compile(print_warnings=False)
+    cases = [(f.descr, _params(f)) for f in prog.funcs.values()]
+    expected = [_run(prog, func_name, params) for func_name, params in cases]
+    prog = Compiler(fname, ip_memo_runners()).compile(print_warnings=False)
+    for memo in [CallMemo(max_size=2), CallMemo(max_size=2, min_hit_rate=0.9, warmup=8)]:
+        for (func_name, params), ee in zip(cases, expected):
+            # twice: the second run takes the results that are still in the caches
+            for _ in range(2):
+                res = [prog.run(func_name, { 'param': p, 'print_result': False, 'memo': memo }) for p in params]
+                assert res == ee, f'{func_name}: {memo.report()}'
+        assert all(len(c) <= 2 for c in memo.caches.values())
+        assert sum(st.evictions for st in memo.stats.values()) > 0
+        assert sum(st.hits for st in memo.stats.values()) > 0
+        if memo.min_hit_rate:
+            assert memo.disabled and all(not memo.caches[descr] for descr in memo.disabled)
+        else:
+            assert not memo.disabled
+
+
+# =====================================================================================================================
+# Compiled program files (.mpc): a cache hit does not read the program, a changed included file is compiled again
+_LIB = '''
+func not:1:1 native
+func f:2:2 #2b:2b { >not:1:1> }
+'''
+
+_MAIN = '''
+#include lib.mp
+func g:2:2 #2b:2b { >f:2:2> }
+'''
+
+
+def _write(tmp_path, fname, src):
+    ret = os.path.join(tmp_path, fname)
+    with open(ret, 'w') as f:
+        f.write(src)
+    return ret
+
+
+@pytest.mark.parametrize('cache_dir', [None, 'cache'])
+def test_cache(tmp_path, monkeypatch, cache_dir):
+    cache_dir = cache_dir and os.path.join(tmp_path, cache_dir)
+    _write(tmp_path, 'lib.mp', _LIB)
+    fname = _write(tmp_path, 'main.mp', _MAIN)
+    prog = Compiler(fname, ip_runners()).compile(print_warnings=False, cache=True, cache_dir=cache_dir)
+    assert _run(prog, 'g:2:2', range(4)) == [1, 0, 3, 2]
+    assert os.path.exists(Compiler(fname).cache_fname(cache_dir))
+
+    read_unit = Compiler._read_unit
+    monkeypatch.setattr(Compiler, '_read_unit', lambda *args: pytest.fail('the program is tokenized on a cache hit'))
+    c = Compiler(fname, ip_runners())
+    prog = c.compile(print_warnings=False, cache=True, cache_dir=cache_dir)
+    assert _run(prog, 'g:2:2', range(4)) == [1, 0, 3, 2]
+    assert not c.words and c.fnames == ['main.mp', 'lib.mp']
+
+    # the same modification time and size: only the contents tell that the file has changed
+    st = os.stat(os.path.join(tmp_path, 'lib.mp'))
+    _write(tmp_path, 'lib.mp', _LIB.replace('>not:1:1>', '>_:1 1:1>'))
+    os.utime(os.path.join(tmp_path, 'lib.mp'), ns=(st.st_atime_ns, st.st_mtime_ns))
+    monkeypatch.setattr(Compiler, '_read_unit', read_unit)
+    c = Compiler(fname, ip_runners())
+    prog = c.compile(print_warnings=False, cache=True, cache_dir=cache_dir)
+    assert _run(prog, 'g:2:2', range(4)) == [1, 1, 3, 3]
+    assert c.changed_fnames == ['main.mp', 'lib.mp']
+
+
+# =====================================================================================================================
+# Incremental compilation: functions of changed files and the functions that call them are compiled again, the
+# others are reused (the same objects)
+_MAIN_H = _MAIN + '''
+func h:2:2 #2b:2b { >_:1 0:1> }
+'''
+
+
+def _recompile(tmp_path):
+    _write(tmp_path, 'lib.mp', _LIB)
+    c = Compiler(_write(tmp_path, 'main.mp', _MAIN_H), ip_runners())
+    prog = c.compile(print_warnings=False)
+    assert _run(prog, 'g:2:2', range(4)) == [1, 0, 3, 2]
+    return c, prog.funcs['h:2:2']
+
+
+def test_recompile_callers(tmp_path):
+    c, h = _recompile(tmp_path)
+    _write(tmp_path, 'lib.mp', _LIB.replace('>not:1:1>', '>_:1 1:1>'))
+    prog = c.recompile(print_warnings=False)
+    assert c.changed_fnames == ['lib.mp'] and sorted(c.compiled_funcs) == ['f:2:2', 'g:2:2', 'not:1:1']
+    assert prog.funcs['h:2:2'] is h
+    assert _run(prog, 'g:2:2', range(4)) == [1, 1, 3, 3]
+    assert _run(prog, 'h:2:2', range(4)) == [0, 0, 2, 2]
+
+
+def test_recompile_shifted(tmp_path):
+    """ A function added to an earlier file moves the words of the later functions """
+    c, h = _recompile(tmp_path)
+    _write(tmp_path, 'lib.mp', _LIB + 'func e:2:2 #2b:2b { >_:2 3:2> }\n')
+    prog = c.recompile(print_warnings=False)
+    assert sorted(c.compiled_funcs) == ['e:2:2', 'f:2:2', 'g:2:2', 'not:1:1']
+    assert prog.funcs['h:2:2'] is h and h.w_first.idx == c.words.index(h.w_first)
+    assert _run(prog, 'e:2:2', range(4)) == [3, 3, 3, 3]
+    assert _run(prog, 'g:2:2', range(4)) == [1, 0, 3, 2]
+    assert _run(prog, 'h:2:2', range(4)) == [0, 0, 2, 2]
+
+
+def test_recompile_after_error(tmp_path):
+    c, h = _recompile(tmp_path)
+    _write(tmp_path, 'lib.mp', _LIB.replace('>not:1:1>', '>not:2:1>'))
+    with pytest.raises(CompilerError):
+        c.recompile(print_warnings=False)
+    _write(tmp_path, 'lib.mp', _LIB.replace('>not:1:1>', '>_:1 1:1>'))
+    prog = c.recompile(print_warnings=False)
+    assert sorted(c.compiled_funcs) == ['f:2:2', 'g:2:2', 'not:1:1'] and prog.funcs['h:2:2'] is h
+    assert _run(prog, 'g:2:2', range(4)) == [1, 1, 3, 3]
+    assert _run(prog, 'h:2:2', range(4)) == [0, 0, 2, 2]
+
+
+# =====================================================================================================================
+# Compilation for an entry point: other functions are compiled when they are run, into the program they belong to
+@pytest.mark.parametrize('cache', [False, True])
+def test_entry(tmp_path, cache):
+    _write(tmp_path, 'lib.mp', _LIB)
+    fname = _write(tmp_path, 'main.mp', _MAIN_H)
+    if cache:
+        Compiler(fname, ip_runners()).compile(print_warnings=False, cache=True, entry='g:2:2')
+    c = Compiler(fname, ip_runners())
+    prog = c.compile(print_warnings=False, cache=cache, entry='g:2:2')
+    assert sorted(prog.funcs) == ['f:2:2', 'g:2:2'] and sorted(prog.native_funcs) == ['not:1:1']
+    assert _run(prog, 'g:2:2', range(4)) == [1, 0, 3, 2]
+    if cache:
+        prog1 = Compiler(fname, ip_runners()).compile(print_warnings=False, cache=True, entry='g:2:2')
+        assert _run(prog1, 'h:2:2', range(4)) == [0, 0, 2, 2]
+
+    # the same compiler compiles the changed program: the first program still loads its own version of h
+    _write(tmp_path, 'main.mp', _MAIN_H.replace('0:1>', '1:1>'))
+    prog2 = c.compile(print_warnings=False, entry='g:2:2')
+    if cache:
+        # the program loaded from the compiled file has not read the source, which is not the same any more
+        with pytest.raises(CompilerError):
+            prog.run('h:2:2', { 'param': 0, 'print_result': False })
+    else:
+        assert _run(prog, 'h:2:2', range(4)) == [0, 0, 2, 2]
+    assert 'h:2:2' not in prog2.funcs
+    assert _run(prog2, 'h:2:2', range(4)) == [1, 1, 3, 3] and c.compiled_funcs == ['h:2:2']
+    assert prog.funcs.get('h:2:2') is not prog2.funcs['h:2:2']
+
+
+# =====================================================================================================================
+# Record files (mp_records.py): inputs written with the layout of ProgFunc.fmt are read back through mmap, and the
+# results of run_records are those of the function
+_RECORDS = '''
+func not:1:1 native
+func g:13:6 #12d+1b:4h+2b {
+  def { a:12 c:1 }
+  >c:1 >a:12
+  a:12> >_:8
+  c:1> >not:1:1> c:1>
+}
+'''
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_records(tmp_path, workers):
+    in_fname, out_fname = os.path.join(tmp_path, 'in.rec'), os.path.join(tmp_path, 'out.rec')
+    for fname, func_name in [(_write(tmp_path, 'test.mp', _RECORDS), 'g:13:6'),
+                             (os.path.join(_PROG_DIR, 'example_sum.mp'), 'sum:16:8')]:
+        prog = Compiler(fname, ip_runners()).compile(print_warnings=False)
+        f = prog.funcs[func_name]
+        params = list(range(0, 1 << f.len_in, 1 + (1 << f.len_in) // 1024))
+        assert write_records(in_fname, input_layout(f), params) == len(params)
+        assert os.path.getsize(in_fname) == len(params) * input_layout(f).size
+        with RecordReader(in_fname, input_layout(f)) as rd:
+            assert list(rd) == params and rd[3] == params[3]
+        assert run_records(prog, func_name, in_fname, out_fname, workers) == len(params)
+        with RecordReader(out_fname, output_layout(f)) as rd:
+            assert list(rd) == _run(prog, func_name, params)
+    # every parameter in whole bytes: 0x15, 0x79 (sum:16:8) -> 15 79; 0xabc, 1 (g:13:6) -> 0a bc 01
+    assert input_layout(f).encode(0x1579) == bytes([0x15, 0x79])
+    assert RecordLayout([(12, 'd'), (1, 'b')]).encode((0xabc << 1) | 1) == bytes([0x0a, 0xbc, 0x01])
+
+
+# =====================================================================================================================
+# Parallel execution: results in input order with several workers and small chunks, errors of a worker are raised
+# with the index of the input
+@pytest.mark.parametrize('workers', [1, 3])
+def test_run_many(workers):
+    prog = Compiler(os.path.join(_PROG_DIR, 'example_sum.mp'), ip_runners()).compile(print_warnings=False)
+    params = [random.Random(i).getrandbits(16) for i in range(2000)]
+    assert list(prog.run_many('sum:16:8', params, workers, chunksize=7)) == _run(prog, 'sum:16:8', params)
+    # an endless input: only 2 * workers chunks are in progress
+    assert list(itertools.islice(prog.run_many('sum:16:8', itertools.count(), workers, chunksize=5), 300)) == \
+        _run(prog, 'sum:16:8', range(300))
+
+    # the intrinsic (compiled again from its source in the workers) fails on one input
+    prog.funcs['sum:16:8'].intrinsic = Intrinsic('sum:16:8', '((s >> 8) + s) & 0xff if s != 1000 else 1 // 0')
+    with pytest.raises(IpRunError, match='sum:16:8: input 1000: ZeroDivisionError'):
+        list(prog.run_many('sum:16:8', range(2000), workers, chunksize=7))
+
+
+# =====================================================================================================================
+# Batch mode of mp_run.py: lines of results (or errors) in input order with several workers and small chunks
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_batch_lines(tmp_path, workers):
+    rnd = random.Random(0)
+    params = [(rnd.getrandbits(8), rnd.getrandbits(8)) for _ in range(50)]
+    lines = [f'{a} {b}' for a, b in params] + ['300 1', '', 'x 1', '0x10 0b11']
+    batch = _write(tmp_path, 'batch.txt', ''.join(s + '\n' for s in lines))
+    res = subprocess.run([sys.executable, os.path.join(os.path.dirname(_PROG_DIR), 'mp_run.py'), f'--batch={batch}',
+                          f'--workers={workers}', '--chunk=3', os.path.join(_PROG_DIR, 'example_sum.mp'), 'sum:16:8'],
+                         capture_output=True, text=True, check=True)
+    out = res.stdout.splitlines()
+    assert out[:50] == [str((a + b) & 0xff) for a, b in params]
+    assert out[50].startswith('error:') and out[51].startswith('error:') and out[52:] == ['19']
+
+
+# =====================================================================================================================
+# Registered gates: a native declaration of a gate registered by the program runs the same with every runner set
+# (and in the CNF export); a native declaration of an unknown gate is a compile error
+_GATES = '''
+func nand3:3:1 native
+func sel4:4:1 native
+func f:6:2 #6b:2b {
+  def { x:6 }
+  >x:6
+  x:6> >_:3 >nand3:3:1>
+  x:6> >_:2 >sel4:4:1>
+}
+'''
+
+
+def test_register_gate(tmp_path, monkeypatch):
+    monkeypatch.setitem(GATES, 'nand3:3:1', Gate('nand3:3:1', '~(a & b & c)'))
+    monkeypatch.setitem(GATES, 'sel4:4:1', Gate('sel4:4:1', '(a & b) | (~a & (c ^ d))'))
+    _check_src(tmp_path, _GATES, 'f:6:2')
+    prog = Compiler(os.path.join(tmp_path, 'test.mp'), ip_runners()).compile(print_warnings=False)
+    assert prog.native_funcs['sel4:4:1'].gate is GATES['sel4:4:1']
+    assert _run(prog, 'f:6:2', [0b111000, 0b000111, 0b101101]) == [0b01, 0b11, 0b10]
+
+
+def test_unknown_gate(tmp_path):
+    _write(tmp_path, 'test.mp', _GATES)
+    with pytest.raises(CompilerError, match='no such native function: nand3:3:1'):
+        Compiler(os.path.join(tmp_path, 'test.mp'), ip_runners()).compile(print_warnings=False)
+
+
+# =====================================================================================================================
+# Evaluation server: concurrent client requests are batched in a thread of the server process, results match the
+# interpreter, errors are answered per request
+@pytest.mark.parametrize('runners', ['pk', 'bs'])
+def test_server(tmp_path, runners):
+    fname = os.path.join(_PROG_DIR, 'example_sum.mp')
+    params = [random.Random(i).getrandbits(16) for i in range(100)]
+    expected = _run(Compiler(fname, ip_runners()).compile(print_warnings=False), 'sum:16:8', params)
+    path = os.path.join(tmp_path, 'server.sock')
+
+    async def session():
+        server = EvalServer(Compiler(fname, _RUNNERS[runners]()).compile(print_warnings=False), workers=0,
+                            window=0.01)
+        await server.start(path)
+        c = await EvalClient.connect(path)
+        try:
+            assert await asyncio.gather(*[c.run('sum:16:8', p) for p in params]) == expected
+            assert (await c.request({ 'func': 'sum:16:8', 'param': ['0x10', 3], 'hex': True }))['result'] == '0x13'
+            for req in [{ 'func': 'nope:1:1', 'param': 1 }, { 'func': 'sum:16:8', 'param': 1 << 16 },
+                        { 'param': 1 }]:
+                assert 'error' in await c.request(req), req
+            m = await c.metrics()
+            # a request without a function is not counted as a request, only as an error
+            assert m['requests'] == 103 and m['errors'] == 3 and m['batches'] < 100
+        finally:
+            await c.close()
+            await server.close()
+
+    asyncio.run(session())
@@ -0,0 +1,413 @@
+from mp_interpretator import *
+from mp_optimizer import Optimizer
+
+
+# =====================================================================================================================
+# Bytecode VM: the entry function is lowered to a flat list of integer opcodes (3 integers per instruction:
+# opcode and two arguments) executed by a single dispatch loop. Small functions are inlined, short loops are
+# unrolled, variables are resolved to offsets in the frame of the function (one flat list for all frames),
+# tabulated functions, intrinsics and native gates without their own opcode become lookups. The stack is a list
+# of zeros and ones, as in the interpreter.
+# =====================================================================================================================
+_PUSH_VAR = 0  # a - variable offset, b - size
+_STORE = 1  # a - variable offset, b - size: the top b bits -> variable, removed from the stack
+_COPY = 2  # a - variable offset, b - size: the top b bits -> variable
+_PUSH_CONST = 3  # a - constant index
+_DROP = 4  # b - number of bits
+_AND = 5
+_OR = 6
+_XOR = 7
+_NOT = 8
+_IM = 9
+_JZ = 10  # a - target: the top bit is removed from the stack, jump if it is 0
+_JMP = 11  # a - target
+_LOOP_INIT = 12  # a - counter offset, b - number of repetitions
+_LOOP_NEXT = 13  # a - counter offset, b - target of the next repetition
+_ZERO = 14  # a - variable offset, b - size
+_TABLE = 15  # a - lookup index: input bits (number) -> output bits (number)
+_CALL = 16  # a - target, b - frame size of the caller
+_ENTER = 17  # b - frame size: variables of the function are set to zeros
+_RET = 18
+_PUSH_BIT = 19  # a - offset of a 1-bit variable
+_STORE_BIT = 20  # a - offset of a 1-bit variable
+_PUSH_BIT_CONST = 21  # a - the bit
+
+_OP_NAMES = ['PUSH_VAR', 'STORE', 'COPY', 'PUSH_CONST', 'DROP', 'AND', 'OR', 'XOR', 'NOT', 'IM', 'JZ', 'JMP',
+             'LOOP_INIT', 'LOOP_NEXT', 'ZERO', 'TABLE', 'CALL', 'ENTER', 'RET', 'PUSH_BIT', 'STORE_BIT',
+             'PUSH_BIT_CONST']
+
+_NATIVE_OPS = {
+    'and:2:1': _AND,
+    'or:2:1': _OR,
+    'xor:2:1': _XOR,
+    'not:1:1': _NOT,
+    'im:2:1': _IM
+}
+
+
+# =====================================================================================================================
+class VmCode:
+    """ Lowered entry function """
+    def __init__(self, f: ProgFunc):
+        self.f = f
+        self.code: List[int] = []
+        self.consts = []  # lists of zeros and ones
+        self.tables = []  # (lookup function, len_in, len_out): tables and intrinsics
+        self.mem_size = 0  # size of all frames of the deepest call chain
+
+    def __str__(self):
+        ret = []
+        for pc in range(0, len(self.code), 3):
+            op, a, b = self.code[pc:pc + 3]
+            ret.append(f'{pc:6} {_OP_NAMES[op]:10} {a} {b}')
+        return '\n'.join(ret)
+
+
+# =====================================================================================================================
+class VmLowering:
+    def __init__(self, prog: Prog, inline_max=48, unroll_max=8, unroll_size=512):
+        self.prog = prog
+        self.inline_max = inline_max  # functions with fewer instructions (including nested blocks) are inlined
+        self.unroll_max = unroll_max  # loops with fewer repetitions are unrolled ...
+        self.unroll_size = unroll_size  # ... if the unrolled code has fewer opcodes than this
+        self._vc = None
+        self._consts = {}
+        self._tables = {}
+        self._starts = {}  # function descr -> start of its code
+        self._todo = []  # functions to lower
+        self._call_sites = []  # (position of CALL, called function descr)
+        self._frames = {}  # function descr -> (frame size, called functions)
+        self._frame_size = self._frame_max = 0
+        self._callees = set()
+        self._label = 0  # the last jump target: instructions before it cannot be merged with the next ones
+        self._live_in = {}  # function descr -> variables read before written
+
+    @staticmethod
+    def size(code) -> int:
+        """ Number of instructions, including nested blocks """
+        ret = 0
+        for x in code:
+            ret += 1
+            if isinstance(x, (ProgIf, ProgLoop)):
+                for b in x.children():
+                    ret += VmLowering.size(b.code)
+        return ret
+
+    def lower(self, f: ProgFunc) -> VmCode:
+        self._vc = VmCode(f)
+        self._consts.clear()
+        self._tables.clear()
+        self._starts.clear()
+        self._frames.clear()
+        self._live_in.clear()
+        self._call_sites.clear()
+        self._todo = [f]
+        while self._todo:
+            ff = self._todo.pop()
+            if ff.descr not in self._starts:
+                self._lower_func(ff)
+        for pc, descr in self._call_sites:
+            self._vc.code[pc + 1] = self._starts[descr]
+        self._vc.mem_size = self._mem_size(f.descr)
+        return self._vc
+
+    def _mem_size(self, descr):
+        frame, callees = self._frames[descr]
+        return frame + max([self._mem_size(s) for s in callees], default=0)
+
+    def _emit(self, op, a=0, b=0):
+        self._vc.code.extend((op, a, b))
+
+    def _emit_drop(self, n):
+        code = self._vc.code
+        pc = len(code) - 3
+        if pc >= self._label and code[pc] == _PUSH_VAR and code[pc + 2] > n:
+            code[pc + 2] -= n  # push of a variable without its last bits
+        else:
+            self._emit(_DROP, 0, n)
+
+    def _set_label(self):
+        self._label = len(self._vc.code)
+        return self._label
+
+    def _zeroed_vars(self, f: ProgFunc):
+        """ Variables whose initial zeros are read """
+        if f.descr not in self._live_in:
+            self._live_in[f.descr] = Optimizer(self.prog).live_in(f)
+        return self._live_in[f.descr]
+
+    def _alloc(self, n):
+        ret = self._frame_size
+        self._frame_size += n
+        self._frame_max = max(self._frame_max, self._frame_size)
+        return ret
+
+    def _lower_func(self, f: ProgFunc):
+        code = self._vc.code
+        self._starts[f.descr] = len(code)
+        self._frame_size = self._frame_max = 0
+        self._callees = set()
+        calls = []
+        if f.native and f.descr in _NATIVE_OPS:
+            self._emit(_NATIVE_OPS[f.descr])
+        elif f.native or f.intrinsic is not None or f.table is not None:
+            self._emit_table(f)
+        else:
+            self._emit(_ENTER)
+            enter = len(code) - 3
+            self._emit_body(f, calls)
+            code[enter + 2] = self._frame_max
+        self._emit(_RET)
+        for pc in calls:
+            code[pc + 2] = self._frame_max
+        self._frames[f.descr] = (self._frame_max, self._callees)
+
+    def _emit_table(self, f: ProgFunc):
+        if f.descr not in self._tables:
+            self._tables[f.descr] = len(self._vc.tables)
+            if f.native:
+                fn = f.gate.table.__getitem__
+            elif f.intrinsic is not None:
+                fn = f.intrinsic.fn
+            else:
+                fn = f.table.__getitem__
+            self._vc.tables.append((fn, f.len_in, f.len_out))
+        self._emit(_TABLE, self._tables[f.descr])
+
+    def _emit_body(self, f: ProgFunc, calls):
+        """ Variables of the function get offsets from the current frame size """
+        offs = {name: self._alloc(v.size) for name, v in f.vars.items()}
+        self._emit_block(f.block, offs, calls)
+
+    def _emit_block(self, b: ProgBlock, offs, calls):
+        code = self._vc.code
+        for x in b.code:
+            if isinstance(x, ProgAssign):
+                if x.is_num and x.nn == 1:
+                    self._emit(_PUSH_BIT_CONST, x.var)
+                elif x.is_num:
+                    s = (x.nn, x.var)
+                    if s not in self._consts:
+                        self._consts[s] = len(self._vc.consts)
+                        self._vc.consts.append(IpRunProg.bits_int_to_list(x.var, x.nn))
+                    self._emit(_PUSH_CONST, self._consts[s])
+                elif x.var_from_stack:
+                    op = _COPY if x.var_to_stack else _STORE_BIT if x.nn == 1 else _STORE
+                    self._emit(op, offs[x.var.name], x.nn)
+                elif x.var_to_stack:
+                    self._emit(_PUSH_BIT if x.nn == 1 else _PUSH_VAR, offs[x.var.name], x.nn)
+            elif isinstance(x, ProgReduce):
+                if x.nn:
+                    self._emit_drop(x.nn)
+            elif isinstance(x, ProgCall):
+                self._emit_call(x.f, calls)
+            elif isinstance(x, ProgIf):
+                self._emit(_JZ)
+                jz = len(code) - 3
+                self._emit_block(x.block, offs, calls)
+                if x.block_else is not None:
+                    self._emit(_JMP)
+                    jmp = len(code) - 3
+                    code[jz + 1] = self._set_label()
+                    self._emit_block(x.block_else, offs, calls)
+                    code[jmp + 1] = self._set_label()
+                else:
+                    code[jz + 1] = self._set_label()
+            elif isinstance(x, ProgLoop):
+                self._emit_loop(x, offs, calls)
+            else:
+                raise CompilerError(f'unexpected instruction: {x}')
+
+    def _emit_loop(self, x: ProgLoop, offs, calls):
+        code = self._vc.code
+        if x.nn == 0:
+            return
+        start = len(code)
+        frame_size = self._frame_size
+        if x.nn <= self.unroll_max:
+            self._set_label()  # every copy of the body starts here: its first drop is not merged with the code before
+            self._emit_block(x.block, offs, calls)
+            if (len(code) - start) // 3 * x.nn <= self.unroll_size:
+                body = code[start:]
+                for _ in range(x.nn - 1):
+                    # jump targets are absolute: shift them for every copy of the body
+                    shift = len(code) - start
+                    for pc in range(0, len(body), 3):
+                        op, a, b = body[pc:pc + 3]
+                        if op in (_JZ, _JMP):
+                            a += shift
+                            self._label = max(self._label, a)
+                        elif op == _LOOP_NEXT:
+                            b += shift
+                        code.extend((op, a, b))
+                        if op == _CALL:
+                            calls.append(len(code) - 3)
+                            self._call_sites.append((len(code) - 3, self._call_site(pc + start)))
+                return
+            del code[start:]
+            del calls[len([pc for pc in calls if pc < start]):]
+            del self._call_sites[len([s for s in self._call_sites if s[0] < start]):]
+            self._frame_size = frame_size
+        cnt = self._alloc(1)
+        self._emit(_LOOP_INIT, cnt, x.nn)
+        body = self._set_label()
+        self._emit_block(x.block, offs, calls)
+        self._emit(_LOOP_NEXT, cnt, body)
+        self._frame_size = frame_size
+
+    def _emit_call(self, f: ProgFunc, calls):
+        if f.native and f.descr in _NATIVE_OPS:
+            self._emit(_NATIVE_OPS[f.descr])
+        elif f.native or f.intrinsic is not None or f.table is not None:
+            self._emit_table(f)
+        elif self.size(f.block.code) < self.inline_max:
+            # the variables of an inlined function are released after it: the space is reused by the next ones
+            frame_size = self._frame_size
+            offs = {name: self._alloc(v.size) for name, v in f.vars.items()}
+            for name in self._zeroed_vars(f):
+                self._emit(_ZERO, offs[name], f.vars[name].size)
+            self._emit_block(f.block, offs, calls)
+            self._frame_size = frame_size
+        else:
+            self._emit(_CALL)
+            calls.append(len(self._vc.code) - 3)
+            self._call_sites.append((len(self._vc.code) - 3, f.descr))
+            self._callees.add(f.descr)
+            self._todo.append(f)
+
+    def _call_site(self, pc):
+        """ Function called by CALL at pc """
+        for s in reversed(self._call_sites):
+            if s[0] == pc:
+                return s[1]
+        raise CompilerError(f'unexpected error: no call at {pc}')
+
+
+# =====================================================================================================================
+def _execute(vc: VmCode, st):
+    """ Run the lowered code on the stack st (list of zeros and ones, changed in place) """
+    code = vc.code
+    consts = vc.consts
+    tables = vc.tables
+    mem = [0] * vc.mem_size
+    fp = 0
+    calls = []
+    pc = 0
+    while True:
+        op = code[pc]
+        if op == _PUSH_BIT:
+            st.append(mem[fp + code[pc + 1]])
+        elif op == _STORE_BIT:
+            mem[fp + code[pc + 1]] = st.pop()
+        elif op == _PUSH_VAR:
+            a = fp + code[pc + 1]
+            st.extend(mem[a:a + code[pc + 2]])
+        elif op == _STORE:
+            a = fp + code[pc + 1]
+            n = len(st) - code[pc + 2]
+            mem[a:a + code[pc + 2]] = st[n:]
+            del st[n:]
+        elif op == _XOR:
+            b = st.pop()
+            st[-1] ^= b
+        elif op == _AND:
+            b = st.pop()
+            st[-1] &= b
+        elif op == _OR:
+            b = st.pop()
+            st[-1] |= b
+        elif op == _NOT:
+            st[-1] ^= 1
+        elif op == _IM:
+            b = st.pop()
+            st[-1] = (st[-1] ^ 1) | b
+        elif op == _COPY:
+            a = fp + code[pc + 1]
+            mem[a:a + code[pc + 2]] = st[len(st) - code[pc + 2]:]
+        elif op == _PUSH_BIT_CONST:
+            st.append(code[pc + 1])
+        elif op == _PUSH_CONST:
+            st.extend(consts[code[pc + 1]])
+        elif op == _DROP:
+            del st[len(st) - code[pc + 2]:]
+        elif op == _JZ:
+            if not st.pop():
+                pc = code[pc + 1]
+                continue
+        elif op == _JMP:
+            pc = code[pc + 1]
+            continue
+        elif op == _LOOP_NEXT:
+            a = fp + code[pc + 1]
+            mem[a] -= 1
+            if mem[a]:
+                pc = code[pc + 2]
+                continue
+        elif op == _LOOP_INIT:
+            mem[fp + code[pc + 1]] = code[pc + 2]
+        elif op == _ZERO:
+            a = fp + code[pc + 1]
+            mem[a:a + code[pc + 2]] = [0] * code[pc + 2]
+        elif op == _TABLE:
+            fn, len_in, len_out = tables[code[pc + 1]]
+            n = len(st) - len_in
+            idx = 0
+            for b in st[n:]:
+                idx = (idx << 1) | b
+            del st[n:]
+            v = fn(idx)
+            st.extend([(v >> i) & 1 for i in range(len_out - 1, -1, -1)])
+        elif op == _CALL:
+            calls.append((pc + 3, fp))
+            fp += code[pc + 2]
+            pc = code[pc + 1]
+            continue
+        elif op == _ENTER:
+            mem[fp:fp + code[pc + 2]] = [0] * code[pc + 2]
+        elif op == _RET:
+            if not calls:
+                return
+            pc, fp = calls.pop()
+            continue
+        else:
+            raise IpRunError(f'unexpected error: invalid opcode {op} at {pc}')
+        pc += 3
+
+
+# =====================================================================================================================
+def vm_runners():
+    ret = ip_runners()
+    ret['Prog'] = VmRunProg
+    return ret
+
+
+# =====================================================================================================================
+class VmRunProg(IpRunProg):
+    """ Runs functions through the bytecode VM (the entry function is lowered on its first call) """
+    def __init__(self, prog: Prog):
+        super().__init__(prog)
+        self._code = {}
+
+    def get_code(self, func_name: str) -> VmCode:
+        if func_name not in self._code:
+            self._code[func_name] = VmLowering(self.prog).lower(self.get_func(func_name))
+        return self._code[func_name]
+
+    def run(self, func_name: str, params):
+        """ Parameters as in IpRunProg.run """
+        if params is None or 'param' not in params:
+            raise IpRunError("params['param'] parameter is not defined; example: { 'param': [1, 2] }")
+        param = params['param']
+        print_result = params.get('print_result', True)
+
+        f = self.get_func(func_name)
+        pp = self.param_bits(f, param)
+        st = pp.copy()
+        _execute(self.get_code(func_name), st)
+        ret = self.bits_list_to_int(st)
+
+        if print_result:
+            print(f'{func_name} ( {self.param_to_str(pp, f.fmt[0], ", ")} ) '
+                  + f'-> {self.param_to_str(st, f.fmt[1], ", ")}')
+        return ret
+